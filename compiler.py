@@ -1,13 +1,753 @@
 import argparse
+import hashlib
+import marshal
+import os
+import re
+import sys
 
+# The TuringMini assembler.
+#
+# Two instruction sets are supported (see Readme.md):
+#   reg12 - the 12-bit register ISA, assembled into a 4096-nibble image (one nibble
+#           per byte) with the PC/SP reset vectors at 0xFF9/0xFFC, as loaded by emul4b.py
+#   bf    - the 4-bit BrainFuck-style ISA, assembled into a 256-byte image with the
+#           interrupt vector table at 0x00-0x0F and code from 0x10
+#
+# Source syntax, one statement per line, ';' starts a comment:
+#   label:  MNEMONIC operand, operand
+#           .org <expr>             set the location counter
+#           .equ <name>, <expr>     define a constant
+#           .data <expr>, ...       raw nibbles (reg12) or bytes (bf)
+#           .include "<file>"       assemble another file in place
+#           .entry <expr>           reg12: initial PC (default: main, or 0)
+#           .stack <expr>           reg12: initial SP (default: 0)
+#           .vector <n>, <expr>     bf: interrupt vector n, 0 is main (default: main, or 0x10)
+# Files ending in .bf are BrainFuck sources for the bf ISA, see parse_bf().
+# Expressions are numbers (decimal, 0x.., 0b..), symbols, '$' (address of the current
+# instruction), optionally followed by +/- number.
+#
+# Each file is parsed once into a list of items in which every instruction that does
+# not depend on its address or on a symbol is already encoded. link() then walks the
+# items in a single pass, encodes the remaining instructions as soon as their symbols
+# are known and backpatches forward references at the end. With a cache directory
+# the parsed items are stored per file, keyed by the content hash, so a rebuild only
+# re-parses the files that changed and re-runs the link.
 
-def main(input_file, output_file):
+# Bump whenever the item format or the encoding of any instruction changes
+ASSEMBLER_VERSION = 3
+
+ISA_REG12 = "reg12"
+ISA_BF = "bf"
+ISAS = [ISA_REG12, ISA_BF]
+
+ITEM_DATA, ITEM_INSN, ITEM_LABEL, ITEM_EQU, ITEM_ORG, ITEM_INCLUDE, ITEM_DIRECTIVE, ITEM_RAW = range(8)
+
+
+class AssemblerError(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------
+#  Encoders
+# ----------------------------------------------------------------------
+def check_range(value, low, high, what):
+    if not low <= value <= high:
+        raise ValueError(f"{what} {value} out of range [{low}, {high}]")
+    return value
+
+
+def rel_offset(target, next_pc, bits):
+    half = 1 << (bits - 1)
+    offset = check_range(target - next_pc, -half, half - 1, "jump offset")
+    return offset & ((1 << bits) - 1)
+
+
+def reg12_reg_addr(kind, reg, value):
+    return [(kind << 1) | (reg >> 1), ((reg & 1) << 3) | (value >> 8), (value >> 4) & 0x0F, value & 0x0F]
+
+
+def reg12_jcond(kind):
+    return lambda ops, pc: reg12_reg_addr(kind, ops[0], rel_offset(ops[1], pc + 4, 11))
+
+
+def reg12_mem(kind):
+    return lambda ops, pc: reg12_reg_addr(kind, ops[0], check_range(ops[1], 0, 0x7FF, "address"))
+
+
+def reg12_alu(n0):
+    return lambda ops, pc: [n0, (ops[0] << 2) | ops[1]]
+
+
+def reg12_io(n1):
+    def encode(ops, pc):
+        port = check_range(ops[1], 0, 0xFF, "IO port")
+        return [0xF, n1 | ops[0], port >> 4, port & 0x0F]
+    return encode
+
+
+def reg12_jmp(ops, pc):
+    offset = rel_offset(ops[0], pc + 4, 11)
+    return [0xF, offset >> 8, (offset >> 4) & 0x0F, offset & 0x0F]
+
+
+def bf_nibble_arg(base, what):
+    return lambda ops, pc: [base | check_range(ops[0], 0, 0x0F, what)]
+
+
+def bf_jump(base):
+    return lambda ops, pc: [base | rel_offset(ops[0], pc + 1, 6)]
+
+
+# Operand kinds: "r2" 2-bit register, "r4" 4-bit register, "imm" expression.
+# Entries: mnemonic -> (size, operand kinds, depends on its own address, encoder(operands, pc))
+REG12_OPCODES = {
+    "JZ":   (4, ("r2", "imm"), True, reg12_jcond(0)),
+    "JNZ":  (4, ("r2", "imm"), True, reg12_jcond(1)),
+    "LD":   (4, ("r2", "imm"), False, reg12_mem(2)),
+    "STOR": (4, ("r2", "imm"), False, reg12_mem(3)),
+    "AND":  (2, ("r2", "r2"), False, reg12_alu(0x9)),
+    "OR":   (2, ("r2", "r2"), False, reg12_alu(0xA)),
+    "XOR":  (2, ("r2", "r2"), False, reg12_alu(0xB)),
+    "ADD":  (2, ("r2", "r2"), False, reg12_alu(0xC)),
+    "SUB":  (2, ("r2", "r2"), False, reg12_alu(0xD)),
+    "SETA": (2, ("imm",), False, lambda ops, pc: [0xE, check_range(ops[0], 0, 0x0F, "immediate")]),
+    "JMP":  (4, ("imm",), True, reg12_jmp),
+    "IN":   (4, ("r2", "imm"), False, reg12_io(0x8)),
+    "OUT":  (4, ("r2", "imm"), False, reg12_io(0xC)),
+    "RET":  (2, (), False, lambda ops, pc: [0x8, 0x0]),
+    "MOV":  (4, ("r4", "r4"), False, lambda ops, pc: [0x8, 0x1, ops[0], ops[1]]),
+    "HALT": (4, (), False, lambda ops, pc: [0xF, 0x7, 0xF, 0xC]),     # JMP $
+}
+
+BF_OPCODES = {
+    "SLEEP": (1, (), False, lambda ops, pc: [0x00]),
+    "ZERO":  (1, (), False, lambda ops, pc: [0x01]),
+    "RET":   (1, (), False, lambda ops, pc: [0x10]),
+    "IN":    (1, ("imm",), False, bf_nibble_arg(0x20, "IO port")),
+    "OUT":   (1, ("imm",), False, bf_nibble_arg(0x30, "IO port")),
+    "INC":   (1, ("imm",), False, bf_nibble_arg(0x40, "count")),
+    "DEC":   (1, ("imm",), False, bf_nibble_arg(0x50, "count")),
+    "PINC":  (1, ("imm",), False, bf_nibble_arg(0x60, "count")),
+    "PDEC":  (1, ("imm",), False, bf_nibble_arg(0x70, "count")),
+    "JZ":    (1, ("imm",), True, bf_jump(0x80)),
+    "JNZ":   (1, ("imm",), True, bf_jump(0xC0)),
+}
+
+REGS2 = {"A": 0, "B": 1, "C": 2, "E0": 3}
+REGS4 = {"A": 0, "B": 1, "C": 2, "E0": 3, "E1": 4, "E2": 5, "PC": 6, "SP": 7}
+
+
+class Target:
+    """Memory layout of an ISA"""
+    def __init__(self, isa):
+        self.isa = isa
+        if isa == ISA_REG12:
+            self.opcodes = REG12_OPCODES
+            self.size = 0x1000
+            self.origin = 0x000
+            self.code_end = 0xFF9   # Reset vectors live at 0xFF9-0xFFE
+            self.value_mask = 0x0F
+        elif isa == ISA_BF:
+            self.opcodes = BF_OPCODES
+            self.size = 0x100
+            self.origin = 0x10      # 0x00-0x0F is the interrupt vector table
+            self.code_end = 0x100
+            self.value_mask = 0xFF
+        else:
+            raise AssemblerError(f"Unknown ISA: {isa}")
+
+
+# ----------------------------------------------------------------------
+#  Parser
+# ----------------------------------------------------------------------
+LINE_RE = re.compile(r"\s*(?:([A-Za-z_.][\w.]*)\s*:)?\s*(?:([.\w]+)\s*(.*?))?\s*$")
+EXPR_RE = re.compile(r"([A-Za-z_.][\w.]*|\$|[-+]?(?:0[xX][0-9a-fA-F]+|0[bB][01]+|\d+))\s*(?:([-+])\s*(0[xX][0-9a-fA-F]+|0[bB][01]+|\d+))?$")
+
+
+def parse_number(text):
+    return int(text, 0)
+
+
+def parse_expr(text):
+    """Return an int, or a (symbol, addend) tuple where symbol '$' is the current address"""
+    match = EXPR_RE.match(text.strip())
+    if match is None:
+        raise ValueError(f"invalid expression '{text}'")
+    base, sign, addend = match.groups()
+    addend = parse_number(addend) if addend else 0
+    if sign == "-":
+        addend = -addend
+    if base[0].isdigit() or base[0] in "+-":
+        return parse_number(base) + addend
+    return (base, addend)
+
+
+def tokenize(lines):
+    """Yield (line number, label, mnemonic, operands) for each non-empty source line"""
+    for line_no, line in enumerate(lines, 1):
+        line = line.split(";", 1)[0]
+        if not line.strip():
+            continue
+        match = LINE_RE.match(line)
+        if match is None:
+            yield line_no, None, "", [line.strip()]
+            continue
+        label, mnemonic, rest = match.groups()
+        operands = [op.strip() for op in rest.split(",")] if rest else []
+        yield line_no, label, mnemonic.upper() if mnemonic else None, operands
+
+
+def parse_operand(kind, text):
+    if kind == "r2":
+        reg = REGS2.get(text.upper())
+        if reg is None:
+            raise ValueError(f"expected one of {', '.join(REGS2)}, got '{text}'")
+        return reg
+    if kind == "r4":
+        reg = REGS4.get(text.upper())
+        if reg is None:
+            raise ValueError(f"expected one of {', '.join(REGS4)}, got '{text}'")
+        return reg
+    return parse_expr(text)
+
+
+def parse_lines(lines, path, target):
+    """Parse source lines into a list of items"""
+    items = []
+    data = None     # Last ITEM_DATA item, consecutive encoded instructions are merged into it
+    opcodes = target.opcodes
+    for line_no, label, mnemonic, operands in tokenize(lines):
+        try:
+            if label is not None:
+                items.append((ITEM_LABEL, label, line_no))
+                data = None
+            if mnemonic is None:
+                continue
+            if mnemonic.startswith("."):
+                data = None
+                if mnemonic == ".ORG":
+                    items.append((ITEM_ORG, parse_expr(operands[0]), line_no))
+                elif mnemonic == ".EQU":
+                    items.append((ITEM_EQU, operands[0], parse_expr(operands[1]), line_no))
+                elif mnemonic == ".DATA":
+                    values = [parse_expr(op) for op in operands]
+                    if all(isinstance(v, int) for v in values):
+                        items.append((ITEM_RAW, [v & target.value_mask for v in values], line_no))
+                    else:
+                        for v in values:
+                            items.append((ITEM_DIRECTIVE, ".DATA", [v], line_no))
+                elif mnemonic == ".INCLUDE":
+                    name = operands[0].strip("\"'")
+                    # Absolute, cached items are shared by builds started from other directories
+                    items.append((ITEM_INCLUDE, os.path.join(os.path.dirname(os.path.abspath(path)), name), line_no))
+                elif mnemonic in (".ENTRY", ".STACK", ".VECTOR"):
+                    items.append((ITEM_DIRECTIVE, mnemonic, [parse_expr(op) for op in operands], line_no))
+                else:
+                    raise ValueError(f"unknown directive {mnemonic.lower()}")
+                continue
+            opcode = opcodes.get(mnemonic)
+            if opcode is None:
+                raise ValueError(f"unknown instruction {mnemonic}")
+            size, kinds, pc_relative, encoder = opcode
+            if len(operands) != len(kinds):
+                raise ValueError(f"{mnemonic} takes {len(kinds)} operand(s), got {len(operands)}")
+            values = [parse_operand(kind, op) for kind, op in zip(kinds, operands)]
+            if pc_relative or not all(isinstance(v, int) for v in values):
+                items.append((ITEM_INSN, mnemonic, values, line_no))
+                data = None
+            else:
+                code = encoder(values, 0)
+                if data is None:
+                    data = (ITEM_DATA, code, line_no)
+                    items.append(data)
+                else:
+                    data[1].extend(code)
+        except (ValueError, IndexError) as e:
+            raise AssemblerError(f"{path}:{line_no}: {e}") from None
+    return items
+
+
+def parse_bf(text, path, target):
+    """Translate BrainFuck source into items for the bf ISA.
+
+    '+' '-' '>' '<' map to INC/DEC/PINC/PDEC 1, '.' and ',' to OUT/IN on the UART
+    LSB port, '[' to JZ past the matching ']' and ']' to JNZ back past the '['.
+    Loop labels are prefixed with the file path so included files can't clash.
+    """
+    if target.isa != ISA_BF:
+        raise AssemblerError(f"{path}: BrainFuck sources need the {ISA_BF} ISA")
+    simple = {"+": 0x41, "-": 0x51, ">": 0x61, "<": 0x71, ".": 0x31, ",": 0x21}
+    items = []
+    data = None
+    loops = []
+    count = 0
+    for line_no, line in enumerate(text.splitlines(), 1):
+        for char in line:
+            code = simple.get(char)
+            if code is not None:
+                if data is None:
+                    data = (ITEM_DATA, [], line_no)
+                    items.append(data)
+                data[1].append(code)
+            elif char == "[":
+                loops.append(count)
+                items.append((ITEM_INSN, "JZ", [(bf_label(path, count, "end"), 0)], line_no))
+                items.append((ITEM_LABEL, bf_label(path, count, "start"), line_no))
+                count += 1
+                data = None
+            elif char == "]":
+                if not loops:
+                    raise AssemblerError(f"{path}:{line_no}: unmatched ']'")
+                n = loops.pop()
+                items.append((ITEM_INSN, "JNZ", [(bf_label(path, n, "start"), 0)], line_no))
+                items.append((ITEM_LABEL, bf_label(path, n, "end"), line_no))
+                data = None
+    if loops:
+        raise AssemblerError(f"{path}: unmatched '['")
+    return items
+
+
+def bf_label(path, n, suffix):
+    return f"{path}:bf{n}.{suffix}"
+
+
+def is_private_label(name):
+    """Labels generated by parse_bf() can't be referenced from other files"""
+    return ":bf" in name
+
+
+def parse_source(lines, path, target):
+    if path.endswith(".bf"):
+        return parse_bf("\n".join(lines), path, target)
+    return parse_lines(lines, path, target)
+
+
+def parse_file(path, target):
+    with open(path) as f:
+        return parse_source(f.read().splitlines(), path, target)
+
+
+# ----------------------------------------------------------------------
+#  Peephole optimizer for the bf ISA
+# ----------------------------------------------------------------------
+BF_CELL_MASK = 0x0F     # Tape cells are one nibble wide
+BF_MAX_COUNT = 0x0F     # Largest count of INC/DEC/PINC/PDEC
+BF_LOOP_WEIGHT = 8      # Estimated iterations per loop level, used for the cycle estimate
+
+
+class BFOptimizer:
+    """Peephole optimizer working on the parsed items of the bf ISA.
+
+    Within straight-line code it folds runs of INC/DEC into one instruction (cells
+    are 4 bits wide, so any net change fits) and runs of PINC/PDEC into as few
+    maximal-count instructions as possible, removing moves that cancel out. Clear
+    loops ('[-]', or any odd INC/DEC count) become ZERO, cell updates overwritten by
+    a ZERO and ZEROs of a cell that is already zero after a loop are dropped.
+    Labels from assembly sources may be jumped to from other files, so code is only
+    moved across or deleted around labels generated by parse_bf().
+    Items the optimizer doesn't understand (.org, .data etc.) are left untouched and
+    split the code into independently optimized segments. Jumps to '$', to addresses
+    or to label offsets encode a fixed distance that moving code would break, so files
+    containing one are not optimized at all.
+    """
+    def __init__(self):
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.cycles_before = 0
+        self.cycles_after = 0
+
+    def report(self):
+        return (f"Optimizer: {self.bytes_before} -> {self.bytes_after} bytes, "
+                f"~{self.cycles_before} -> ~{self.cycles_after} cycles (estimated)")
+
+    def optimize(self, items):
+        ops = self.to_ops(items)
+        self.bytes_before += self.size(ops)
+        self.cycles_before += self.cycles(ops)
+        if self.has_fixed_jumps(ops):
+            self.bytes_after += self.size(ops)
+            self.cycles_after += self.cycles(ops)
+            return items
+        while True:
+            before = len(ops)
+            ops = self.clear_loops(ops)
+            ops = self.fold(ops)
+            ops = self.dead_zero(ops)
+            if len(ops) == before:
+                break
+        self.bytes_after += self.size(ops)
+        self.cycles_after += self.cycles(ops)
+        return self.to_items(ops)
+
+    # Ops are [name, argument, line], "ITEM" ops carry an item the optimizer keeps as is
+    @staticmethod
+    def to_ops(items):
+        ops = []
+        decode = {0x4: "INC", 0x5: "DEC", 0x6: "PINC", 0x7: "PDEC"}
+        for item in items:
+            kind = item[0]
+            if kind == ITEM_DATA:
+                for code in item[1]:
+                    name = decode.get(code >> 4)
+                    if name is not None and code & 0x0F:
+                        ops.append([name, code & 0x0F, item[2]])
+                    elif code == 0x01:
+                        ops.append(["ZERO", 0, item[2]])
+                    else:
+                        ops.append(["BYTE", code, item[2]])
+            elif kind == ITEM_LABEL:
+                ops.append(["LABEL", item[1], item[2]])
+            elif (kind == ITEM_INSN and item[1] in ("JZ", "JNZ") and isinstance(item[2][0], tuple)
+                    and item[2][0][0] != "$" and item[2][0][1] == 0):
+                ops.append([item[1], item[2][0][0], item[3]])
+            else:
+                ops.append(["ITEM", item, item[-1]])
+        return ops
+
+    @staticmethod
+    def to_items(ops):
+        items = []
+        data = None
+        encode = {"INC": 0x40, "DEC": 0x50, "PINC": 0x60, "PDEC": 0x70}
+        for name, arg, line in ops:
+            if name in encode or name in ("ZERO", "BYTE"):
+                code = encode[name] | arg if name in encode else (0x01 if name == "ZERO" else arg)
+                if data is None:
+                    data = (ITEM_DATA, [], line)
+                    items.append(data)
+                data[1].append(code)
+                continue
+            data = None
+            if name == "LABEL":
+                items.append((ITEM_LABEL, arg, line))
+            elif name in ("JZ", "JNZ"):
+                items.append((ITEM_INSN, name, [(arg, 0)], line))
+            else:
+                items.append(arg)
+        return items
+
+    @staticmethod
+    def has_fixed_jumps(ops):
+        """True if a JZ/JNZ target isn't a plain label (kept as an "ITEM" op by to_ops())"""
+        return any(name == "ITEM" and arg[0] == ITEM_INSN and arg[1] in ("JZ", "JNZ") for name, arg, _ in ops)
+
+    @staticmethod
+    def size(ops):
+        return sum(1 for op in ops if op[0] not in ("LABEL", "ITEM"))
+
+    @staticmethod
+    def cycles(ops):
+        """One cycle per instruction, weighted by BF_LOOP_WEIGHT per enclosing JZ/JNZ loop"""
+        depth = 0
+        total = 0
+        for name, _, _ in ops:
+            if name in ("LABEL", "ITEM"):
+                continue
+            if name == "JNZ":
+                depth = max(0, depth - 1)
+            total += BF_LOOP_WEIGHT ** depth
+            if name == "JZ":
+                depth += 1
+        return total
+
+    @staticmethod
+    def references(ops):
+        refs = {}
+        for name, arg, _ in ops:
+            if name in ("JZ", "JNZ"):
+                refs[arg] = refs.get(arg, 0) + 1
+        return refs
+
+    def clear_loops(self, ops):
+        """JZ end / start: / INC|DEC odd / JNZ start / end: -> ZERO"""
+        refs = self.references(ops)
+        out = []
+        i = 0
+        while i < len(ops):
+            window = ops[i:i + 5]
+            if (len(window) == 5 and window[0][0] == "JZ" and window[1][0] == "LABEL"
+                    and window[2][0] in ("INC", "DEC") and window[2][1] & 1
+                    and window[3][0] == "JNZ" and window[3][1] == window[1][1]
+                    and window[4][0] == "LABEL" and window[0][1] == window[4][1]
+                    and is_private_label(window[1][1]) and is_private_label(window[4][1])
+                    and refs[window[1][1]] == 1 and refs[window[4][1]] == 1):
+                out.append(["ZERO", 0, window[0][2]])
+                i += 5
+            else:
+                out.append(ops[i])
+                i += 1
+        return out
+
+    @staticmethod
+    def fold(ops):
+        out = []
+        i = 0
+        while i < len(ops):
+            name = ops[i][0]
+            if name in ("INC", "DEC", "PINC", "PDEC"):
+                is_cell = name in ("INC", "DEC")
+                group = ("INC", "DEC") if is_cell else ("PINC", "PDEC")
+                delta = 0
+                line = ops[i][2]
+                while i < len(ops) and ops[i][0] in group:
+                    delta += ops[i][1] if ops[i][0] == group[0] else -ops[i][1]
+                    i += 1
+                if is_cell:
+                    delta &= BF_CELL_MASK
+                    if delta:
+                        if delta <= (BF_CELL_MASK + 1) // 2:
+                            out.append(["INC", delta, line])
+                        else:
+                            out.append(["DEC", (-delta) & BF_CELL_MASK, line])
+                else:
+                    op = group[0] if delta > 0 else group[1]
+                    delta = abs(delta)
+                    while delta:
+                        count = min(delta, BF_MAX_COUNT)
+                        out.append([op, count, line])
+                        delta -= count
+            else:
+                out.append(ops[i])
+                i += 1
+        return out
+
+    @staticmethod
+    def dead_zero(ops):
+        """Drop cell updates before a ZERO and ZEROs of a cell known to be zero"""
+        jnz_targets = {op[1] for op in ops if op[0] == "JNZ"}
+        out = []
+        known_zero = False  # The current cell is zero at this point
+        for op in ops:
+            name = op[0]
+            if name == "ZERO":
+                while out and out[-1][0] in ("INC", "DEC"):
+                    out.pop()
+                if known_zero or (out and out[-1][0] == "ZERO"):
+                    continue
+                out.append(op)
+                known_zero = True
+                continue
+            if name == "LABEL":
+                # Zero is still known if only JZs (taken when the cell is zero) jump here
+                if not is_private_label(op[1]) or op[1] in jnz_targets:
+                    known_zero = False
+                out.append(op)
+                continue
+            out.append(op)
+            known_zero = name == "JNZ"  # JNZ falls through only when the cell is zero
+        return out
+
+
+class ItemCache:
+    """On-disk cache of parsed items, one marshal file per source file version.
+
+    The key covers the source content, its path (includes are resolved relative
+    to it), the ISA, ASSEMBLER_VERSION and the marshal format. Unreadable entries
+    are treated as misses.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.memory = {}    # Entries already loaded by this process
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, target, content):
+        digest = hashlib.sha256()
+        digest.update(f"{ASSEMBLER_VERSION}:{marshal.version}:{target.isa}:{os.path.abspath(path)}\0".encode())
+        digest.update(content)
+        return digest.hexdigest()
+
+    def load_items(self, path, target):
+        with open(path, 'rb') as f:
+            content = f.read()
+        key = self.key(path, target, content)
+        items = self.memory.get(key)
+        if items is not None:
+            self.hits += 1
+            return items
+        cache_file = os.path.join(self.cache_dir, key + ".bin")
+        try:
+            with open(cache_file, 'rb') as f:
+                items = marshal.loads(f.read())
+            self.hits += 1
+        except (OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            items = parse_source(content.decode().splitlines(), path, target)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(marshal.dumps(items))
+            os.replace(tmp_file, cache_file)   # Atomic, parallel builds may share the cache
+        self.memory[key] = items
+        return items
+
+
+# ----------------------------------------------------------------------
+#  Linker
+# ----------------------------------------------------------------------
+class Linker:
+    def __init__(self, target, load_items=parse_file, optimizer=None):
+        self.target = target
+        self.load_items = load_items    # (path, target) -> items
+        self.optimizer = optimizer      # Rewrites the items of each file before they are linked
+        self.image = bytearray(target.size)
+        self.used = bytearray(target.size)
+        self.symbols = {}
+        self.fixups = []        # (pc, mnemonic, operands, path, line) waiting for symbols
+        self.directives = []    # (name, operands, pc, path, line) resolved after the last file
+        self.pc = target.origin
+        self.files = []
+
+    def resolve(self, value, pc):
+        """Return the value of an expression, or None while its symbol is undefined"""
+        if isinstance(value, int):
+            return value
+        symbol, addend = value
+        if symbol == "$":
+            return pc + addend
+        base = self.symbols.get(symbol)
+        return None if base is None else base + addend
+
+    def emit(self, pc, code):
+        end = pc + len(code)
+        if pc < 0 or end > self.target.code_end:
+            raise ValueError(f"code at 0x{pc:X} doesn't fit below 0x{self.target.code_end:X}")
+        if any(self.used[pc:end]):
+            raise ValueError(f"code at 0x{pc:X} overlaps previously assembled code")
+        self.image[pc:end] = bytes(code)
+        self.used[pc:end] = b"\x01" * len(code)
+
+    def define(self, name, value):
+        if name in self.symbols:
+            raise ValueError(f"symbol '{name}' redefined")
+        self.symbols[name] = value
+
+    def link_file(self, path, stack=()):
+        if path in stack:
+            raise AssemblerError(f"{path}: recursive include")
+        self.files.append(path)
+        items = self.load_items(path, self.target)
+        if self.optimizer is not None:
+            items = self.optimizer.optimize(items)
+        opcodes = self.target.opcodes
+        for item in items:
+            kind = item[0]
+            try:
+                if kind == ITEM_DATA or kind == ITEM_RAW:
+                    self.emit(self.pc, item[1])
+                    self.pc += len(item[1])
+                elif kind == ITEM_INSN:
+                    _, mnemonic, operands, _ = item
+                    size, _, _, encoder = opcodes[mnemonic]
+                    values = [self.resolve(v, self.pc) for v in operands]
+                    if None in values:
+                        self.emit(self.pc, [0] * size)
+                        self.fixups.append((self.pc, mnemonic, operands, path, item[-1]))
+                    else:
+                        self.emit(self.pc, encoder(values, self.pc))
+                    self.pc += size
+                elif kind == ITEM_LABEL:
+                    self.define(item[1], self.pc)
+                elif kind == ITEM_EQU:
+                    value = self.resolve(item[2], self.pc)
+                    if value is None:
+                        raise ValueError(f".equ {item[1]} uses an undefined symbol")
+                    self.define(item[1], value)
+                elif kind == ITEM_ORG:
+                    value = self.resolve(item[1], self.pc)
+                    if value is None:
+                        raise ValueError(".org uses an undefined symbol")
+                    self.pc = value
+                elif kind == ITEM_INCLUDE:
+                    self.link_file(item[1], stack + (path,))
+                elif kind == ITEM_DIRECTIVE:
+                    self.directives.append((item[1], item[2], self.pc, path, item[-1]))
+                    if item[1] == ".DATA":
+                        self.emit(self.pc, [0])
+                        self.pc += 1
+            except ValueError as e:
+                raise AssemblerError(f"{path}:{item[-1]}: {e}") from None
+
+    def finish(self):
+        """Backpatch forward references and write the vectors, returns the image"""
+        opcodes = self.target.opcodes
+        for pc, mnemonic, operands, path, line in self.fixups:
+            try:
+                values = [self.resolve_final(v, pc) for v in operands]
+                code = opcodes[mnemonic][3](values, pc)
+            except ValueError as e:
+                raise AssemblerError(f"{path}:{line}: {e}") from None
+            self.image[pc:pc + len(code)] = bytes(code)
+
+        main = self.symbols.get("main")
+        if self.target.isa == ISA_REG12:
+            vectors = {".ENTRY": main if main is not None else 0, ".STACK": 0}
+        else:
+            vectors = {0: main if main is not None else self.target.origin}
+        for name, operands, pc, path, line in self.directives:
+            try:
+                values = [self.resolve_final(v, pc) for v in operands]
+                if name == ".DATA":
+                    self.image[pc] = values[0] & self.target.value_mask
+                elif name == ".VECTOR" and self.target.isa == ISA_BF:
+                    vectors[check_range(values[0], 0, 0x0F, "vector")] = values[1]
+                elif name in (".ENTRY", ".STACK") and self.target.isa == ISA_REG12:
+                    vectors[name] = values[0]
+                else:
+                    raise ValueError(f"{name.lower()} is not supported by the {self.target.isa} ISA")
+            except (ValueError, IndexError) as e:
+                raise AssemblerError(f"{path}:{line}: {e}") from None
+
+        if self.target.isa == ISA_REG12:
+            for address, value in ((0xFF9, vectors[".ENTRY"]), (0xFFC, vectors[".STACK"])):
+                value &= 0xFFF
+                self.image[address:address + 3] = bytes([value >> 8, (value >> 4) & 0x0F, value & 0x0F])
+        else:
+            for n, value in vectors.items():
+                self.image[n] = value & 0xFF
+        return self.image
+
+    def resolve_final(self, value, pc):
+        resolved = self.resolve(value, pc)
+        if resolved is None:
+            raise ValueError(f"undefined symbol '{value[0]}'")
+        return resolved
+
+
+def assemble(path, isa=ISA_REG12, cache=None, optimizer=None):
+    """Assemble a source file, returns the memory image as a bytearray.
+
+    cache is an optional ItemCache reused for all the files of the program,
+    optimizer an optional BFOptimizer (bf ISA only).
+    """
+    if optimizer is not None and isa != ISA_BF:
+        raise AssemblerError(f"The optimizer only supports the {ISA_BF} ISA")
+    linker = Linker(Target(isa), cache.load_items if cache is not None else parse_file, optimizer)
+    linker.link_file(path)
+    return linker.finish()
+
+
+def main(input_file, output_file, isa=ISA_REG12, cache_dir=None, optimize=False):
     print(f"Source file: {input_file}, output file: {output_file}")
+    optimizer = BFOptimizer() if optimize else None
+    try:
+        image = assemble(input_file, isa, ItemCache(cache_dir) if cache_dir else None, optimizer)
+    except (AssemblerError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+    if optimizer is not None:
+        print(optimizer.report())
+    with open(output_file, 'wb') as f:
+        f.write(image)
+    return 0
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="The TuringMini compiler")
     parser.add_argument("--source", required=True, type=str, help="The source file")
     parser.add_argument("--output", required=True, type=str, help="Output file name")
+    parser.add_argument("--isa", choices=ISAS, default=ISA_REG12, help="Target instruction set")
+    parser.add_argument("--cache-dir", type=str, help="Directory for the incremental assembly cache")
+    parser.add_argument("--optimize", action="store_true", help="Run the peephole optimizer (bf ISA)")
     args = parser.parse_args()
-    main(args.source, args.output)
+    sys.exit(main(args.source, args.output, args.isa, args.cache_dir, args.optimize))
@@ -1,52 +1,126 @@
-from pynput import keyboard # pip install pynput
-from queue import Queue
+from queue import Queue, Empty
+from collections import deque
 import threading
+import argparse
 import time
 import sys
 
+import trace4b
+
 class UserInputGetter:
     def __init__(self):
-        self.input_queue = Queue()
+        from pynput import keyboard # pip install pynput, only the REPL needs it
+        self.keys = keyboard.Key
+        self.input_queue = Queue()  # Commands entered by the user (input after they hit Enter)
         self.part_input = ""    # Contains user input before they hit Enter
-        self.command = None     # Contains user input after user hit Enter, become None after read
-        self.event = threading.Event()  # Set when user hit Enter, can be used for smart wait
         self.listener = keyboard.Listener(on_press=self.key_press)
         self.listener.start()
 
     def get_part_input(self):
         return self.part_input
 
-    def get_command(self):
-        cmd = self.command
-        self.command = None
-        self.event.clear()
-        return cmd
+    def get_command(self, timeout=None):
+        """Block until the user enters a command, returns None on timeout"""
+        try:
+            return self.input_queue.get(timeout=timeout)
+        except Empty:
+            return None
 
     def key_press(self, key):
-        if key == keyboard.Key.enter:
-            self.command = self.part_input
+        if key == self.keys.enter:
+            self.input_queue.put(self.part_input)
             self.part_input = ""
-            self.event.set()
-        elif key == keyboard.Key.backspace:
+        elif key == self.keys.backspace:
             self.part_input = self.part_input[:-1]
-        elif key == keyboard.Key.space:
+        elif key == self.keys.space:
             self.part_input += " "
         elif hasattr(key, 'char'):
             self.part_input += key.char
 
 
+class BufferedWriter:
+    """Keeps a file open and writes it from a background thread in large batches.
+
+    Data is queued in a bounded ring of chunks and written when flush_size bytes are
+    pending, every flush_interval seconds and on close(). Producers block while the
+    ring holds capacity bytes instead of dropping data.
+    """
+    def __init__(self, filename, flush_size=1 << 16, flush_interval=0.5, capacity=1 << 22):
+        self.file = open(filename, 'ab')
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.ring = deque()
+        self.pending = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        with self.cond:
+            while self.pending >= self.capacity:
+                self.cond.wait()
+            self.ring.append(data)
+            self.pending += len(data)
+            if self.pending >= self.flush_size:
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.file.close()
+
+    def writer(self):
+        while True:
+            with self.cond:
+                if not self.closed and self.pending < self.flush_size:
+                    self.cond.wait(self.flush_interval)
+                chunks = list(self.ring)
+                self.ring.clear()
+                self.pending = 0
+                closed = self.closed
+                self.cond.notify_all()  # Unblock producers waiting for free space
+            if chunks:
+                self.file.write(b"".join(chunks))
+                self.file.flush()
+            if closed:
+                return
+
+
 class Logger:
-    def __init__(self, ui_getter, print_to_file=False):
+    def __init__(self, ui_getter, print_to_file=False, buffered=False):
         self.ui_getter = ui_getter
         self.print_to_file = print_to_file
+        self.buffered = buffered    # Keep files open and write them in the background
+        self.writers = {}
 
     def print(self, filename, logstring):
         if self.print_to_file:
-            with open(filename, 'a') as f:
-                f.write(logstring + "\n")
+            if self.buffered:
+                self.write(filename, (logstring + "\n").encode())
+            else:
+                with open(filename, 'a') as f:
+                    f.write(logstring + "\n")
         else:
             self.print_line(logstring)
 
+    def write(self, filename, data):
+        """Append raw bytes to a file through its BufferedWriter"""
+        writer = self.writers.get(filename)
+        if writer is None:
+            writer = self.writers[filename] = BufferedWriter(filename)
+        writer.write(data)
+
+    def close(self, filename=None):
+        """Flush and close one buffered file, or all of them"""
+        for name in [filename] if filename is not None else list(self.writers):
+            writer = self.writers.pop(name, None)
+            if writer is not None:
+                writer.close()
+
     def print_line(self, line):
         part_cmd = self.ui_getter.get_part_input()
         print(f"\033[2K\r{line}")
@@ -54,6 +128,28 @@ class Logger:
         sys.stdout.flush()
 
 
+class RateMeter:
+    """Measures emulated instructions per second and host CPU usage since the last reset"""
+    def __init__(self, instret=0):
+        self.reset(instret)
+
+    def reset(self, instret):
+        self.instret = instret
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def sample(self, instret):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        ips = (instret - self.instret) / wall if wall > 0 else 0.0
+        load = 100.0 * cpu / wall if wall > 0 else 0.0
+        return ips, load
+
+    def report(self, instret):
+        ips, load = self.sample(instret)
+        return f"{ips:,.0f} instructions/s, host CPU {load:.0f}%"
+
+
 class CPURegs:
     def __init__(self):
         self.A = 0
@@ -75,64 +171,767 @@ class CPURegs:
         self.C = value & 0x0F
 
 
+# Instruction kinds of the 12-bit register ISA (see the bottom of Readme.md).
+# Instructions are 2 or 4 nibbles long and are fetched MSB nibble first.
+OP_JZ, OP_JNZ, OP_LD, OP_STOR, OP_AND, OP_OR, OP_XOR, OP_ADD, OP_SUB, OP_SETA, \
+    OP_JMP, OP_IN, OP_OUT, OP_RET, OP_MOV, OP_HALT, OP_ILLEGAL = range(17)
+
+OP_NAMES = ["JZ", "JNZ", "LD", "STOR", "AND", "OR", "XOR", "ADD", "SUB", "SETA",
+            "JMP", "IN", "OUT", "RET", "MOV", "HALT", "ILLEGAL"]
+
+# 2-bit register fields select one of the first four registers, MOV uses 4-bit fields
+REG_NAMES = ["A", "B", "C", "E0", "E1", "E2", "PC", "SP"]
+REG_MASKS = [0x0F, 0x0F, 0x0F, 0xFFF, 0xFFF, 0xFFF, 0xFFF, 0xFFF]
+
+MEM_SIZE = 0x1000
+ADDR_MASK = MEM_SIZE - 1
+UART_MSB_PORT = 0x00
+UART_LSB_PORT = 0x01
+
+# Basic blocks end at control flow and IO instructions, HALT/ILLEGAL are left to tick()
+BLOCK_TERMINATORS = {OP_JZ, OP_JNZ, OP_JMP, OP_RET, OP_IN, OP_OUT}
+MAX_BLOCK_LEN = 64
+
+# CPU.run() stop reasons
+STOP_HALT = "halt"
+STOP_BREAKPOINT = "breakpoint"
+STOP_WATCHPOINT = "watchpoint"
+STOP_BUDGET = "budget"
+RUN_CHUNK = 10000   # Instructions executed by the REPL between command checks
+
+# REPL run modes
+MODE_REALTIME = "realtime"        # Paced to the configured frequency
+MODE_UNTHROTTLED = "unthrottled"  # As fast as possible, rate reported when the CPU stops
+MODE_REFRESH = "refresh"          # As fast as possible with a periodic status line
+RUN_MODES = [MODE_REALTIME, MODE_UNTHROTTLED, MODE_REFRESH]
+REALTIME_SLICE = 0.01       # Seconds of emulated time executed per real-time chunk
+UI_REFRESH_PERIOD = 0.5     # Seconds between status lines
+USAGE = ("commands: run, stop, step, break <hex addr>, watch <hex addr>, mode <mode> [freq], "
+         "rate, trace <file> [binary] | off, quit")
+
+
+def reg_read_expr(idx, next_pc):
+    """Python expression reading register idx inside a compiled block"""
+    name = REG_NAMES[idx]
+    if name == "E0":
+        return "(A << 8 | B << 4 | C)"
+    if name == "PC":
+        return str(next_pc)
+    return name
+
+
+def reg_write_stmts(idx, expr):
+    """Python statements assigning expr to register idx inside a compiled block"""
+    name = REG_NAMES[idx]
+    if name == "E0":
+        return [f"v = ({expr}) & 4095", "A = v >> 8", "B = v >> 4 & 15", "C = v & 15"]
+    if name == "PC":
+        return [f"pc = ({expr}) & 4095"]
+    return [f"{name} = ({expr}) & {REG_MASKS[idx]}"]
+
+
+def reg_deps(idx):
+    name = REG_NAMES[idx]
+    if name == "E0":
+        return {"A", "B", "C"}
+    if name == "PC":
+        return set()
+    return {name}
+
+
+class NibbleMemory:
+    """Nibble-addressed memory, one nibble per byte of a bytearray.
+
+    Addresses wrap around the memory size (a power of two), stored values are
+    masked to 4 bits. view() exports the backing store without copying it.
+    """
+    def __init__(self, data=b"", size=MEM_SIZE):
+        self.size = size
+        self.mask = size - 1
+        self.data = bytearray(size)
+        self.load(0, data)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, address):
+        return self.data[address & self.mask]
+
+    def __setitem__(self, address, value):
+        self.data[address & self.mask] = value & 0x0F
+
+    def load(self, address, nibbles):
+        nibbles = bytes(nibble & 0x0F for nibble in nibbles)
+        if address + len(nibbles) <= self.size:
+            self.data[address:address + len(nibbles)] = nibbles
+        else:
+            for i, nibble in enumerate(nibbles):
+                self.data[(address + i) & self.mask] = nibble
+
+    def view(self):
+        return memoryview(self.data)
+
+    def get_8b(self, address):
+        data, mask = self.data, self.mask
+        return (data[address & mask] << 4) | data[(address + 1) & mask]
+
+    def set_8b(self, address, value):
+        data, mask = self.data, self.mask
+        data[address & mask] = (value >> 4) & 0x0F
+        data[(address + 1) & mask] = value & 0x0F
+
+    def get_12b(self, address):
+        data, mask = self.data, self.mask
+        return (data[address & mask] << 8) | (data[(address + 1) & mask] << 4) | data[(address + 2) & mask]
+
+    def set_12b(self, address, value):
+        data, mask = self.data, self.mask
+        data[address & mask] = (value >> 8) & 0x0F
+        data[(address + 1) & mask] = (value >> 4) & 0x0F
+        data[(address + 2) & mask] = value & 0x0F
+
+
 class CPU:
     def __init__(self, binary=[], logger=None):
         self.RESET_VECTOR = [0xFF9, 0xFFC]
-        self.ROM = binary
-        self.RAM = [0 for _ in range(0x1000)]
+        self.ROM = NibbleMemory(binary)
+        self.RAM = NibbleMemory()
         self.logger = logger
         self.regs = CPURegs()
+        self.ports = [0 for _ in range(0x100)]
+        self.uart = bytearray()
+        # Decoded instruction cache, indexed by PC. Entries are built lazily from ROM
+        # and dropped by rom_write() when the nibbles they were decoded from change.
+        self.decoded = [None for _ in range(MEM_SIZE)]
+        # Compiled basic blocks indexed by their start address, see step_block()
+        self.blocks = [None for _ in range(MEM_SIZE)]
+        # start -> (end, length, addresses of the non-first instructions, RAM addresses written)
+        self.block_info = {}
+        self.instret = 0    # Instructions retired by run()
+        self.trace_file = None  # Instruction trace written by run() through the logger
+        self.trace_writer = None    # Trace BufferedWriter owned by the CPU when there is no logger
+        self.trace_binary = False
+        self.trace_regs = None  # Register values at the previous binary trace record
+        self.handlers = [
+            self.op_jz, self.op_jnz, self.op_ld, self.op_stor,
+            self.op_alu, self.op_alu, self.op_alu, self.op_alu, self.op_alu,
+            self.op_seta, self.op_jmp, self.op_in, self.op_out, self.op_ret, self.op_mov,
+            self.op_halt, self.op_illegal,
+        ]
         self.regs.PC = self.get_12b_value(self.ROM, self.RESET_VECTOR[0])
         self.regs.SP = self.get_12b_value(self.ROM, self.RESET_VECTOR[1])
-    
+
+    def reset(self, binary=None):
+        """Return to the power-on state, optionally with a new ROM image.
+
+        Decoded instructions and compiled blocks are kept when the ROM is unchanged,
+        so a CPU reused for many runs of the same image compiles it only once.
+        """
+        if binary is not None:
+            rom = NibbleMemory(binary)
+            if rom.data != self.ROM.data:
+                self.ROM = rom
+                self.decoded = [None for _ in range(MEM_SIZE)]
+                self.blocks = [None for _ in range(MEM_SIZE)]
+                self.block_info = {}
+        self.RAM.data[:] = bytes(self.RAM.size)
+        self.regs = CPURegs()
+        self.ports = [0 for _ in range(0x100)]
+        self.uart = bytearray()
+        self.instret = 0
+        self.regs.PC = self.get_12b_value(self.ROM, self.RESET_VECTOR[0])
+        self.regs.SP = self.get_12b_value(self.ROM, self.RESET_VECTOR[1])
+
     def get_12b_value(self, mem_space, address):
-        return (mem_space[address] << 8) + (mem_space[address+1] << 4) + mem_space[address+2]
+        return mem_space.get_12b(address)
     
     def set_12b_value(self, mem_space, address, value):
-        mem_space[address]   = (value >> 8) & 0x0F
-        mem_space[address+1] = (value >> 4) & 0x0F
-        mem_space[address+2] = value & 0x0F
+        mem_space.set_12b(address, value)
+        if mem_space is self.ROM:
+            self.invalidate(address, 3)
     
     def get_8b_value(self, mem_space, address):
-        return (mem_space[address] << 4) + mem_space[address+1]
+        return mem_space.get_8b(address)
     
     def set_8b_value(self, mem_space, address, value):
-        mem_space[address]   = (value >> 4) & 0x0F
-        mem_space[address+1] = value & 0x0F
+        mem_space.set_8b(address, value)
+        if mem_space is self.ROM:
+            self.invalidate(address, 2)
+
+    def rom_write(self, address, nibbles):
+        self.ROM.load(address, nibbles)
+        self.invalidate(address, len(nibbles))
+
+    def invalidate(self, address, length):
+        # An instruction is at most 4 nibbles long, so entries starting up to
+        # 3 nibbles before the written range may have been decoded from it
+        for addr in range(address - 3, address + length):
+            self.decoded[addr & ADDR_MASK] = None
+        for start, info in list(self.block_info.items()):
+            if start < address + length and address < info[0]:
+                self.blocks[start] = None
+                del self.block_info[start]
+
+    # ------------------------------------------------------------------
+    #  Decoder
+    # ------------------------------------------------------------------
+    def decode(self, pc):
+        """Decode the instruction at pc into (kind, reg_a, reg_b, operand, next_pc).
+
+        Jump operands are resolved to absolute targets (the 11-bit field is a signed
+        offset from the next instruction), LD/STOR operands are RAM addresses,
+        SETA holds the immediate and IN/OUT hold the IO port.
+        """
+        rom = self.ROM.data
+        n0 = rom[pc]
+        n1 = rom[(pc + 1) & ADDR_MASK]
+        if n0 < 0x8 or n0 == 0xF or (n0 == 0x8 and n1 != 0):
+            n2 = rom[(pc + 2) & ADDR_MASK]
+            n3 = rom[(pc + 3) & ADDR_MASK]
+            next_pc = (pc + 4) & ADDR_MASK
+        else:
+            next_pc = (pc + 2) & ADDR_MASK
+
+        if n0 < 0x8:
+            kind = n0 >> 1
+            reg = ((n0 & 1) << 1) | (n1 >> 3)
+            operand = ((n1 & 0x7) << 8) | (n2 << 4) | n3
+            if kind in (OP_JZ, OP_JNZ):
+                operand = self.jump_target(next_pc, operand)
+            return (kind, reg, 0, operand, next_pc)
+        if n0 == 0x8:
+            if n1 == 0:
+                return (OP_RET, 0, 0, 0, next_pc)
+            if n1 == 1 and n2 < len(REG_NAMES) and n3 < len(REG_NAMES):
+                return (OP_MOV, n2, n3, 0, next_pc)
+            return (OP_ILLEGAL, 0, 0, 0, next_pc)
+        if n0 < 0xE:
+            return (OP_AND + n0 - 0x9, n1 >> 2, n1 & 0x3, 0, next_pc)
+        if n0 == 0xE:
+            return (OP_SETA, 0, 0, n1, next_pc)
+        if n1 < 0x8:
+            target = self.jump_target(next_pc, (n1 << 8) | (n2 << 4) | n3)
+            if target == pc:    # "JMP $" halts the CPU
+                return (OP_HALT, 0, 0, target, next_pc)
+            return (OP_JMP, 0, 0, target, next_pc)
+        kind = OP_IN if n1 < 0xC else OP_OUT
+        return (kind, n1 & 0x3, 0, (n2 << 4) | n3, next_pc)
+
+    @staticmethod
+    def jump_target(next_pc, offset):
+        if offset & 0x400:
+            offset -= 0x800
+        return (next_pc + offset) & ADDR_MASK
 
+    def tick(self):
+        """Execute one instruction, returns 0 if the CPU halted"""
+        pc = self.regs.PC
+        entry = self.decoded[pc]
+        if entry is None:
+            entry = self.decoded[pc] = self.decode(pc)
+        return self.handlers[entry[0]](entry)
 
-def main():
+    def run(self, max_steps, breakpoints=set(), watch=set()):
+        """Execute up to max_steps instructions and return the stop reason.
+
+        Stops before an instruction at one of the breakpoints addresses (except the
+        first one, so a run can be resumed from a breakpoint) and after an instruction
+        wrote to one of the watch RAM addresses. Whole basic blocks are executed
+        whenever they fit in the remaining budget and contain no breakpoint or
+        watched store, the rest is single-stepped.
+        """
+        regs = self.regs
+        blocks = self.blocks
+        block_info = self.block_info
+        decoded = self.decoded
+        ram = self.RAM.data
+        tracing = self.trace_file is not None
+        steps = 0
+        reason = STOP_BUDGET
+        while steps < max_steps:
+            pc = regs.PC
+            if steps and pc in breakpoints:
+                reason = STOP_BREAKPOINT
+                break
+            block = blocks[pc]
+            if block is None:
+                block = self.compile_block(pc)
+            if block is not None and not tracing:
+                _, length, inner_pcs, writes = block_info[pc]
+                if (length <= max_steps - steps
+                        and (not breakpoints or breakpoints.isdisjoint(inner_pcs))
+                        and (not watch or watch.isdisjoint(writes))):
+                    steps += block(self, regs, ram)
+                    continue
+            entry = decoded[pc]
+            if entry is None:
+                entry = decoded[pc] = self.decode(pc)
+            if not self.handlers[entry[0]](entry):
+                reason = STOP_HALT
+                break
+            steps += 1
+            if tracing:
+                self.trace(pc, entry)
+            if watch and entry[0] == OP_STOR and not watch.isdisjoint(self.stor_addresses(entry[1], entry[3])):
+                reason = STOP_WATCHPOINT
+                break
+        self.instret += steps
+        return reason
+
+    def start_trace(self, filename, binary=False):
+        """Log every instruction executed by run() (compiled blocks are bypassed).
+
+        Binary traces use the trace4b format and can be compared with trace4b.py trace-diff.
+        """
+        self.stop_trace()
+        open(filename, 'wb').close()
+        if self.logger is None:
+            self.trace_writer = BufferedWriter(filename)
+        self.trace_file = filename
+        self.trace_binary = binary
+        self.trace_regs = self.trace_state()
+        if binary:
+            self.trace_write(trace4b.trace_header())
+
+    def stop_trace(self):
+        if self.trace_writer is not None:
+            self.trace_writer.close()
+            self.trace_writer = None
+        elif self.trace_file is not None:
+            self.logger.close(self.trace_file)
+        self.trace_file = None
+
+    def trace_write(self, data):
+        if self.trace_writer is not None:
+            self.trace_writer.write(data)
+        else:
+            self.logger.write(self.trace_file, data)
+
+    def trace_state(self):
+        regs = self.regs
+        return (regs.A, regs.B, regs.C, regs.E1, regs.E2, regs.SP)
+
+    def trace(self, pc, entry):
+        opcode = 0
+        for i in range((entry[4] - pc) & ADDR_MASK):
+            opcode = (opcode << 4) | self.ROM[pc + i]
+        if self.trace_binary:
+            state = self.trace_state()
+            if entry[0] == OP_STOR:
+                mem_len = len(self.stor_addresses(entry[1], entry[3]))
+                mem_value = self.get_reg(entry[1])
+                record = trace4b.pack_record(pc, opcode, self.trace_regs, state, mem_len, entry[3], mem_value)
+            else:
+                record = trace4b.pack_record(pc, opcode, self.trace_regs, state)
+            self.trace_regs = state
+        else:
+            regs = self.regs
+            record = (f"{pc:03X}: {opcode:04X} {OP_NAMES[entry[0]]:<4} A={regs.A:X} B={regs.B:X} C={regs.C:X} "
+                      f"E1={regs.E1:03X} E2={regs.E2:03X} SP={regs.SP:03X}\n").encode()
+        self.trace_write(record)
+
+    @staticmethod
+    def stor_addresses(reg, address):
+        return range(address, address + (1 if REG_MASKS[reg] == 0x0F else 3))
+
+    # ------------------------------------------------------------------
+    #  Basic block engine
+    # ------------------------------------------------------------------
+    def step_block(self):
+        """Execute the whole basic block starting at PC.
+
+        Returns the number of executed instructions, 0 if the CPU halted.
+        """
+        pc = self.regs.PC
+        block = self.blocks[pc]
+        if block is None:
+            block = self.compile_block(pc)
+            if block is None:
+                return self.tick()
+        return block(self, self.regs, self.RAM.data)
+
+    def block_entries(self, start):
+        """Decoded instructions of the basic block starting at start"""
+        entries = []
+        pc = start
+        while len(entries) < MAX_BLOCK_LEN:
+            entry = self.decoded[pc]
+            if entry is None:
+                entry = self.decoded[pc] = self.decode(pc)
+            kind, reg_a, _, _, next_pc = entry
+            if kind in (OP_HALT, OP_ILLEGAL):
+                break
+            entries.append(entry)
+            if kind in BLOCK_TERMINATORS or (kind == OP_MOV and REG_NAMES[reg_a] == "PC"):
+                break
+            if next_pc < pc:    # Don't let a block wrap around the address space
+                break
+            pc = next_pc
+        return entries
+
+    def compile_block(self, start):
+        """Translate a basic block into a Python function and cache it.
+
+        The generated function keeps registers in locals, writes back only the
+        registers it modified and leaves PC pointing past the block, so the
+        architectural state after the call is identical to running tick() len(block) times.
+        """
+        entries = self.block_entries(start)
+        if not entries:
+            return None
+        body = []
+        used = set()
+        written = set()
+        pc = str(entries[-1][4])
+        for kind, reg_a, reg_b, operand, next_pc in entries:
+            if kind in (OP_JZ, OP_JNZ):
+                cond = "==" if kind == OP_JZ else "!="
+                used |= reg_deps(reg_a)
+                pc = "pc"
+                body.append(f"pc = {operand} if {reg_read_expr(reg_a, next_pc)} {cond} 0 else {next_pc}")
+            elif kind == OP_JMP:
+                pc = str(operand)
+            elif kind == OP_LD:
+                if REG_MASKS[reg_a] == 0x0F:
+                    value = f"RAM[{operand}]"
+                else:
+                    value = f"(RAM[{operand}] << 8 | RAM[{operand + 1}] << 4 | RAM[{operand + 2}])"
+                used |= reg_deps(reg_a)
+                written |= reg_deps(reg_a)
+                body.extend(reg_write_stmts(reg_a, value))
+            elif kind == OP_STOR:
+                value = reg_read_expr(reg_a, next_pc)
+                used |= reg_deps(reg_a)
+                if REG_MASKS[reg_a] == 0x0F:
+                    body.append(f"RAM[{operand}] = {value}")
+                else:
+                    body.append(f"v = {value}")
+                    body.append(f"RAM[{operand}] = v >> 8 & 15")
+                    body.append(f"RAM[{operand + 1}] = v >> 4 & 15")
+                    body.append(f"RAM[{operand + 2}] = v & 15")
+            elif OP_AND <= kind <= OP_SUB:
+                op = {OP_AND: "&", OP_OR: "|", OP_XOR: "^", OP_ADD: "+", OP_SUB: "-"}[kind]
+                expr = f"{reg_read_expr(reg_a, next_pc)} {op} {reg_read_expr(reg_b, next_pc)}"
+                used |= reg_deps(reg_a) | reg_deps(reg_b)
+                written |= reg_deps(reg_a)
+                body.extend(reg_write_stmts(reg_a, expr))
+            elif kind == OP_SETA:
+                written.add("A")
+                body.append(f"A = {operand}")
+            elif kind == OP_IN:
+                used |= reg_deps(reg_a)
+                written |= reg_deps(reg_a)
+                body.extend(reg_write_stmts(reg_a, f"cpu.in_port({operand})"))
+            elif kind == OP_OUT:
+                used |= reg_deps(reg_a)
+                body.append(f"cpu.out_port({operand}, {reg_read_expr(reg_a, next_pc)})")
+            elif kind == OP_RET:
+                used.add("SP")
+                written.add("SP")
+                pc = "pc"
+                body.append("pc = RAM[SP] << 8 | RAM[(SP + 1) & 4095] << 4 | RAM[(SP + 2) & 4095]")
+                body.append("SP = (SP + 3) & 4095")
+            elif kind == OP_MOV:
+                used |= reg_deps(reg_a) | reg_deps(reg_b)
+                written |= reg_deps(reg_a)
+                body.extend(reg_write_stmts(reg_a, reg_read_expr(reg_b, next_pc)))
+                if REG_NAMES[reg_a] == "PC":
+                    pc = "pc"
+
+        names = sorted(used | written)
+        lines = ["def block(cpu, regs, RAM):"]
+        lines += [f"    {name} = regs.{name}" for name in names]
+        lines += [f"    {stmt}" for stmt in body]
+        lines += [f"    regs.{name} = {name}" for name in sorted(written)]
+        lines += [f"    regs.PC = {pc}", f"    return {len(entries)}"]
+        namespace = {}
+        exec(compile("\n".join(lines), f"<block 0x{start:03X}>", "exec"), namespace)
+        block = namespace["block"]
+        self.blocks[start] = block
+        writes = set()
+        for kind, reg_a, _, operand, _ in entries:
+            if kind == OP_STOR:
+                writes.update(self.stor_addresses(reg_a, operand))
+        self.block_info[start] = (
+            entries[-1][4] if entries[-1][4] > start else MEM_SIZE,
+            len(entries),
+            frozenset(entry[4] for entry in entries[:-1]),
+            frozenset(writes),
+        )
+        return block
+
+    # ------------------------------------------------------------------
+    #  Registers and IO
+    # ------------------------------------------------------------------
+    def get_reg(self, idx):
+        return getattr(self.regs, REG_NAMES[idx])
+
+    def set_reg(self, idx, value):
+        setattr(self.regs, REG_NAMES[idx], value & REG_MASKS[idx])
+
+    def in_port(self, port):
+        return self.ports[port]
+
+    def out_port(self, port, value):
+        self.ports[port] = value
+        if port == UART_LSB_PORT:
+            self.uart.append(((self.ports[UART_MSB_PORT] & 0x0F) << 4) | (value & 0x0F))
+
+    # ------------------------------------------------------------------
+    #  Instruction handlers, each one receives a decoded cache entry
+    # ------------------------------------------------------------------
+    def op_jz(self, entry):
+        self.regs.PC = entry[3] if self.get_reg(entry[1]) == 0 else entry[4]
+        return 1
+
+    def op_jnz(self, entry):
+        self.regs.PC = entry[3] if self.get_reg(entry[1]) != 0 else entry[4]
+        return 1
+
+    def op_ld(self, entry):
+        reg, addr = entry[1], entry[3]
+        if REG_MASKS[reg] == 0x0F:
+            self.set_reg(reg, self.RAM[addr])
+        else:
+            self.set_reg(reg, self.get_12b_value(self.RAM, addr))
+        self.regs.PC = entry[4]
+        return 1
+
+    def op_stor(self, entry):
+        reg, addr = entry[1], entry[3]
+        if REG_MASKS[reg] == 0x0F:
+            self.RAM[addr] = self.get_reg(reg)
+        else:
+            self.set_12b_value(self.RAM, addr, self.get_reg(reg))
+        self.regs.PC = entry[4]
+        return 1
+
+    def op_alu(self, entry):
+        kind, rd, rs = entry[0], entry[1], entry[2]
+        a = self.get_reg(rd)
+        b = self.get_reg(rs)
+        if kind == OP_AND:
+            self.set_reg(rd, a & b)
+        elif kind == OP_OR:
+            self.set_reg(rd, a | b)
+        elif kind == OP_XOR:
+            self.set_reg(rd, a ^ b)
+        elif kind == OP_ADD:
+            self.set_reg(rd, a + b)
+        else:
+            self.set_reg(rd, a - b)
+        self.regs.PC = entry[4]
+        return 1
+
+    def op_seta(self, entry):
+        self.regs.A = entry[3]
+        self.regs.PC = entry[4]
+        return 1
+
+    def op_jmp(self, entry):
+        self.regs.PC = entry[3]
+        return 1
+
+    def op_in(self, entry):
+        self.set_reg(entry[1], self.in_port(entry[3]))
+        self.regs.PC = entry[4]
+        return 1
+
+    def op_out(self, entry):
+        self.out_port(entry[3], self.get_reg(entry[1]))
+        self.regs.PC = entry[4]
+        return 1
+
+    def op_ret(self, entry):
+        self.regs.PC = self.get_12b_value(self.RAM, self.regs.SP)
+        self.regs.SP = (self.regs.SP + 3) & ADDR_MASK
+        return 1
+
+    def op_mov(self, entry):
+        self.regs.PC = entry[4]     # MOV PC, x overrides this
+        self.set_reg(entry[1], self.get_reg(entry[2]))
+        return 1
+
+    def op_halt(self, entry):
+        return 0
+
+    def op_illegal(self, entry):
+        if self.logger is not None:
+            self.logger.print_line(f"Illegal instruction at 0x{self.regs.PC:03X}")
+        return 0
+
+
+class CPUWorker:
+    """Runs the CPU in its own thread, in chunks of at most RUN_CHUNK instructions.
+
+    The worker blocks while the CPU is stopped. stop() takes effect between two
+    chunks and also interrupts real-time mode sleeps. Other threads must hold
+    self.lock while they touch the CPU, breakpoints or watchpoints. An exception
+    raised while running stops the CPU and is reported instead of killing the thread.
+    """
+    def __init__(self, cpu, logger, run_mode=MODE_REFRESH, frequency=1000):
+        self.cpu = cpu
+        self.logger = logger
+        self.run_mode = run_mode
+        self.frequency = frequency
+        self.breakpoints = set()
+        self.watch = set()
+        self.run_meter = RateMeter()    # Whole run, reported when the CPU stops
+        self.lock = threading.Lock()
+        self.run_request = threading.Event()    # Set while the CPU should run
+        self.interrupt = threading.Event()      # Wakes the worker up from real-time sleeps
+        self.idle = threading.Event()           # Set while the worker waits for a run request
+        self.idle.set()
+        self.quit = False
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @frequency.setter
+    def frequency(self, value):
+        if value <= 0:
+            raise ValueError(f"Frequency must be positive, got {value}")
+        self._frequency = value
+
+    def is_running(self):
+        return self.run_request.is_set()
+
+    def start(self):
+        self.interrupt.clear()
+        self.run_request.set()
+
+    def stop(self):
+        self.run_request.clear()
+        self.interrupt.set()
+        # Wait until the current chunk finished and the run was reported
+        while not self.idle.wait(0.1):
+            if not self.thread.is_alive():
+                break
+
+    def shutdown(self):
+        self.quit = True
+        self.stop()
+        self.run_request.set()
+        self.thread.join()
+
+    def worker(self):
+        cpu = self.cpu
+        refresh_meter = RateMeter()     # Since the last status line
+        while True:
+            self.run_request.wait()
+            if self.quit:
+                return
+            self.idle.clear()
+            self.run_meter.reset(cpu.instret)
+            refresh_meter.reset(cpu.instret)
+            try:
+                reason = self.run(refresh_meter)
+            except Exception as e:
+                self.run_request.clear()
+                reason = f"error: {type(e).__name__}: {e}"
+            if not self.quit:
+                self.logger.print_line(f"CPU stopped: {reason} at PC 0x{cpu.regs.PC:03X}, {self.run_meter.report(cpu.instret)}")
+            self.idle.set()
+
+    def run(self, refresh_meter):
+        """Run chunks until a stop request or a stop condition, returns the stop reason"""
+        cpu = self.cpu
+        last_refresh = deadline = time.perf_counter()
+        reason = "stopped by user"
+        while self.run_request.is_set() and not self.quit:
+            with self.lock:
+                # The mode and frequency may change between chunks, read them once per chunk
+                run_mode = self.run_mode
+                frequency = self.frequency
+                if run_mode == MODE_REALTIME:
+                    period = max(REALTIME_SLICE, 1 / frequency)
+                    chunk_reason = cpu.run(max(1, round(frequency * period)), self.breakpoints, self.watch)
+                else:
+                    chunk_reason = cpu.run(RUN_CHUNK, self.breakpoints, self.watch)
+            if chunk_reason != STOP_BUDGET:
+                self.run_request.clear()
+                return chunk_reason
+            if run_mode == MODE_REALTIME:
+                deadline += period
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    self.interrupt.wait(delay)
+                elif delay < -1:
+                    deadline = time.perf_counter()  # Too far behind, don't try to catch up
+            if run_mode != MODE_UNTHROTTLED and time.perf_counter() - last_refresh > UI_REFRESH_PERIOD:
+                last_refresh = time.perf_counter()
+                self.logger.print_line(f"PC 0x{cpu.regs.PC:03X}: {refresh_meter.report(cpu.instret)}")
+                refresh_meter.reset(cpu.instret)
+        return reason
+
+
+def main(binary=[], run_mode=MODE_REFRESH, frequency=1000):
     ui_getter = UserInputGetter()
     logger = Logger(ui_getter)
-    cpu = CPU(binary=[], logger=logger)
-    last_update = time.time()
-    inner_state = 'stopped'
+    cpu = CPU(binary=binary, logger=logger)
+    worker = CPUWorker(cpu, logger, run_mode, frequency)
+    logger.print_line("The CPU is stopped")
     while True:
         command = ui_getter.get_command()
-
-        if command is not None:
-            logger.print_line(f"User command from thread: {command}")
+        logger.print_line(f"User command from thread: {command}")
+        if command == 'quit':
+            worker.shutdown()
+            logger.close()
+            return
+        try:
             if command == 'run':
-                inner_state = 'running'
+                worker.start()
             elif command == 'print value':
                 logger.print_line("Here is the value!")
             elif command == 'stop':
-                inner_state = 'stopped'
+                worker.stop()
             elif command == 'step':
-                cpu.tick()
-                inner_state = 'stopped'
-            elif command == 'quit':
-                return
-
-        if inner_state == 'running':
-            if time.time()-last_update > 0.1:
-                if 0 == cpu.tick():
-                    inner_state = 'stopped'
-                last_update = time.time()
-        elif inner_state == 'stopped':
-            logger.print_line("The thread is stopped")
-            ui_getter.event.wait()
+                worker.stop()
+                with worker.lock:
+                    cpu.run(1)
+                logger.print_line(f"PC 0x{cpu.regs.PC:03X}")
+            elif command.startswith('break '):
+                with worker.lock:
+                    worker.breakpoints.add(int(command.split()[1], 16))
+            elif command.startswith('watch '):
+                with worker.lock:
+                    worker.watch.add(int(command.split()[1], 16))
+            elif command.startswith('mode '):
+                args = command.split()
+                if args[1] in RUN_MODES:
+                    frequency = int(args[2]) if len(args) > 2 else worker.frequency
+                    with worker.lock:
+                        worker.frequency = frequency    # Validated before the mode changes
+                        worker.run_mode = args[1]
+                    logger.print_line(f"Run mode: {worker.run_mode}" + (f" at {worker.frequency} Hz" if worker.run_mode == MODE_REALTIME else ""))
+                else:
+                    logger.print_line(f"Unknown run mode, expected one of: {', '.join(RUN_MODES)}")
+            elif command == 'rate':
+                logger.print_line(worker.run_meter.report(cpu.instret))
+            elif command.startswith('trace '):
+                args = command.split()
+                with worker.lock:
+                    if args[1] == 'off':
+                        cpu.stop_trace()
+                    else:
+                        cpu.start_trace(args[1], binary=len(args) > 2 and args[2] == 'binary')
+            else:
+                logger.print_line(f"Unknown command, {USAGE}")
+        except (IndexError, ValueError, OSError) as e:
+            logger.print_line(f"Invalid command '{command}' ({e}), {USAGE}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="The 4-bit CPU emulator")
+    parser.add_argument("--rom", type=str, help="ROM image, one nibble per byte")
+    parser.add_argument("--mode", choices=RUN_MODES, default=MODE_REFRESH, help="Run mode")
+    parser.add_argument("--freq", type=int, default=1000, help="Instructions per second in realtime mode")
+    args = parser.parse_args()
+    binary = []
+    if args.rom:
+        with open(args.rom, 'rb') as f:
+            binary = f.read()
+    main(binary, args.mode, args.freq)
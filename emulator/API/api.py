@@ -1,5 +1,25 @@
 import ctypes
-from ctypes import POINTER, c_uint32, c_char_p, c_void_p
+from ctypes import POINTER, c_uint32, c_uint64, c_char_p, c_void_p
+
+DONE_CALLBACK = ctypes.CFUNCTYPE(None, c_void_p, c_uint32)    # emu, reason: XTAL_STOP_* in devices/clock/clock.h
+
+
+def c_buffer(data):
+    """Returns (pointer, size) passing a bytes-like object to C without copying it.
+
+    Same as c_buffer() in dll_wrapper.py, this module is used on its own.
+    """
+    if isinstance(data, bytes):
+        return data, len(data)
+    if not isinstance(data, bytearray):
+        data = memoryview(data).cast('B')
+        if data.readonly:
+            data = bytes(data)
+            return data, len(data)
+    if not data:
+        return None, 0
+    return ctypes.byref(ctypes.c_char.from_buffer(data)), len(data)
+
 
 class CPUEmulatorAPI:
     def __init__(self, lib_path="./emulator.dll"):
@@ -11,69 +31,144 @@ class CPUEmulatorAPI:
             raise e
 
         self._setup_prototypes()
-        # Initialize the emulator core
-        self.lib.init()
+        # Initialize the emulator core, every CPUEmulatorAPI gets its own context
+        self.emu = self.lib.init()
 
     def _setup_prototypes(self):
         """Define argument and return types for the DLL functions."""
-        
+
+        # Context, init() returns the emulator_t* handle passed to everything else
+        self.lib.init.argtypes = []
+        self.lib.init.restype = c_void_p
+        self.lib.destroy.argtypes = [c_void_p]
+
         # State Management
-        self.lib.save_state.argtypes = [c_char_p]
-        self.lib.restore_state.argtypes = [c_char_p]
+        self.lib.save_state.argtypes = [c_void_p, c_char_p]
+        self.lib.restore_state.argtypes = [c_void_p, c_char_p]
 
         # Execution Control
-        self.lib.run.argtypes = []
-        self.lib.stop.argtypes = []
-        self.lib.step.argtypes = [c_uint32]
-        self.lib.reset.argtypes = []
+        self.lib.run.argtypes = [c_void_p]
+        self.lib.stop.argtypes = [c_void_p]
+        self.lib.step.argtypes = [c_void_p, c_uint32]
+        self.lib.reset.argtypes = [c_void_p]
+
+        # Run limits
+        self.lib.set_tick_limit.argtypes = [c_void_p, c_uint64]
+        self.lib.set_deadline.argtypes = [c_void_p, c_uint32]
+        self.lib.set_done_callback.argtypes = [c_void_p, DONE_CALLBACK]
+        self.lib.wait_done.argtypes = [c_void_p, c_uint32]
+        self.lib.wait_done.restype = c_uint32
+        self.lib.irq_sleep.argtypes = [c_void_p]
+        self.lib.irq_sleep.restype = c_uint64
 
         # Memory Access
-        # void mem_write(uint32_t memspace, uint32_t offset, uint32_t len, void *data)
-        self.lib.mem_write.argtypes = [c_uint32, c_uint32, c_uint32, c_void_p]
-        self.lib.mem_read.argtypes = [c_uint32, c_uint32, c_uint32, c_void_p]
+        # void mem_write(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, void *data)
+        self.lib.mem_write.argtypes = [c_void_p, c_uint32, c_uint32, c_uint32, c_void_p]
+        self.lib.mem_read.argtypes = [c_void_p, c_uint32, c_uint32, c_uint32, c_void_p]
+        self.lib.mem_fill.argtypes = [c_void_p, c_uint32, c_uint32, c_uint32, ctypes.c_uint8]
+        self.lib.mem_compare.argtypes = [c_void_p, c_uint32, c_uint32, c_uint32, c_void_p]
+        self.lib.mem_compare.restype = ctypes.c_int64
+        self.lib.mem_map.argtypes = [c_void_p, c_uint32, POINTER(POINTER(ctypes.c_ubyte)), POINTER(c_uint32)]
+        self.lib.mem_map.restype = ctypes.c_int
 
         # Register Access
-        self.lib.set_register.argtypes = [c_uint32, c_uint32, c_uint32]
+        self.lib.set_register.argtypes = [c_void_p, c_uint32, c_uint32, c_uint32]
         # Note: Your C signature for get_register likely needs a pointer to return a value
-        self.lib.get_register.argtypes = [c_uint32, c_uint32, POINTER(c_uint32)]
+        self.lib.get_register.argtypes = [c_void_p, c_uint32, c_uint32, POINTER(c_uint32)]
+
+        # Logging
+        self.lib.set_log_level.argtypes = [c_uint32]
 
     # --- Wrapper Methods ---
 
+    def destroy(self):
+        """Stops the clock thread and frees the emulator context"""
+        self.lib.destroy(self.emu)
+        self.emu = None
+
     def save(self, filename: str):
-        self.lib.save_state(filename.encode('utf-8'))
+        self.lib.save_state(self.emu, filename.encode('utf-8'))
 
     def load(self, filename: str):
-        self.lib.restore_state(filename.encode('utf-8'))
+        self.lib.restore_state(self.emu, filename.encode('utf-8'))
 
     def run(self):
-        self.lib.run()
+        self.lib.run(self.emu)
 
     def stop(self):
-        self.lib.stop()
+        self.lib.stop(self.emu)
 
     def step(self, count=1):
-        self.lib.step(c_uint32(count))
+        self.lib.step(self.emu, c_uint32(count))
 
     def reset(self):
-        self.lib.reset()
+        self.lib.reset(self.emu)
+
+    def set_tick_limit(self, ticks):
+        """Pause after ticks more ticks, 0: no limit"""
+        self.lib.set_tick_limit(self.emu, ticks)
+
+    def set_deadline(self, seconds):
+        """Pause once the wall clock time has passed, 0: no deadline"""
+        self.lib.set_deadline(self.emu, int(seconds * 1000))
+
+    def set_done_callback(self, callback):
+        """callback(reason) is called from the clock thread when a limit pauses the clock"""
+        self._done_callback = DONE_CALLBACK(lambda emu, reason: callback(reason)) if callback else DONE_CALLBACK()
+        self.lib.set_done_callback(self.emu, self._done_callback)
+
+    def wait_done(self, timeout=0):
+        """Wait until the clock is paused, returns the XTAL_STOP_* reason (0 on timeout)"""
+        return self.lib.wait_done(self.emu, int(timeout * 1000))
+
+    def irq_sleep(self):
+        """SLEEP: skips the paused clock to the next scheduled interrupt, returns the skipped ticks (2**64-1: no wakeup)"""
+        return self.lib.irq_sleep(self.emu)
 
     def write_memory(self, memspace, offset, data_bytes):
-        """Writes a bytes object or bytearray to the emulator memory."""
-        length = len(data_bytes)
-        # Create a temporary buffer ctypes can understand
-        buffer = (ctypes.c_ubyte * length).from_buffer_copy(data_bytes)
-        self.lib.mem_write(memspace, offset, length, buffer)
+        """Writes any bytes-like object to the emulator memory without copying it."""
+        buffer, length = c_buffer(data_bytes)
+        self.lib.mem_write(self.emu, memspace, offset, length, buffer)
 
     def read_memory(self, memspace, offset, length):
         """Reads 'length' bytes from the emulator and returns a python bytes object."""
-        buffer = (ctypes.c_ubyte * length)()
-        self.lib.mem_read(memspace, offset, length, buffer)
-        return bytes(buffer)
+        buffer = ctypes.create_string_buffer(length)
+        self.lib.mem_read(self.emu, memspace, offset, length, buffer)
+        return buffer.raw
+
+    def read_memory_into(self, memspace, offset, buffer):
+        """Fills a preallocated writable buffer (bytearray, memoryview...) from the emulator memory."""
+        c_buf, length = c_buffer(buffer)
+        if isinstance(c_buf, bytes):
+            raise TypeError("read_memory_into() needs a writable buffer")
+        self.lib.mem_read(self.emu, memspace, offset, length, c_buf)
+        return buffer
+
+    def fill_memory(self, memspace, offset, length, value=0):
+        self.lib.mem_fill(self.emu, memspace, offset, length, value)
+
+    def compare_memory(self, memspace, offset, data_bytes):
+        """Index of the first byte differing from data_bytes, -1 if equal, -2 if out of bounds"""
+        buffer, length = c_buffer(data_bytes)
+        return self.lib.mem_compare(self.emu, memspace, offset, length, buffer)
+
+    def memory_view(self, memspace):
+        """Writable memoryview aliasing the emulator memory (no copy), valid until destroy()"""
+        ptr = POINTER(ctypes.c_ubyte)()
+        length = c_uint32()
+        if self.lib.mem_map(self.emu, memspace, ctypes.byref(ptr), ctypes.byref(length)):
+            raise ValueError(f"Unknown memspace {memspace}")
+        buffer = (ctypes.c_ubyte * length.value).from_address(ctypes.addressof(ptr.contents))
+        return memoryview(buffer).cast('B')
 
     def set_reg(self, dev_id, reg_id, value):
-        self.lib.set_register(dev_id, reg_id, value)
+        self.lib.set_register(self.emu, dev_id, reg_id, value)
 
     def get_reg(self, dev_id, reg_id):
         val = c_uint32()
-        self.lib.get_register(dev_id, reg_id, ctypes.byref(val))
-        return val.value
\ No newline at end of file
+        self.lib.get_register(self.emu, dev_id, reg_id, ctypes.byref(val))
+        return val.value
+
+    def set_log_level(self, level):
+        """level: LOG_LEVEL_* from lib/log.h, 0 (trace) ... 5 (none)"""
+        self.lib.set_log_level(level)
@@ -2,24 +2,27 @@
 
 #include <stdint.h>
 
-/* Each device should inplement the following functions:
-    void init(void);
-    void tick(void);
-    uint8_t *save_state(uint32_t *buf_size);   // Buf size: siz in bytes
-    int restore_state(uint8_t *buf);
-    void set_register(uint32_t reg_id, uint32_t value);
-    void get_register(uint32_t reg_id, uint32_t *value);
+/* Each device should inplement the following functions, ctx is the device instance
+   created by its <device>_get_device_iface() function, so an emulator process can
+   host any number of independent machines:
+    void init(void *ctx);
+    void tick(void *ctx);
+    uint8_t *save_state(void *ctx, uint32_t *buf_size);   // Buf size: siz in bytes
+    int restore_state(void *ctx, uint8_t *buf);
+    void set_register(void *ctx, uint32_t reg_id, uint32_t value);
+    void get_register(void *ctx, uint32_t reg_id, uint32_t *value);
+    void destroy(void *ctx);    // Frees the instance
 */
 
 typedef struct {
-    void (*init)(void);
-    void (*tick)(void);
-    uint32_t (*get_buf_size)(void);
-    void (*save_state)(uint8_t*);
-    void (*restore_state)(uint8_t*);
-    void (*set_register)(uint32_t, uint32_t);
-    void (*get_register)(uint32_t, uint32_t*);
-    void (*reset)(void);
+    void *ctx;  // Device instance, passed to all the functions below
+    void (*init)(void*);
+    void (*tick)(void*);
+    uint32_t (*get_buf_size)(void*);
+    void (*save_state)(void*, uint8_t*);
+    void (*restore_state)(void*, uint8_t*);
+    void (*set_register)(void*, uint32_t, uint32_t);
+    void (*get_register)(void*, uint32_t, uint32_t*);
+    void (*reset)(void*);
+    void (*destroy)(void*);
 } device_iface_t;
-
-device_iface_t get_device_iface(void);
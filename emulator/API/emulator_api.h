@@ -8,17 +8,53 @@
     #define DLL_PREFIX __declspec(dllexport)
 #endif
 
-DLL_PREFIX void init(void);
-DLL_PREFIX void save_state(char *filename);
-DLL_PREFIX void restore_state(char *filename);
+// Emulator context: each one is an independent machine with its own clock thread,
+// any number of them can be used from any number of threads
+typedef struct emulator emulator_t;
 
-DLL_PREFIX void run(void);
-DLL_PREFIX void stop(void);
-DLL_PREFIX void step(uint32_t num_steps);
-DLL_PREFIX void reset(void);
+DLL_PREFIX emulator_t *init(void);
+// Same with another clock than the default one, see init_clock() in devices/clock/clock.h
+DLL_PREFIX emulator_t *init_with_clock(int freq, int real_time_mode);
+DLL_PREFIX void destroy(emulator_t *emu);
+DLL_PREFIX void save_state(emulator_t *emu, char *filename);
+DLL_PREFIX void restore_state(emulator_t *emu, char *filename);
 
-DLL_PREFIX void mem_write(uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data);
-DLL_PREFIX void mem_read(uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data);
+DLL_PREFIX void run(emulator_t *emu);
+DLL_PREFIX void stop(emulator_t *emu);
+DLL_PREFIX void step(emulator_t *emu, uint32_t num_steps);
+DLL_PREFIX void reset(emulator_t *emu);
 
-DLL_PREFIX void set_register(uint32_t dev_id, uint32_t reg_id, uint32_t value);
-DLL_PREFIX void get_register(uint32_t dev_id, uint32_t reg_id, uint32_t *value);
+// Run limits, the clock pauses when one is reached (see XTAL_STOP_* in devices/clock/clock.h)
+DLL_PREFIX void set_tick_limit(emulator_t *emu, uint64_t ticks);            // 0: no limit
+DLL_PREFIX void set_deadline(emulator_t *emu, uint32_t ms);                 // Wall clock time from now, 0: no deadline
+DLL_PREFIX void set_done_callback(emulator_t *emu, void (*callback)(emulator_t *emu, uint32_t reason));
+DLL_PREFIX uint32_t wait_done(emulator_t *emu, uint32_t timeout_ms);        // 0: no timeout, returns the stop reason
+
+// What the CPU does on SLEEP: skips the clock to the next scheduled unmasked interrupt.
+// Returns the skipped ticks or UINT64_MAX if nothing can wake the CPU up, call it while the clock is paused.
+DLL_PREFIX uint64_t irq_sleep(emulator_t *emu);
+
+DLL_PREFIX void mem_write(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data);
+DLL_PREFIX void mem_read(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data);
+DLL_PREFIX void mem_fill(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t value);
+// Index of the first byte that differs from data, -1: equal, -2: out of bounds or unknown memspace
+DLL_PREFIX int64_t mem_compare(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data);
+// Backing store of a memspace for zero-copy access, valid until destroy(), returns 0 or -1: unknown memspace.
+// Accesses through it are not synchronised with a running clock.
+DLL_PREFIX int mem_map(emulator_t *emu, uint32_t memspace, uint8_t **ptr, uint32_t *len);
+
+// CPU side memory accesses, decoded by the address decoder (the memspaces are also mapped on the bus).
+// Return 0 or an ADDRESS_DECODER_* error, see devices/address_decoder/address_decoder.h
+DLL_PREFIX int bus_read(emulator_t *emu, uint32_t address, uint8_t *val);
+DLL_PREFIX int bus_write(emulator_t *emu, uint32_t address, uint8_t val);
+// Maps [addr_start, addr_end] of the bus to a memspace from its offset 0, accessed through the memory
+// device callbacks. Returns the map entry index or an ADDRESS_DECODER_* error.
+DLL_PREFIX int bus_map_device(emulator_t *emu, uint32_t memspace, uint32_t addr_start, uint32_t addr_end);
+// Same, accessing the memspace backing store directly, access: MEM_ACCESS_* rights of the CPU.
+// The ROM is mapped read-only and the RAM read/write this way.
+DLL_PREFIX int bus_map_direct(emulator_t *emu, uint32_t memspace, uint32_t addr_start, uint32_t addr_end, uint32_t access);
+
+DLL_PREFIX void set_register(emulator_t *emu, uint32_t dev_id, uint32_t reg_id, uint32_t value);
+DLL_PREFIX void get_register(emulator_t *emu, uint32_t dev_id, uint32_t reg_id, uint32_t *value);
+
+DLL_PREFIX void set_log_level(uint32_t level);  // LOG_LEVEL_* from lib/log.h, shared by all the contexts
@@ -0,0 +1,39 @@
+#pragma once
+
+#include <stdint.h>
+
+/* Binary execution trace, the same format is written and read by trace4b.py.
+   A trace file is a trace_header_t followed by one trace_record_t per executed
+   instruction. All fields are little-endian. Register fields only hold the new
+   values of the registers flagged in `changed` and are 0 otherwise. */
+
+#define TRACE_MAGIC     "T4BT"
+#define TRACE_VERSION   1
+
+#define TRACE_CHANGED_A     0x01
+#define TRACE_CHANGED_B     0x02
+#define TRACE_CHANGED_C     0x04
+#define TRACE_CHANGED_E1    0x08
+#define TRACE_CHANGED_E2    0x10
+#define TRACE_CHANGED_SP    0x20
+
+#pragma pack(push, 1)
+typedef struct {
+    char magic[4];
+    uint16_t version;
+    uint16_t record_size;   // sizeof(trace_record_t)
+} trace_header_t;
+
+typedef struct {
+    uint16_t pc;
+    uint16_t opcode;        // Raw instruction nibbles
+    uint8_t changed;        // TRACE_CHANGED_* bits
+    uint8_t mem_len;        // Nibbles written to RAM, 0 if none
+    uint16_t abc;           // A << 8 | B << 4 | C
+    uint16_t e1;
+    uint16_t e2;
+    uint16_t sp;
+    uint16_t mem_addr;
+    uint16_t mem_value;
+} trace_record_t;
+#pragma pack(pop)
@@ -6,64 +6,187 @@
 #include <stdarg.h>
 #include <string.h>
 
-#include "devices/memory/memory.h"
+#include "address_decoder.h"
 #include "lib/utils.h"
 
 #define LOG_FILE            "address_decoder.log"
 #define DEVICE_DATA_FILE    "data/address_decoder.bin"
 #define DEVICE_MAP_SIZE 128
 
+#define ADDR_SPACE_SIZE (1 << (8 * sizeof(ADDR_BUS_WIDTH)))
+#define PAGE_BITS       8
+#define PAGE_SIZE       (1 << PAGE_BITS)
+#define PAGE_MASK       (PAGE_SIZE - 1)
+#define NUM_PAGES       (ADDR_SPACE_SIZE / PAGE_SIZE)
+
 typedef struct {
     mem_read_func_t *read;
     mem_write_func_t *write;
+    void *ctx;
+    DATA_BUS_WIDTH *mem;    // Backing store of a direct region, NULL for MMIO devices
+    uint32_t access;        // MEM_ACCESS_* of a direct region
     uint32_t range[2];
 } device_map_t;
 
-device_map_t device_map[DEVICE_MAP_SIZE];
+// Map entries are stored as index + 1, 0 means unmapped
+typedef struct {
+    uint8_t owner;      // Entry of a page covered by a single device (or unmapped)
+    uint8_t *split;     // Per address entries of a page shared by several devices, NULL otherwise
+    DATA_BUS_WIDTH *read;   // Backing store of the page if a direct region with read access covers it
+    DATA_BUS_WIDTH *write;  // Same for write access
+} page_t;
+
+struct address_decoder {
+    device_map_t device_map[DEVICE_MAP_SIZE];
+    uint32_t num_entries;
+    page_t pages[NUM_PAGES];
+};
+
+// Returns NULL if nothing is mapped at addr
+static device_map_t *find_device(address_decoder_t *decoder, uint32_t addr) {
+    if(addr >= ADDR_SPACE_SIZE) {
+        return NULL;
+    }
+    page_t *page = &decoder->pages[addr >> PAGE_BITS];
+    uint8_t owner = page->split? page->split[addr & PAGE_MASK]: page->owner;
+    if(!owner) {
+        return NULL;
+    }
+    return &decoder->device_map[owner - 1];
+}
 
-uint32_t find_device_idx(uint32_t addr) {
-    for(uint32_t i=0; i<DEVICE_MAP_SIZE; i++) {
-        if(device_map[i].range[0] <= addr && device_map[i].range[1] >= addr) {
-            return i;
+int address_decoder_read(address_decoder_t *decoder, uint32_t address, uint8_t *val) {
+    if(address < ADDR_SPACE_SIZE) {
+        DATA_BUS_WIDTH *page = decoder->pages[address >> PAGE_BITS].read;
+        if(page) {
+            *val = page[address & PAGE_MASK];
+            return 0;
         }
     }
-    RAISE("Error: Couldn't find device for a given address (0x%X)!\n", addr);
+    device_map_t *entry = find_device(decoder, address);
+    if(!entry) {
+        return ADDRESS_DECODER_UNMAPPED;
+    }
+    uint32_t offset = address - entry->range[0];
+    if(!entry->mem) {
+        *val = entry->read(entry->ctx, offset);
+        return 0;
+    }
+    if(!(entry->access & MEM_ACCESS_READ)) {
+        return ADDRESS_DECODER_ACCESS_DENIED;
+    }
+    *val = entry->mem[offset];
+    return 0;
 }
 
-uint8_t memory_read(uint32_t address) {
-    uint32_t idx = find_device_idx(address);
-    uint32_t offset = device_map[idx].range[0];
-    return device_map[idx].read(address-offset);
+int address_decoder_write(address_decoder_t *decoder, uint32_t address, uint8_t val) {
+    if(address < ADDR_SPACE_SIZE) {
+        DATA_BUS_WIDTH *page = decoder->pages[address >> PAGE_BITS].write;
+        if(page) {
+            page[address & PAGE_MASK] = val;
+            return 0;
+        }
+    }
+    device_map_t *entry = find_device(decoder, address);
+    if(!entry) {
+        return ADDRESS_DECODER_UNMAPPED;
+    }
+    uint32_t offset = address - entry->range[0];
+    if(!entry->mem) {
+        entry->write(entry->ctx, offset, val);
+        return 0;
+    }
+    if(!(entry->access & MEM_ACCESS_WRITE)) {
+        return ADDRESS_DECODER_ACCESS_DENIED;
+    }
+    entry->mem[offset] = val;
+    return 0;
 }
 
-void memory_write(uint32_t address, uint8_t val) {
-    uint32_t idx = find_device_idx(address);
-    uint32_t offset = device_map[idx].range[0];
-    device_map[idx].write(address-offset, val);
+static void map_page(page_t *page, uint32_t start, uint32_t end, uint8_t owner, device_map_t *entry) {
+    if((start & PAGE_MASK) == 0 && (end & PAGE_MASK) == PAGE_MASK && !page->split && !page->owner) {
+        page->owner = owner;    // The whole page belongs to one device
+        if(entry->mem) {
+            DATA_BUS_WIDTH *base = &entry->mem[start - entry->range[0]];
+            page->read = (entry->access & MEM_ACCESS_READ)? base: NULL;
+            page->write = (entry->access & MEM_ACCESS_WRITE)? base: NULL;
+        }
+        return;
+    }
+    if(!page->split) {
+        page->split = malloc(PAGE_SIZE);
+        memset(page->split, page->owner, PAGE_SIZE);
+        page->owner = 0;
+    }
+    memset(&page->split[start & PAGE_MASK], owner, end - start + 1);
 }
 
-uint32_t memory_map_device(uint32_t addr_start, uint32_t addr_end, mem_read_func_t *read_func, mem_write_func_t *write_func) {
-    for(uint32_t i=0; i<DEVICE_MAP_SIZE; i++) {
-        if(device_map[i].range[0] == 0 && device_map[i].range[1] == 0) {
-            device_map[i].read = read_func;
-            device_map[i].write = write_func;
-            device_map[i].range[0] = addr_start;
-            device_map[i].range[1] = addr_end;
-            return i;
+// Returns the new entry index or an ADDRESS_DECODER_* error
+static int add_entry(address_decoder_t *decoder, uint32_t addr_start, uint32_t addr_end) {
+    if(addr_start > addr_end || addr_end >= ADDR_SPACE_SIZE) {
+        return ADDRESS_DECODER_INVALID_RANGE;
+    }
+    if(decoder->num_entries == DEVICE_MAP_SIZE) {
+        return ADDRESS_DECODER_TABLE_FULL;
+    }
+    for(uint32_t i=0; i<decoder->num_entries; i++) {
+        device_map_t *entry = &decoder->device_map[i];
+        if(addr_start <= entry->range[1] && entry->range[0] <= addr_end) {
+            return ADDRESS_DECODER_OVERLAP;
         }
     }
-    RAISE("Error: Couldn't map device: table is full\n");
+    device_map_t *entry = &decoder->device_map[decoder->num_entries];
+    entry->range[0] = addr_start;
+    entry->range[1] = addr_end;
+    return decoder->num_entries++;
+}
+
+static void map_entry(address_decoder_t *decoder, device_map_t *entry) {
+    uint8_t owner = entry - decoder->device_map + 1;
+    for(uint32_t start=entry->range[0]; start<=entry->range[1]; start=(start | PAGE_MASK) + 1) {
+        uint32_t end = start | PAGE_MASK;
+        map_page(&decoder->pages[start >> PAGE_BITS], start, end < entry->range[1]? end: entry->range[1], owner, entry);
+    }
+}
+
+int memory_map_device(address_decoder_t *decoder, uint32_t addr_start, uint32_t addr_end,
+                      mem_read_func_t *read_func, mem_write_func_t *write_func, void *ctx) {
+    int idx = add_entry(decoder, addr_start, addr_end);
+    if(idx < 0) {
+        return idx;
+    }
+    device_map_t *entry = &decoder->device_map[idx];
+    entry->read = read_func;
+    entry->write = write_func;
+    entry->ctx = ctx;
+    map_entry(decoder, entry);
+    return idx;
+}
+
+int memory_map_direct(address_decoder_t *decoder, uint32_t addr_start, uint32_t addr_end,
+                      DATA_BUS_WIDTH *mem, uint32_t access) {
+    int idx = add_entry(decoder, addr_start, addr_end);
+    if(idx < 0) {
+        return idx;
+    }
+    device_map_t *entry = &decoder->device_map[idx];
+    entry->mem = mem;
+    entry->access = access;
+    map_entry(decoder, entry);
+    return idx;
+}
+
+address_decoder_t *address_decoder_init(void) {
+    return calloc(1, sizeof(address_decoder_t));
 }
 
-void module_init(void) {
-    for(uint32_t i=0; i<DEVICE_MAP_SIZE; i++) {
-        device_map[i].read = NULL;
-        device_map[i].write = NULL;
-        device_map[i].range[0] = 0;
-        device_map[i].range[1] = 0;
+void address_decoder_free(address_decoder_t *decoder) {
+    for(uint32_t i=0; i<NUM_PAGES; i++) {
+        free(decoder->pages[i].split);
     }
+    free(decoder);
 }
 
-void module_reset(void) {
+void address_decoder_reset(address_decoder_t *decoder) {
     ;
 }
@@ -0,0 +1,50 @@
+#pragma once
+
+#include <stdint.h>
+
+#include "devices/memory/memory.h"
+
+#define MEM_ACCESS_READ     0x01
+#define MEM_ACCESS_WRITE    0x02
+
+// Errors of memory_map_*() and address_decoder_read()/address_decoder_write()
+#define ADDRESS_DECODER_INVALID_RANGE   (-1)    // addr_start > addr_end or outside of the address space
+#define ADDRESS_DECODER_TABLE_FULL      (-2)
+#define ADDRESS_DECODER_OVERLAP         (-3)    // The range overlaps an already mapped one
+#define ADDRESS_DECODER_UNMAPPED        (-4)    // No device at the address
+#define ADDRESS_DECODER_ACCESS_DENIED   (-5)    // Access not allowed by memory_map_direct()
+
+typedef struct address_decoder address_decoder_t;
+
+address_decoder_t *address_decoder_init(void);
+void address_decoder_free(address_decoder_t *decoder);
+void address_decoder_reset(address_decoder_t *decoder);
+
+/**
+ * @brief Maps the address range [addr_start, addr_end] to a device
+ *
+ * Ranges overlapping an already mapped device are rejected. Lookups go through a
+ * page table, pages shared by several devices are resolved per address.
+ *
+ * @param[void*] ctx The device instance passed to read_func and write_func
+ * @return Map entry index or ADDRESS_DECODER_* error
+ */
+int memory_map_device(address_decoder_t *decoder, uint32_t addr_start, uint32_t addr_end,
+                      mem_read_func_t *read_func, mem_write_func_t *write_func, void *ctx);
+
+/**
+ * @brief Maps the address range [addr_start, addr_end] to plain memory
+ *
+ * Reads and writes are done on mem directly instead of through device callbacks,
+ * use it for RAM and ROM and keep memory_map_device() for MMIO devices.
+ *
+ * @param[DATA_BUS_WIDTH*] mem Backing store, at least addr_end - addr_start + 1 cells
+ * @param[uint32_t] access MEM_ACCESS_READ and/or MEM_ACCESS_WRITE, other accesses are errors
+ * @return Map entry index or ADDRESS_DECODER_* error
+ */
+int memory_map_direct(address_decoder_t *decoder, uint32_t addr_start, uint32_t addr_end,
+                      DATA_BUS_WIDTH *mem, uint32_t access);
+
+// Return 0 or an ADDRESS_DECODER_* error, val is left untouched on errors
+int address_decoder_read(address_decoder_t *decoder, uint32_t address, uint8_t *val);
+int address_decoder_write(address_decoder_t *decoder, uint32_t address, uint8_t val);
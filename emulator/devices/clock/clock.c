@@ -2,183 +2,677 @@
 #include <stdlib.h>
 #include <time.h>
 #include <unistd.h>
+#ifdef _WIN32
 #include <pthread_time.h>   // Only to make VSCode happy
+#endif
 #include "clock.h"
+#include "API/device_api.h"
 #include <pthread.h>
+#include <string.h>
 
 #include "lib/utils.h"
+#include "lib/log.h"
 
 #define MAX_NUM_DEVICES 256
 #define NSEC_PER_SEC 1000000000L
 
 typedef struct {
-    void (*tick_func)(void);
-    uint32_t tick_counter;  // Used for the divider functionality
+    void (*tick_func)(void*);
+    void *ctx;
     uint32_t clock_divider;
+    uint64_t next_due;      // Scheduler tick the device fires at
 } device_t;
 
-static uint64_t tick_counter;
-static int ticks_per_second;
-static int rtm;
-static uint64_t target_ns;
-static device_t devices[MAX_NUM_DEVICES];
-
-int clock_add_device(void (*tick_func)(void), uint32_t clock_divider) {
-    for(int i=0; i<MAX_NUM_DEVICES; i++) {
-        if (devices[i].tick_func == NULL) {
-            devices[i].tick_func = tick_func;
-            devices[i].tick_counter = 0;
-            devices[i].clock_divider = clock_divider;
-            return i;
+// Real time pacing: the thread sleeps until absolute deadlines computed from the number of
+// ticks since pacing_start, once every pace_ticks ticks, so sleep inaccuracies don't add up.
+// If the emulation falls behind, the following periods run without sleeping to catch up,
+// unless it is more than MAX_CATCHUP_NS behind, then the deadlines are rebased.
+#define PACE_PERIOD_DIV 1000                    // Sleep at most every 1 ms
+#define MAX_CATCHUP_NS  (100 * 1000000L)
+
+typedef struct {
+    struct timespec start;      // Wall time of tick 0 of the current pacing run
+    uint64_t ticks;             // Ticks executed since start
+    uint32_t pace_ticks;        // Ticks between deadlines
+    uint32_t countdown;         // Ticks left to the next deadline
+    int resync;                 // Restart pacing on the next tick (after a pause)
+    uint64_t total_ticks;       // Totals of the finished pacing runs, for the achieved frequency
+    uint64_t total_ns;
+    uint32_t overruns;          // Deadlines that had already passed
+    uint32_t rebases;           // Times the catch-up was abandoned
+} pacing_t;
+
+typedef struct {
+    uint64_t ticks;
+    uint64_t fired;         // Device tick functions called
+    uint64_t visited;       // Heap nodes examined, the scan cost
+    uint32_t max_fired;     // Most devices fired by a single tick
+} clock_stats_t;
+
+typedef enum { STATE_PAUSED, STATE_RUNNING, STATE_STEPPING, STATE_EXIT } system_state_t;
+
+struct xtal {
+    int ticks_per_second;
+    int rtm;
+    pacing_t pacing;
+
+    // Registered devices are kept in a compact list, the ones with a non-zero divider are
+    // also kept in a min-heap ordered by (next_due, id), so a tick only visits the devices
+    // that fire on it.
+    device_t devices[MAX_NUM_DEVICES];
+    uint32_t num_devices;
+    uint32_t heap[MAX_NUM_DEVICES];     // Device ids
+    uint32_t heap_size;
+    uint64_t scheduler_ticks;           // Number of tick_system() calls plus the skipped ticks
+    uint64_t skip_pending;              // clock_skip_ticks() not applied yet, protected by state_mtx
+    clock_stats_t stats;
+
+    // Worker thread
+    pthread_t worker_thread;
+    pthread_mutex_t state_mtx;
+    pthread_cond_t state_cond;
+    pthread_cond_t step_done_cond;
+    system_state_t current_state;
+    int step_budget;
+    uint32_t ticks_in_flight;           // Ticks of a stepping batch not executed yet
+
+    // Run limits, see xtal_set_tick_limit() and xtal_set_deadline()
+    pthread_cond_t done_cond;
+    uint64_t ticks_left;                // UINT64_MAX: no tick limit
+    int deadline_set;
+    struct timespec deadline;
+    uint32_t stop_reason;
+    xtal_done_func_t *done_callback;
+    void *done_arg;
+};
+
+static void* run_xtal(void* arg);
+
+static int heap_before(xtal_t *xtal, uint32_t a, uint32_t b) {
+    if (xtal->devices[a].next_due != xtal->devices[b].next_due) {
+        return xtal->devices[a].next_due < xtal->devices[b].next_due;
+    }
+    return a < b;   // Devices due on the same tick fire in registration order
+}
+
+static void heap_sift_up(xtal_t *xtal, uint32_t pos) {
+    while (pos > 0) {
+        uint32_t parent = (pos - 1) / 2;
+        xtal->stats.visited++;
+        if (!heap_before(xtal, xtal->heap[pos], xtal->heap[parent])) {
+            break;
         }
+        uint32_t tmp = xtal->heap[pos];
+        xtal->heap[pos] = xtal->heap[parent];
+        xtal->heap[parent] = tmp;
+        pos = parent;
+    }
+}
+
+static void heap_sift_down(xtal_t *xtal, uint32_t pos) {
+    while (1) {
+        uint32_t smallest = pos;
+        uint32_t left = 2 * pos + 1;
+        uint32_t right = left + 1;
+        if ((left < xtal->heap_size) && heap_before(xtal, xtal->heap[left], xtal->heap[smallest])) {
+            smallest = left;
+        }
+        if ((right < xtal->heap_size) && heap_before(xtal, xtal->heap[right], xtal->heap[smallest])) {
+            smallest = right;
+        }
+        xtal->stats.visited++;
+        if (smallest == pos) {
+            return;
+        }
+        uint32_t tmp = xtal->heap[pos];
+        xtal->heap[pos] = xtal->heap[smallest];
+        xtal->heap[smallest] = tmp;
+        pos = smallest;
+    }
+}
+
+static void heap_push(xtal_t *xtal, uint32_t id) {
+    xtal->heap[xtal->heap_size] = id;
+    xtal->heap_size++;
+    heap_sift_up(xtal, xtal->heap_size - 1);
+}
+
+static void heap_rebuild(xtal_t *xtal) {
+    xtal->heap_size = 0;
+    for (uint32_t i=0; i<xtal->num_devices; i++) {
+        if (xtal->devices[i].clock_divider != 0) {
+            heap_push(xtal, i);
+        }
+    }
+}
+
+int clock_add_device(xtal_t *xtal, void (*tick_func)(void*), void *ctx, uint32_t clock_divider) {
+    if (xtal->num_devices == MAX_NUM_DEVICES) {
+        return -1;
+    }
+    uint32_t id = xtal->num_devices;
+    xtal->devices[id].tick_func = tick_func;
+    xtal->devices[id].ctx = ctx;
+    xtal->devices[id].clock_divider = clock_divider;
+    xtal->devices[id].next_due = xtal->scheduler_ticks + clock_divider;
+    xtal->num_devices++;
+    if (clock_divider != 0) {   // A zero divider never fires
+        heap_push(xtal, id);
     }
-    return -1;
+    return id;
 }
 
-int init_clock(int freq, int real_time_mode) {
-    for(int i=0; i<MAX_NUM_DEVICES; i++) {
-        devices[i].tick_func = NULL;
+xtal_t *init_clock(int freq, int real_time_mode) {
+    xtal_t *xtal = calloc(1, sizeof(xtal_t));
+    if (xtal == NULL) {
+        return NULL;
     }
-    printf("Init clock, freq: %d, real_time_mode: %s\n", freq, real_time_mode? "True": "False");
+    LOG_INFO("Init clock, freq: %d, real_time_mode: %s\n", freq, real_time_mode? "True": "False");
     if (real_time_mode == 0) {
-        rtm = 0;
+        xtal->rtm = 0;
     } else {
-        rtm = 1;
+        xtal->rtm = 1;
     }
-    ticks_per_second = freq;
-    target_ns = NSEC_PER_SEC / ticks_per_second;
-    init_xtal_thread();
-    return EXIT_SUCCESS;
+    xtal->ticks_per_second = freq;
+    xtal->pacing.pace_ticks = xtal->ticks_per_second / PACE_PERIOD_DIV;
+    if (xtal->pacing.pace_ticks == 0) {
+        xtal->pacing.pace_ticks = 1;
+    }
+    xtal->pacing.resync = 1;
+    pthread_mutex_init(&xtal->state_mtx, NULL);
+    pthread_cond_init(&xtal->state_cond, NULL);
+    pthread_cond_init(&xtal->step_done_cond, NULL);
+    pthread_cond_init(&xtal->done_cond, NULL);
+    xtal->current_state = STATE_PAUSED;
+    xtal->ticks_left = UINT64_MAX;
+    xtal->stop_reason = XTAL_STOP_NONE;
+    pthread_create(&xtal->worker_thread, NULL, run_xtal, xtal);
+    return xtal;
 }
 
-void tick_system() {
-    for(int i=0; i<MAX_NUM_DEVICES; i++) {
-        if (devices[i].tick_func != NULL) {
-            devices[i].tick_counter++;
-            if(devices[i].tick_counter == devices[i].clock_divider) {
-                devices[i].tick_func();
-                devices[i].tick_counter = 0;
-            }
+void free_clock(xtal_t *xtal) {
+    xtal_exit(xtal);
+    pthread_join(xtal->worker_thread, NULL);
+    pthread_mutex_destroy(&xtal->state_mtx);
+    pthread_cond_destroy(&xtal->state_cond);
+    pthread_cond_destroy(&xtal->step_done_cond);
+    pthread_cond_destroy(&xtal->done_cond);
+    free(xtal);
+}
+
+// The skipped ticks fire no device, each device keeps its phase: its next tick is moved
+// to the first multiple of its divider after the skipped time. Called with state_mtx locked.
+static void apply_skip(xtal_t *xtal) {
+    xtal->scheduler_ticks += xtal->skip_pending;
+    xtal->skip_pending = 0;
+    for (uint32_t i=0; i<xtal->num_devices; i++) {
+        device_t *device = &xtal->devices[i];
+        if ((device->clock_divider != 0) && (device->next_due <= xtal->scheduler_ticks)) {
+            device->next_due += ((xtal->scheduler_ticks - device->next_due) / device->clock_divider + 1) * device->clock_divider;
         }
     }
+    heap_rebuild(xtal);
+}
+
+static void tick_system(xtal_t *xtal) {
+    uint32_t fired = 0;
+    if (xtal->skip_pending) {
+        pthread_mutex_lock(&xtal->state_mtx);
+        apply_skip(xtal);
+        pthread_mutex_unlock(&xtal->state_mtx);
+    }
+    xtal->scheduler_ticks++;
+    xtal->stats.ticks++;
+    while ((xtal->heap_size > 0) && (xtal->devices[xtal->heap[0]].next_due == xtal->scheduler_ticks)) {
+        device_t *device = &xtal->devices[xtal->heap[0]];
+        device->tick_func(device->ctx);
+        device->next_due += device->clock_divider;
+        heap_sift_down(xtal, 0);
+        fired++;
+    }
+    xtal->stats.visited++;    // The heap top that ended the loop
+    xtal->stats.fired += fired;
+    if (fired > xtal->stats.max_fired) {
+        xtal->stats.max_fired = fired;
+    }
+}
+
+void clock_skip_ticks(xtal_t *xtal, uint64_t ticks) {
+    // Applied by the next tick_system(), the caller may be a device in the middle of a tick
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->skip_pending += ticks;
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+static int64_t timespec_diff_ns(const struct timespec *a, const struct timespec *b) {
+    return (int64_t)(a->tv_sec - b->tv_sec) * NSEC_PER_SEC + (a->tv_nsec - b->tv_nsec);
+}
+
+static void pacing_deadline(xtal_t *xtal, struct timespec *deadline) {
+    // Split to avoid overflowing ticks * NSEC_PER_SEC
+    uint64_t seconds = xtal->pacing.ticks / xtal->ticks_per_second;
+    uint64_t ns = (xtal->pacing.ticks % xtal->ticks_per_second) * NSEC_PER_SEC / xtal->ticks_per_second;
+    deadline->tv_sec = xtal->pacing.start.tv_sec + seconds;
+    deadline->tv_nsec = xtal->pacing.start.tv_nsec + ns;
+    if (deadline->tv_nsec >= NSEC_PER_SEC) {
+        deadline->tv_sec++;
+        deadline->tv_nsec -= NSEC_PER_SEC;
+    }
+}
+
+static void pacing_finish_run(xtal_t *xtal, const struct timespec *now) {
+    if (xtal->pacing.ticks) {
+        xtal->pacing.total_ticks += xtal->pacing.ticks;
+        xtal->pacing.total_ns += timespec_diff_ns(now, &xtal->pacing.start);
+    }
+    xtal->pacing.start = *now;
+    xtal->pacing.ticks = 0;
+    xtal->pacing.countdown = xtal->pacing.pace_ticks;
+}
+
+static void pacing_pause(xtal_t *xtal) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    pacing_finish_run(xtal, &now);
 }
 
-int run_one_tick(void) {
-    struct timespec start, end, delay;
-    if (tick_counter > 128) {
-        exit(EXIT_SUCCESS);
+static void pace(xtal_t *xtal) {
+    struct timespec now, deadline;
+    if (xtal->pacing.resync) {    // Don't try to catch up on the time spent paused
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        pacing_finish_run(xtal, &now);
+        xtal->pacing.resync = 0;
     }
-    if (rtm == 0) {
-        tick_system();
+    xtal->pacing.ticks++;
+    if (--xtal->pacing.countdown) {
+        return;
+    }
+    xtal->pacing.countdown = xtal->pacing.pace_ticks;
+    pacing_deadline(xtal, &deadline);
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    int64_t ahead_ns = timespec_diff_ns(&deadline, &now);
+    if (ahead_ns > 0) {
+        clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &deadline, NULL);
     } else {
-        clock_gettime(CLOCK_MONOTONIC, &start);
-        tick_system();
-        clock_gettime(CLOCK_MONOTONIC, &end);
-        long elapsed_ns = (end.tv_sec - start.tv_sec) * NSEC_PER_SEC + (end.tv_nsec - start.tv_nsec);
-
-        if (elapsed_ns < target_ns) {
-            long remaining_ns = target_ns - elapsed_ns;
-            delay.tv_sec = 0;
-            delay.tv_nsec = remaining_ns;
-            nanosleep(&delay, NULL);
+        xtal->pacing.overruns++;
+        if (-ahead_ns > MAX_CATCHUP_NS) {
+            xtal->pacing.rebases++;
+            pacing_finish_run(xtal, &now);
         }
     }
-    tick_counter++;
-    return EXIT_SUCCESS;
 }
 
-typedef enum { STATE_PAUSED, STATE_RUNNING, STATE_STEPPING, STATE_EXIT } system_state_t;
+static void run_one_tick(xtal_t *xtal) {
+    tick_system(xtal);
+    if (xtal->rtm) {
+        pace(xtal);
+    }
+}
 
-static pthread_t worker_thread;
-static pthread_mutex_t state_mtx = PTHREAD_MUTEX_INITIALIZER;
-static pthread_cond_t state_cond = PTHREAD_COND_INITIALIZER;
-static pthread_cond_t step_done_cond = PTHREAD_COND_INITIALIZER;
-static system_state_t current_state = STATE_PAUSED;
+// The worker claims up to TICK_BATCH ticks per lock acquisition and runs them without
+// the lock, the state is only rechecked between batches. In real time mode a batch is
+// also limited to BATCH_PERIOD_DIV-th of a second, so xtal_pause() takes effect quickly.
+#define TICK_BATCH          4096
+#define BATCH_PERIOD_DIV    100
 
-static int step_budget = 0;
+static uint32_t batch_size(xtal_t *xtal) {
+    if (xtal->rtm) {
+        uint32_t ticks = xtal->ticks_per_second / BATCH_PERIOD_DIV;
+        if (ticks == 0) {
+            return 1;
+        }
+        return ticks < TICK_BATCH? ticks: TICK_BATCH;
+    }
+    return TICK_BATCH;
+}
 
-void* run_xtal(void* arg) {
-    printf("run_xtal: Init\n");
+// Called with state_mtx locked
+static uint32_t limited_batch_size(xtal_t *xtal) {
+    uint32_t batch = batch_size(xtal);
+    return (batch > xtal->ticks_left)? (uint32_t)xtal->ticks_left: batch;
+}
+
+// Called with state_mtx locked, returns the XTAL_STOP_* reason if a limit was reached
+static uint32_t check_limits(xtal_t *xtal) {
+    if (xtal->ticks_left == 0) {
+        return XTAL_STOP_TICK_LIMIT;
+    }
+    if (xtal->deadline_set) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        if (timespec_diff_ns(&xtal->deadline, &now) <= 0) {
+            return XTAL_STOP_DEADLINE;
+        }
+    }
+    return XTAL_STOP_NONE;
+}
+
+// Called with state_mtx locked
+static void stop_on_limit(xtal_t *xtal, uint32_t reason) {
+    xtal->current_state = STATE_PAUSED;
+    xtal->step_budget = 0;
+    xtal->stop_reason = reason;
+    pthread_cond_broadcast(&xtal->done_cond);
+    pthread_cond_broadcast(&xtal->step_done_cond);
+}
+
+static void* run_xtal(void* arg) {
+    xtal_t *xtal = arg;
+    LOG_DEBUG("run_xtal: Init\n");
     while (1) {
-        int just_finished_stepping = 0;
-        int keep_running = 0;
-        pthread_mutex_lock(&state_mtx);
-        switch(current_state) {
+        int stepping = 0;
+        uint32_t batch = 0;
+        pthread_mutex_lock(&xtal->state_mtx);
+        if ((xtal->current_state == STATE_RUNNING) || (xtal->current_state == STATE_STEPPING)) {
+            uint32_t limit_reason = check_limits(xtal);
+            if (limit_reason != XTAL_STOP_NONE) {
+                LOG_DEBUG("run_xtal: run limit reached: %d\n", limit_reason);
+                stop_on_limit(xtal, limit_reason);
+                xtal_done_func_t *callback = xtal->done_callback;
+                void *callback_arg = xtal->done_arg;
+                pthread_mutex_unlock(&xtal->state_mtx);
+                if (callback != NULL) {
+                    callback(callback_arg, limit_reason);
+                }
+                continue;
+            }
+        }
+        switch(xtal->current_state) {
             case STATE_EXIT:
-                pthread_mutex_unlock(&state_mtx);
+                pthread_mutex_unlock(&xtal->state_mtx);
                 return NULL;
             case STATE_STEPPING:
-                printf("run_xtal: STATE_STEPPING\n");
-                if (step_budget > 0) {
-                    step_budget--;
-                    if (step_budget <= 0) { // Will halt on the next iteration
-                        current_state = STATE_PAUSED;
-                        just_finished_stepping = 1;
+                if (xtal->step_budget > 0) {
+                    batch = limited_batch_size(xtal);
+                    if ((uint32_t)xtal->step_budget < batch) {
+                        batch = xtal->step_budget;
                     }
-                    keep_running = 1;
+                    xtal->step_budget -= batch;
+                    if (xtal->step_budget <= 0) { // Will halt after this batch
+                        xtal->current_state = STATE_PAUSED;
+                    }
+                    xtal->ticks_in_flight = batch;
+                    stepping = 1;
                 } else {    // Counter was decremented by API, do one more step and halt
-                    RAISE("Error: current_state == STATE_STEPPING and step_budget <= 0\n");
-                    current_state = STATE_PAUSED;
+                    RAISE("Error: xtal->current_state == STATE_STEPPING and xtal->step_budget <= 0\n");
+                    xtal->current_state = STATE_PAUSED;
                 }
                 break;
             case STATE_RUNNING:
-                printf("run_xtal: STATE_RUNNING\n");
-                keep_running = 1;
+                batch = limited_batch_size(xtal);
                 break;
             case STATE_PAUSED:
-                printf("run_xtal: STATE_PAUSED\n");
-                pthread_cond_wait(&state_cond, &state_mtx);
-                printf("run_xtal: signal received\n");
+                LOG_DEBUG("run_xtal: STATE_PAUSED\n");
+                if (xtal->rtm) {
+                    pacing_pause(xtal);
+                }
+                pthread_cond_wait(&xtal->state_cond, &xtal->state_mtx);
+                xtal->pacing.resync = 1;
                 break;
             default:
-                RAISE("Error: Unknown state: %d\n", current_state);
+                RAISE("Error: Unknown state: %d\n", xtal->current_state);
         }
 
-        pthread_mutex_unlock(&state_mtx);
+        if (xtal->ticks_left != UINT64_MAX) {
+            xtal->ticks_left -= batch;
+        }
+        pthread_mutex_unlock(&xtal->state_mtx);
 
-        if (keep_running) {
-            run_one_tick();
+        for (uint32_t i=0; i<batch; i++) {
+            run_one_tick(xtal);
         }
 
-        if (just_finished_stepping) {
-            pthread_cond_broadcast(&step_done_cond);
+        if (stepping) {
+            pthread_mutex_lock(&xtal->state_mtx);
+            xtal->ticks_in_flight = 0;
+            pthread_cond_broadcast(&xtal->step_done_cond);
+            pthread_mutex_unlock(&xtal->state_mtx);
         }
     }
 }
 
-void xtal_run(void) {
-    pthread_mutex_lock(&state_mtx);
-    current_state = STATE_RUNNING;
-    pthread_cond_signal(&state_cond);
-    pthread_mutex_unlock(&state_mtx);
+void xtal_run(xtal_t *xtal) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->current_state = STATE_RUNNING;
+    xtal->stop_reason = XTAL_STOP_NONE;
+    pthread_cond_signal(&xtal->state_cond);
+    pthread_mutex_unlock(&xtal->state_mtx);
 }
 
-void xtal_pause(void) {
-    pthread_mutex_lock(&state_mtx);
-    current_state = STATE_PAUSED;
+void xtal_pause(xtal_t *xtal) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->current_state = STATE_PAUSED;
     // We don't clear step_budget here, allowing pending steps to finish
-    pthread_mutex_unlock(&state_mtx);
+    if (xtal->stop_reason == XTAL_STOP_NONE) {
+        xtal->stop_reason = XTAL_STOP_PAUSED;
+        pthread_cond_broadcast(&xtal->done_cond);
+    }
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+void xtal_step(xtal_t *xtal, uint32_t steps) {
+    LOG_DEBUG("xtal_step: running %d steps\n", steps);
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->step_budget += steps;
+    xtal->current_state = STATE_STEPPING;
+    xtal->stop_reason = XTAL_STOP_NONE;
+    pthread_cond_signal(&xtal->state_cond);
+    while ((xtal->step_budget > 0) || (xtal->ticks_in_flight > 0)) {
+        pthread_cond_wait(&xtal->step_done_cond, &xtal->state_mtx);
+    }
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+void xtal_exit(xtal_t *xtal) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->current_state = STATE_EXIT;
+    pthread_cond_signal(&xtal->state_cond);
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+void xtal_set_tick_limit(xtal_t *xtal, uint64_t ticks) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->ticks_left = ticks? ticks: UINT64_MAX;
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+void xtal_set_deadline(xtal_t *xtal, uint32_t ms) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->deadline_set = ms != 0;
+    clock_gettime(CLOCK_MONOTONIC, &xtal->deadline);
+    xtal->deadline.tv_sec += ms / 1000;
+    xtal->deadline.tv_nsec += (long)(ms % 1000) * 1000000L;
+    if (xtal->deadline.tv_nsec >= NSEC_PER_SEC) {
+        xtal->deadline.tv_sec++;
+        xtal->deadline.tv_nsec -= NSEC_PER_SEC;
+    }
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+void xtal_set_done_callback(xtal_t *xtal, xtal_done_func_t *callback, void *arg) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->done_callback = callback;
+    xtal->done_arg = arg;
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+uint32_t xtal_wait(xtal_t *xtal, uint32_t timeout_ms) {
+    struct timespec until;
+    clock_gettime(CLOCK_REALTIME, &until);  // The condition variable uses the default clock
+    until.tv_sec += timeout_ms / 1000;
+    until.tv_nsec += (long)(timeout_ms % 1000) * 1000000L;
+    if (until.tv_nsec >= NSEC_PER_SEC) {
+        until.tv_sec++;
+        until.tv_nsec -= NSEC_PER_SEC;
+    }
+    pthread_mutex_lock(&xtal->state_mtx);
+    while (xtal->stop_reason == XTAL_STOP_NONE) {
+        if (timeout_ms == 0) {
+            pthread_cond_wait(&xtal->done_cond, &xtal->state_mtx);
+        } else if (pthread_cond_timedwait(&xtal->done_cond, &xtal->state_mtx, &until) != 0) {
+            break;
+        }
+    }
+    uint32_t reason = xtal->stop_reason;
+    pthread_mutex_unlock(&xtal->state_mtx);
+    return reason;
+}
+
+// --- Device interface, exposes the scheduler stats ---
+
+static void clock_iface_init(void *ctx) {
+    return;
+}
+
+static void clock_iface_tick(void *ctx) {
+    return;
+}
+
+static uint32_t clock_iface_get_buf_size(void *ctx) {
+    xtal_t *xtal = ctx;
+    return sizeof(xtal->scheduler_ticks) + sizeof(uint64_t) * xtal->num_devices;
+}
+
+static void clock_iface_save_state(void *ctx, uint8_t *buf) {
+    xtal_t *xtal = ctx;
+    pthread_mutex_lock(&xtal->state_mtx);
+    if (xtal->skip_pending) {
+        apply_skip(xtal);
+    }
+    memmove(buf, &xtal->scheduler_ticks, sizeof(xtal->scheduler_ticks));
+    for (uint32_t i=0; i<xtal->num_devices; i++) {
+        memmove(&buf[sizeof(xtal->scheduler_ticks) + i * sizeof(uint64_t)], &xtal->devices[i].next_due, sizeof(uint64_t));
+    }
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+static void clock_iface_restore_state(void *ctx, uint8_t *buf) {
+    xtal_t *xtal = ctx;
+    pthread_mutex_lock(&xtal->state_mtx);
+    memmove(&xtal->scheduler_ticks, buf, sizeof(xtal->scheduler_ticks));
+    xtal->skip_pending = 0;
+    for (uint32_t i=0; i<xtal->num_devices; i++) {
+        memmove(&xtal->devices[i].next_due, &buf[sizeof(xtal->scheduler_ticks) + i * sizeof(uint64_t)], sizeof(uint64_t));
+    }
+    heap_rebuild(xtal);
+    pthread_mutex_unlock(&xtal->state_mtx);
+}
+
+static void clock_iface_set_register(void *ctx, uint32_t reg_id, uint32_t value) {
+    xtal_t *xtal = ctx;
+    if (reg_id == CLOCK_REG_RESET_STATS) {
+        memset(&xtal->stats, 0, sizeof(xtal->stats));
+        xtal->pacing.total_ticks = 0;
+        xtal->pacing.total_ns = 0;
+        xtal->pacing.overruns = 0;
+        xtal->pacing.rebases = 0;
+        xtal->pacing.resync = 1;
+    } else {
+        LOG_ERROR("Clock has no writable register 0x%X\n", reg_id);
+    }
+}
+
+// In mHz, so the slow clocks don't round down to 0
+static uint64_t achieved_frequency(xtal_t *xtal) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    uint64_t ticks = xtal->pacing.total_ticks + xtal->pacing.ticks;
+    uint64_t ns = xtal->pacing.total_ns;
+    if (xtal->pacing.ticks) {
+        ns += timespec_diff_ns(&now, &xtal->pacing.start);
+    }
+    return ns? (uint64_t)(ticks * 1000.0 * NSEC_PER_SEC / ns): 0;
+}
+
+static uint64_t scheduler_time(xtal_t *xtal) {
+    pthread_mutex_lock(&xtal->state_mtx);
+    uint64_t time = xtal->scheduler_ticks + xtal->skip_pending;
+    pthread_mutex_unlock(&xtal->state_mtx);
+    return time;
+}
+
+static void clock_iface_get_register(void *ctx, uint32_t reg_id, uint32_t *value) {
+    xtal_t *xtal = ctx;
+    switch (reg_id) {
+        case CLOCK_REG_TICKS_LO:
+            *value = (uint32_t)xtal->stats.ticks;
+            break;
+        case CLOCK_REG_TICKS_HI:
+            *value = (uint32_t)(xtal->stats.ticks >> 32);
+            break;
+        case CLOCK_REG_NUM_DEVICES:
+            *value = xtal->num_devices;
+            break;
+        case CLOCK_REG_FIRED_LO:
+            *value = (uint32_t)xtal->stats.fired;
+            break;
+        case CLOCK_REG_FIRED_HI:
+            *value = (uint32_t)(xtal->stats.fired >> 32);
+            break;
+        case CLOCK_REG_FIRED_PER_TICK:
+            *value = xtal->stats.ticks? (uint32_t)(xtal->stats.fired * 1000 / xtal->stats.ticks): 0;
+            break;
+        case CLOCK_REG_SCAN_PER_TICK:
+            *value = xtal->stats.ticks? (uint32_t)(xtal->stats.visited * 1000 / xtal->stats.ticks): 0;
+            break;
+        case CLOCK_REG_MAX_FIRED:
+            *value = xtal->stats.max_fired;
+            break;
+        case CLOCK_REG_TARGET_FREQ:
+            *value = xtal->ticks_per_second;
+            break;
+        case CLOCK_REG_ACHIEVED_FREQ_LO:
+            *value = (uint32_t)achieved_frequency(xtal);
+            break;
+        case CLOCK_REG_ACHIEVED_FREQ_HI:
+            *value = (uint32_t)(achieved_frequency(xtal) >> 32);
+            break;
+        case CLOCK_REG_OVERRUNS:
+            *value = xtal->pacing.overruns;
+            break;
+        case CLOCK_REG_REBASES:
+            *value = xtal->pacing.rebases;
+            break;
+        case CLOCK_REG_TIME_LO:
+            *value = (uint32_t)scheduler_time(xtal);
+            break;
+        case CLOCK_REG_TIME_HI:
+            *value = (uint32_t)(scheduler_time(xtal) >> 32);
+            break;
+        default:
+            LOG_ERROR("Clock has no readable register 0x%X\n", reg_id);
+            *value = 0;
+    }
 }
 
-void xtal_step(uint32_t steps) {
-    printf("xtal_step: running %d steps\n", steps);
-    pthread_mutex_lock(&state_mtx);
-    step_budget += steps;
-    current_state = STATE_STEPPING;
-    pthread_cond_signal(&state_cond);
-    while (step_budget > 0) {
-        pthread_cond_wait(&step_done_cond, &state_mtx);
+// Restarts the time base at tick 0 like the other devices' reset, each device fires again
+// clock_divider ticks from now
+static void clock_iface_reset(void *ctx) {
+    xtal_t *xtal = ctx;
+    pthread_mutex_lock(&xtal->state_mtx);
+    xtal->scheduler_ticks = 0;
+    xtal->skip_pending = 0;
+    for (uint32_t i=0; i<xtal->num_devices; i++) {
+        xtal->devices[i].next_due = xtal->devices[i].clock_divider;
     }
-    pthread_mutex_unlock(&state_mtx);
+    heap_rebuild(xtal);
+    memset(&xtal->stats, 0, sizeof(xtal->stats));
+    pthread_mutex_unlock(&xtal->state_mtx);
 }
 
-void xtal_exit(void) {
-    pthread_mutex_lock(&state_mtx);
-    current_state = STATE_EXIT;
-    pthread_cond_signal(&state_cond);
-    pthread_mutex_unlock(&state_mtx);
+static void clock_iface_destroy(void *ctx) {
+    return;     // The clock is freed by free_clock()
 }
 
-void init_xtal_thread(void) {
-    pthread_create(&worker_thread, NULL, run_xtal, NULL);
+void clock_get_device_iface(xtal_t *xtal, device_iface_t *iface) {
+    iface->ctx = xtal;
+    iface->init = clock_iface_init;
+    iface->tick = clock_iface_tick;
+    iface->get_buf_size = clock_iface_get_buf_size;
+    iface->save_state = clock_iface_save_state;
+    iface->restore_state = clock_iface_restore_state;
+    iface->get_register = clock_iface_get_register;
+    iface->set_register = clock_iface_set_register;
+    iface->reset = clock_iface_reset;
+    iface->destroy = clock_iface_destroy;
 }
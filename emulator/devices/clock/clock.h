@@ -2,29 +2,107 @@
 
 #include <stdint.h>
 
+#include "API/device_api.h"
+
+/* Scheduler stats registers (get_register of the clock device) */
+#define CLOCK_REG_TICKS_LO          0x00    // r: ticks executed
+#define CLOCK_REG_TICKS_HI          0x01
+#define CLOCK_REG_NUM_DEVICES       0x02    // r: devices connected to the clock
+#define CLOCK_REG_FIRED_LO          0x03    // r: device tick functions called
+#define CLOCK_REG_FIRED_HI          0x04
+#define CLOCK_REG_FIRED_PER_TICK    0x05    // r: average devices fired per tick, x1000
+#define CLOCK_REG_SCAN_PER_TICK     0x06    // r: average scheduler nodes examined per tick, x1000
+#define CLOCK_REG_MAX_FIRED         0x07    // r: most devices fired by a single tick
+#define CLOCK_REG_RESET_STATS       0x08    // w: clear the stats
+#define CLOCK_REG_TIME_LO           0x09    // r: scheduler time in ticks, including the skipped ones
+#define CLOCK_REG_TIME_HI           0x0A
+#define CLOCK_REG_TARGET_FREQ       0x0B    // r: ticks per second requested in init_clock()
+#define CLOCK_REG_ACHIEVED_FREQ_LO  0x0C    // r: real time mode: measured ticks per second while running, x1000 (mHz)
+#define CLOCK_REG_ACHIEVED_FREQ_HI  0x0D
+#define CLOCK_REG_OVERRUNS          0x0E    // r: real time mode: pacing deadlines missed
+#define CLOCK_REG_REBASES           0x0F    // r: real time mode: times the emulation fell too far behind to catch up
+
+typedef struct xtal xtal_t;    // Clock instance, each one has its own worker thread
+
 /**
  * @brief Connect device to xtal
  *
- * @param[void (*tick)(void)] tick The tick function of the device
+ * @param[xtal_t*] xtal The clock
+ * @param[void (*tick)(void*)] tick The tick function of the device
+ * @param[void*] ctx The device instance passed to tick
  * @param[int] clock_divider The device will be called each clock_divider clock of xtal
- * @return Device id [0...] or EXIT_FAILURE in case of error
+ * @return Device id [0...] or -1 in case of error
  */
-int clock_add_device(void (*tick)(void), uint32_t clock_divider);
+int clock_add_device(xtal_t *xtal, void (*tick)(void*), void *ctx, uint32_t clock_divider);
 
 /**
- * @brief Initialises clock
+ * @brief Creates a clock and starts its worker thread (paused)
  * @details If real_time_mode set and xtal can run faster than real time, it will add sleep periods to each cycle to run at real time
  *
  * @param[int] freq Ticks per second
  * @param[int] real_time_mode 0: run as fast as possible; 1: do not run faster than real time
- * @return Device id [0...] or EXIT_FAILURE in case of error
+ * @return The clock or NULL in case of error
+ */
+xtal_t *init_clock(int freq, int real_time_mode);
+
+/**
+ * @brief Stops the worker thread and frees the clock
+ */
+void free_clock(xtal_t *xtal);
+
+/**
+ * @brief Advances the clock without ticking the devices, used to skip idle time (CPU in SLEEP)
+ *
+ * The scheduler time moves on by `ticks` before the next tick, each device keeps its phase.
+ * Safe to call from a device tick function.
+ *
+ * @param[uint64_t] ticks Number of ticks to skip, see interrupt_controller_sleep()
+ */
+void clock_skip_ticks(xtal_t *xtal, uint64_t ticks);
+
+/**
+ * @brief Fills iface with the clock device interface, used to read the scheduler stats
  */
-int init_clock(int freq, int real_time_mode);
+void clock_get_device_iface(xtal_t *xtal, device_iface_t *iface);
 
 // --- Control Functions ---
 
-void xtal_run(void);
-void xtal_pause(void);
-void xtal_step(uint32_t steps);
-void xtal_exit(void);
-void init_xtal_thread(void);
+void xtal_run(xtal_t *xtal);
+void xtal_pause(xtal_t *xtal);
+void xtal_step(xtal_t *xtal, uint32_t steps);
+void xtal_exit(xtal_t *xtal);
+
+// --- Run limits ---
+
+#define XTAL_STOP_NONE          0   // Still running (or never started)
+#define XTAL_STOP_TICK_LIMIT    1
+#define XTAL_STOP_DEADLINE      2
+#define XTAL_STOP_PAUSED        3   // xtal_pause() was called
+
+typedef void (xtal_done_func_t)(void*, uint32_t);  // params: callback argument, XTAL_STOP_* reason
+
+/**
+ * @brief Pauses the clock after the given number of ticks from now, 0: no limit
+ */
+void xtal_set_tick_limit(xtal_t *xtal, uint64_t ticks);
+
+/**
+ * @brief Pauses the clock once the given wall clock time from now has passed, 0: no deadline
+ * @details Checked between tick batches, so the clock may overshoot by one batch
+ */
+void xtal_set_deadline(xtal_t *xtal, uint32_t ms);
+
+/**
+ * @brief Sets the function called from the clock thread when a limit pauses the clock, NULL: none
+ *
+ * @param[void*] arg Passed to the callback as its first argument
+ */
+void xtal_set_done_callback(xtal_t *xtal, xtal_done_func_t *callback, void *arg);
+
+/**
+ * @brief Waits until the clock is paused by a limit or xtal_pause()
+ *
+ * @param[uint32_t] timeout_ms 0: wait forever
+ * @return XTAL_STOP_* reason, XTAL_STOP_NONE on timeout
+ */
+uint32_t xtal_wait(xtal_t *xtal, uint32_t timeout_ms);
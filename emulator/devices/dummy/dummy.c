@@ -2,51 +2,65 @@
 #include <string.h>
 #include <stdio.h>
 #include "dummy.h"
+#include "lib/log.h"
 
 #define TEST_BUF_SIZE 128
-static uint8_t test_buf[TEST_BUF_SIZE];
-static uint32_t tick_counter;
 
-static void init(void) {
+typedef struct {
+    uint8_t test_buf[TEST_BUF_SIZE];
+    uint32_t tick_counter;
+} dummy_t;
+
+static void init(void *ctx) {
     return;
 }
 
-static void tick(void) {
-    tick_counter++;
-    printf("Dummy device tick counter: %d\n", tick_counter);
+static void tick(void *ctx) {
+    dummy_t *dev = ctx;
+    dev->tick_counter++;
+    LOG_TRACE("Dummy device tick counter: %d\n", dev->tick_counter);
 }
 
-static uint32_t get_buf_size(void) {
+static uint32_t get_buf_size(void *ctx) {
     return TEST_BUF_SIZE;
 }
 
-static void save_state(uint8_t *buf) {
+static void save_state(void *ctx, uint8_t *buf) {
+    dummy_t *dev = ctx;
     // uint8_t *buf = (uint8_t*)calloc(TEST_BUF_SIZE, sizeof(uint8_t));
-    memmove(buf, test_buf, sizeof(test_buf));
+    memmove(buf, dev->test_buf, sizeof(dev->test_buf));
     buf[12] = 23;
     buf[28] = 98;
 }
 
-static void restore_state(uint8_t *buf) {
-    memmove(test_buf, buf, sizeof(test_buf));
-    if ((test_buf[12] != 23) || (test_buf[28] != 98)) {
-        printf("Error: Device state restore failed!\n");
+static void restore_state(void *ctx, uint8_t *buf) {
+    dummy_t *dev = ctx;
+    memmove(dev->test_buf, buf, sizeof(dev->test_buf));
+    if ((dev->test_buf[12] != 23) || (dev->test_buf[28] != 98)) {
+        LOG_ERROR("Error: Device state restore failed!\n");
     }
 }
 
-static void set_register(uint32_t reg_id, uint32_t value) {
-    test_buf[reg_id] = value;
+static void set_register(void *ctx, uint32_t reg_id, uint32_t value) {
+    dummy_t *dev = ctx;
+    dev->test_buf[reg_id] = value;
 }
 
-static void get_register(uint32_t reg_id, uint32_t *value) {
-    *value = test_buf[reg_id];
+static void get_register(void *ctx, uint32_t reg_id, uint32_t *value) {
+    dummy_t *dev = ctx;
+    *value = dev->test_buf[reg_id];
 }
 
-static void reset(void) {
+static void reset(void *ctx) {
     return;
 }
 
+static void destroy(void *ctx) {
+    free(ctx);
+}
+
 void dummy_device_get_device_iface(device_iface_t *iface) {
+    iface->ctx = calloc(1, sizeof(dummy_t));
     iface->init = init;
     iface->tick = tick;
     iface->get_buf_size = get_buf_size;
@@ -55,4 +69,5 @@ void dummy_device_get_device_iface(device_iface_t *iface) {
     iface->get_register = get_register;
     iface->set_register = set_register;
     iface->reset = reset;
+    iface->destroy = destroy;
 }
@@ -2,4 +2,5 @@
 
 #include "API/device_api.h"
 
+// Creates a device instance in iface->ctx, freed by iface->destroy()
 void dummy_device_get_device_iface(device_iface_t *iface);
@@ -0,0 +1,230 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <stdint.h>
+#include <string.h>
+
+#include "interrupt_controller.h"
+#include "lib/log.h"
+
+typedef struct {
+    uint64_t due;       // Device time to raise the line at, 0 - not scheduled
+    uint32_t period;    // 0 - one shot
+} irq_event_t;
+
+struct interrupt_controller {
+    uint32_t pending;
+    uint32_t mask;
+    uint32_t sched_line;
+    uint32_t sched_period;
+    uint64_t time;
+    uint64_t skipped;
+    uint64_t next_due;  // Earliest irq_event_t.due, UINT64_MAX if nothing is scheduled
+    irq_event_t events[IRQ_NUM_LINES];
+};
+
+// Logs an error and returns 0 for the lines that can't be raised
+static int check_line(uint32_t line) {
+    if ((line == 0) || (line >= IRQ_NUM_LINES)) {
+        LOG_ERROR("Invalid interrupt line: %d\n", line);
+        return 0;
+    }
+    return 1;
+}
+
+static void update_next_due(interrupt_controller_t *state) {
+    state->next_due = UINT64_MAX;
+    for (uint32_t i=1; i<IRQ_NUM_LINES; i++) {
+        if (state->events[i].due && (state->events[i].due < state->next_due)) {
+            state->next_due = state->events[i].due;
+        }
+    }
+}
+
+static void raise_due_events(interrupt_controller_t *state) {
+    for (uint32_t i=1; i<IRQ_NUM_LINES; i++) {
+        irq_event_t *event = &state->events[i];
+        if (event->due && (event->due <= state->time)) {
+            state->pending |= 1 << i;
+            event->due = event->period? event->due + event->period: 0;
+        }
+    }
+    update_next_due(state);
+}
+
+static void schedule(interrupt_controller_t *state, uint32_t line, uint32_t delay, uint32_t period) {
+    if (!check_line(line)) {
+        return;
+    }
+    state->events[line].due = state->time + (delay? delay: 1);
+    state->events[line].period = period;
+    if (state->events[line].due < state->next_due) {
+        state->next_due = state->events[line].due;
+    }
+}
+
+static void init(void *ctx) {
+    interrupt_controller_t *state = ctx;
+    memset(state, 0, sizeof(*state));
+    state->next_due = UINT64_MAX;
+}
+
+static void tick(void *ctx) {
+    interrupt_controller_t *state = ctx;
+    state->time++;
+    if (state->time >= state->next_due) {
+        raise_due_events(state);
+    }
+}
+
+static uint32_t get_buf_size(void *ctx) {
+    return sizeof(interrupt_controller_t);
+}
+
+static void save_state(void *ctx, uint8_t *buf) {
+    memmove(buf, ctx, sizeof(interrupt_controller_t));
+}
+
+static void restore_state(void *ctx, uint8_t *buf) {
+    memmove(ctx, buf, sizeof(interrupt_controller_t));
+}
+
+static uint64_t next_wakeup(interrupt_controller_t *state) {
+    uint64_t wakeup = UINT64_MAX;
+    for (uint32_t i=1; i<IRQ_NUM_LINES; i++) {
+        if (state->events[i].due && !(state->mask & (1 << i)) && (state->events[i].due < wakeup)) {
+            wakeup = state->events[i].due;
+        }
+    }
+    return wakeup;
+}
+
+static void set_register(void *ctx, uint32_t reg_id, uint32_t value) {
+    interrupt_controller_t *state = ctx;
+    switch (reg_id) {
+        case IRQ_REG_PENDING:
+            state->pending = value & ~1;
+            break;
+        case IRQ_REG_MASK:
+            state->mask = value;
+            break;
+        case IRQ_REG_RAISE:
+            if (check_line(value)) {
+                state->pending |= 1 << value;
+            }
+            break;
+        case IRQ_REG_ACK:
+            interrupt_controller_acknowledge(state, value);
+            break;
+        case IRQ_REG_SCHED_LINE:
+            if (check_line(value)) {
+                state->sched_line = value;
+            }
+            break;
+        case IRQ_REG_SCHED_PERIOD:
+            state->sched_period = value;
+            break;
+        case IRQ_REG_SCHED_DELAY:
+            schedule(state, state->sched_line, value, state->sched_period);
+            break;
+        case IRQ_REG_CANCEL:
+            if (check_line(value)) {
+                state->events[value].due = 0;
+                update_next_due(state);
+            }
+            break;
+        default:
+            LOG_ERROR("Interrupt controller has no writable register 0x%X\n", reg_id);
+    }
+}
+
+static void get_register(void *ctx, uint32_t reg_id, uint32_t *value) {
+    interrupt_controller_t *state = ctx;
+    uint64_t wakeup;
+    switch (reg_id) {
+        case IRQ_REG_PENDING:
+            *value = state->pending;
+            break;
+        case IRQ_REG_MASK:
+            *value = state->mask;
+            break;
+        case IRQ_REG_ACTIVE:
+            *value = interrupt_controller_active(state);
+            break;
+        case IRQ_REG_SCHED_LINE:
+            *value = state->sched_line;
+            break;
+        case IRQ_REG_SCHED_PERIOD:
+            *value = state->sched_period;
+            break;
+        case IRQ_REG_NEXT_WAKEUP:
+            wakeup = next_wakeup(state);
+            *value = (wakeup == UINT64_MAX)? UINT32_MAX: (uint32_t)(wakeup - state->time);
+            break;
+        case IRQ_REG_TIME_LO:
+            *value = (uint32_t)state->time;
+            break;
+        case IRQ_REG_TIME_HI:
+            *value = (uint32_t)(state->time >> 32);
+            break;
+        case IRQ_REG_SKIPPED_LO:
+            *value = (uint32_t)state->skipped;
+            break;
+        case IRQ_REG_SKIPPED_HI:
+            *value = (uint32_t)(state->skipped >> 32);
+            break;
+        default:
+            LOG_ERROR("Interrupt controller has no readable register 0x%X\n", reg_id);
+            *value = 0;
+    }
+}
+
+static void reset(void *ctx) {
+    init(ctx);
+}
+
+static void destroy(void *ctx) {
+    free(ctx);
+}
+
+uint32_t interrupt_controller_active(interrupt_controller_t *state) {
+    uint32_t active = state->pending & ~state->mask;
+    if (active == 0) {
+        return 0;
+    }
+    return __builtin_ctz(active);
+}
+
+void interrupt_controller_acknowledge(interrupt_controller_t *state, uint32_t line) {
+    if (check_line(line)) {
+        state->pending &= ~(1 << line);
+    }
+}
+
+uint64_t interrupt_controller_sleep(interrupt_controller_t *state) {
+    if (state->pending & ~state->mask) {
+        return 0;
+    }
+    uint64_t wakeup = next_wakeup(state);
+    if (wakeup == UINT64_MAX) {
+        return IRQ_NO_WAKEUP;
+    }
+    uint64_t skipped = wakeup - state->time;
+    state->time = wakeup;
+    state->skipped += skipped;
+    raise_due_events(state);
+    return skipped;
+}
+
+void interrupt_controller_get_device_iface(device_iface_t *iface) {
+    iface->ctx = malloc(sizeof(interrupt_controller_t));
+    init(iface->ctx);
+    iface->init = init;
+    iface->tick = tick;
+    iface->get_buf_size = get_buf_size;
+    iface->save_state = save_state;
+    iface->restore_state = restore_state;
+    iface->get_register = get_register;
+    iface->set_register = set_register;
+    iface->reset = reset;
+    iface->destroy = destroy;
+}
@@ -0,0 +1,47 @@
+#pragma once
+
+#include <stdint.h>
+
+#include "API/device_api.h"
+
+#define IRQ_NUM_LINES   16          // Line 0 is the main function vector and can't be raised
+#define IRQ_NO_WAKEUP   UINT64_MAX  // interrupt_controller_sleep(): nothing can wake the CPU up
+
+/* Registers (set_register / get_register) */
+#define IRQ_REG_PENDING         0x00    // r/w: bit n set - line n is pending
+#define IRQ_REG_MASK            0x01    // r/w: bit n set - line n is masked
+#define IRQ_REG_RAISE           0x02    // w: line to raise
+#define IRQ_REG_ACK             0x03    // w: line to acknowledge
+#define IRQ_REG_ACTIVE          0x04    // r: lowest unmasked pending line, 0 if none
+#define IRQ_REG_SCHED_LINE      0x05    // r/w: line of the next IRQ_REG_SCHED_DELAY write
+#define IRQ_REG_SCHED_PERIOD    0x06    // r/w: period of the next IRQ_REG_SCHED_DELAY write, 0 - one shot
+#define IRQ_REG_SCHED_DELAY     0x07    // w: schedule IRQ_REG_SCHED_LINE to be raised in `value` ticks
+#define IRQ_REG_CANCEL          0x08    // w: line to unschedule
+#define IRQ_REG_NEXT_WAKEUP     0x09    // r: ticks to the next unmasked scheduled interrupt, 0xFFFFFFFF if none
+#define IRQ_REG_TIME_LO         0x0A    // r: device time in ticks, including the skipped ones
+#define IRQ_REG_TIME_HI         0x0B
+#define IRQ_REG_SKIPPED_LO      0x0C    // r: ticks skipped by interrupt_controller_sleep()
+#define IRQ_REG_SKIPPED_HI      0x0D
+
+typedef struct interrupt_controller interrupt_controller_t;
+
+// Creates a device instance in iface->ctx, freed by iface->destroy()
+void interrupt_controller_get_device_iface(device_iface_t *iface);
+
+/**
+ * @brief Returns the lowest unmasked pending line, 0 if there is none
+ */
+uint32_t interrupt_controller_active(interrupt_controller_t *irq);
+
+/**
+ * @brief Clears the pending bit of the line, called by the CPU when it enters the handler
+ */
+void interrupt_controller_acknowledge(interrupt_controller_t *irq, uint32_t line);
+
+/**
+ * @brief Called by the CPU on SLEEP: skips the time straight to the next scheduled unmasked interrupt
+ *
+ * @return Number of skipped ticks (0 if an interrupt is already pending) or IRQ_NO_WAKEUP if
+ *         nothing can wake the CPU up. The caller skips the same number of ticks on the clock.
+ */
+uint64_t interrupt_controller_sleep(interrupt_controller_t *irq);
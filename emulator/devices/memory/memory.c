@@ -16,42 +16,93 @@ typedef struct {
     uint32_t MEM_SIZE;
 } device_regs_t;
 
-device_regs_t regs;
-DATA_BUS_WIDTH *memory;
+struct memory {
+    device_regs_t regs;
+    DATA_BUS_WIDTH *memory;
+};
 
-DATA_BUS_WIDTH memory_read(uint32_t address) {
-    if(address < regs.MEM_SIZE) {
-        DATA_BUS_WIDTH val = memory[address];
+DATA_BUS_WIDTH memory_read(void *ctx, ADDR_BUS_WIDTH address) {
+    memory_t *mem = ctx;
+    if(address < mem->regs.MEM_SIZE) {
+        DATA_BUS_WIDTH val = mem->memory[address];
         return val;
     } else {
         RAISE("Error: Attempting to read from outside of memory! Addr: %d\n", address);
     }
 }
 
-void memory_write(ADDR_BUS_WIDTH address, DATA_BUS_WIDTH val) {
-    if(address < regs.MEM_SIZE) {
-        memory[address] = val;
+void memory_write(void *ctx, ADDR_BUS_WIDTH address, DATA_BUS_WIDTH val) {
+    memory_t *mem = ctx;
+    if(address < mem->regs.MEM_SIZE) {
+        mem->memory[address] = val;
     } else {
         RAISE("Error: Attempting to write outside of memory! Addr: %d\n", address);
     }
 }
 
-void memory_write_array(ADDR_BUS_WIDTH offset, uint32_t size, const DATA_BUS_WIDTH *data) {
-    if((offset+size) > regs.MEM_SIZE) {
-        RAISE("Error: Attempting to write data outside of the memory!\n");
+DATA_BUS_WIDTH *memory_get_buffer(memory_t *mem) {
+    return mem->memory;
+}
+
+uint32_t memory_get_size(memory_t *mem) {
+    return mem->regs.MEM_SIZE;
+}
+
+static int in_bounds(memory_t *mem, uint32_t offset, uint32_t size) {
+    return offset <= mem->regs.MEM_SIZE && size <= mem->regs.MEM_SIZE - offset;
+}
+
+int memory_write_array(memory_t *mem, uint32_t offset, uint32_t size, const DATA_BUS_WIDTH *data) {
+    if(!in_bounds(mem, offset, size)) {
+        return -1;
+    }
+    memcpy(&mem->memory[offset], data, size * sizeof(DATA_BUS_WIDTH));
+    return 0;
+}
+
+int memory_read_array(memory_t *mem, uint32_t offset, uint32_t size, DATA_BUS_WIDTH *data) {
+    if(!in_bounds(mem, offset, size)) {
+        return -1;
     }
-    for(uint32_t i=0; i<size; i++) {
-        memory[offset+i] = data[i];
+    memcpy(data, &mem->memory[offset], size * sizeof(DATA_BUS_WIDTH));
+    return 0;
+}
+
+int memory_fill(memory_t *mem, uint32_t offset, uint32_t size, DATA_BUS_WIDTH val) {
+    if(!in_bounds(mem, offset, size)) {
+        return -1;
+    }
+    memset(&mem->memory[offset], val, size * sizeof(DATA_BUS_WIDTH));
+    return 0;
+}
+
+int64_t memory_compare(memory_t *mem, uint32_t offset, uint32_t size, const DATA_BUS_WIDTH *data) {
+    if(!in_bounds(mem, offset, size)) {
+        return MEMORY_OUT_OF_BOUNDS;
     }
+    const DATA_BUS_WIDTH *cells = &mem->memory[offset];
+    if(memcmp(cells, data, size * sizeof(DATA_BUS_WIDTH)) == 0) {
+        return MEMORY_EQUAL;
+    }
+    uint32_t i = 0;
+    while(cells[i] == data[i]) {
+        i++;
+    }
+    return i;
+}
+
+memory_t *memory_init(uint32_t mem_size) {
+    memory_t *mem = calloc(1, sizeof(memory_t));
+    mem->regs.MEM_SIZE = mem_size;
+    mem->memory = (DATA_BUS_WIDTH*)calloc(mem->regs.MEM_SIZE, sizeof(DATA_BUS_WIDTH));
+    return mem;
 }
 
-void module_init(uint32_t mem_size) {
-    regs.MEM_SIZE = mem_size;
-    if(memory != NULL) free(memory);
-    fflush(stdout);
-    memory = (DATA_BUS_WIDTH*)calloc(regs.MEM_SIZE, sizeof(DATA_BUS_WIDTH));
+void memory_free(memory_t *mem) {
+    free(mem->memory);
+    free(mem);
 }
 
-void module_reset(void) {
-    memset(&regs, 0, sizeof(device_regs_t));
+void memory_reset(memory_t *mem) {
+    memset(mem->memory, 0, mem->regs.MEM_SIZE * sizeof(DATA_BUS_WIDTH));
 }
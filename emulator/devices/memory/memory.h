@@ -5,5 +5,28 @@
 #define ADDR_BUS_WIDTH uint16_t
 #define DATA_BUS_WIDTH uint8_t
 
-typedef DATA_BUS_WIDTH(mem_read_func_t) (ADDR_BUS_WIDTH);            // param: address, ret_val: read value
-typedef void   (mem_write_func_t)(ADDR_BUS_WIDTH, DATA_BUS_WIDTH);   // params: address, value to write
+typedef DATA_BUS_WIDTH(mem_read_func_t) (void*, ADDR_BUS_WIDTH);            // params: device instance, address; ret_val: read value
+typedef void   (mem_write_func_t)(void*, ADDR_BUS_WIDTH, DATA_BUS_WIDTH);   // params: device instance, address, value to write
+
+typedef struct memory memory_t;
+
+memory_t *memory_init(uint32_t mem_size);
+void memory_free(memory_t *mem);
+void memory_reset(memory_t *mem);     // Clears the content
+
+// mem_read_func_t / mem_write_func_t of the memory, ctx is a memory_t
+DATA_BUS_WIDTH memory_read(void *ctx, ADDR_BUS_WIDTH address);
+void memory_write(void *ctx, ADDR_BUS_WIDTH address, DATA_BUS_WIDTH val);
+
+DATA_BUS_WIDTH *memory_get_buffer(memory_t *mem);    // Backing store for memory_map_direct()
+uint32_t memory_get_size(memory_t *mem);
+
+#define MEMORY_EQUAL            (-1)    // memory_compare(): all the cells match
+#define MEMORY_OUT_OF_BOUNDS    (-2)    // memory_compare(): the block doesn't fit in the memory
+
+// Block transfers, return 0 or -1 if [offset, offset + size) doesn't fit in the memory
+int memory_write_array(memory_t *mem, uint32_t offset, uint32_t size, const DATA_BUS_WIDTH *data);
+int memory_read_array(memory_t *mem, uint32_t offset, uint32_t size, DATA_BUS_WIDTH *data);
+int memory_fill(memory_t *mem, uint32_t offset, uint32_t size, DATA_BUS_WIDTH val);
+// Returns the index of the first cell that differs from data, MEMORY_EQUAL or MEMORY_OUT_OF_BOUNDS
+int64_t memory_compare(memory_t *mem, uint32_t offset, uint32_t size, const DATA_BUS_WIDTH *data);
@@ -2,6 +2,71 @@ import ctypes
 import os
 import time
 
+# Reasons returned by wait_done(), XTAL_STOP_* in devices/clock/clock.h
+STOP_NONE = 0
+STOP_TICK_LIMIT = 1
+STOP_DEADLINE = 2
+STOP_PAUSED = 3
+
+# mem_read()/mem_write() memory spaces of the test DLL, MEMSPACE_* in tests/test_clock/main.c
+MEMSPACE_ROM = 0
+MEMSPACE_RAM = 1
+
+# Bus addresses of the memspaces in the test DLL, BUS_* in tests/test_clock/main.c
+BUS_ROM_BASE = 0x0000
+BUS_RAM_BASE = 0x1000
+
+# bus_*() errors, ADDRESS_DECODER_* in devices/address_decoder/address_decoder.h
+BUS_INVALID_RANGE = -1
+BUS_TABLE_FULL = -2
+BUS_OVERLAP = -3
+BUS_UNMAPPED = -4
+BUS_ACCESS_DENIED = -5
+
+# bus_map_direct() access rights, MEM_ACCESS_* in devices/address_decoder/address_decoder.h
+MEM_ACCESS_READ = 0x01
+MEM_ACCESS_WRITE = 0x02
+
+# set_register()/get_register() device ids of the test DLL, DEV_* in tests/test_clock/main.c
+DEV_DUMMY = 0
+DEV_CLOCK = 1
+DEV_IRQ = 2
+
+# irq_sleep() result when no interrupt can wake the CPU up, IRQ_NO_WAKEUP in devices/interrupt_controller
+IRQ_NO_WAKEUP = 2**64 - 1
+
+# mem_compare() results besides the index of the first difference
+MEM_EQUAL = -1
+MEM_OUT_OF_BOUNDS = -2
+
+DONE_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_uint32)
+
+
+class BusError(Exception):
+    """A bus access or mapping failed, code is the BUS_* error"""
+    def __init__(self, code, message):
+        super().__init__(f"{message} (error {code})")
+        self.code = code
+
+
+def c_buffer(data):
+    """Return (pointer, size) passing a bytes-like object to C without copying it.
+
+    bytes go through as they are, writable buffers (bytearray, memoryview,
+    array, NumPy) are wrapped with from_buffer(), read-only ones are copied once.
+    """
+    if isinstance(data, bytes):
+        return data, len(data)
+    if not isinstance(data, bytearray):
+        data = memoryview(data).cast('B')
+        if data.readonly:
+            data = bytes(data)
+            return data, len(data)
+    if not data:
+        return None, 0
+    return ctypes.byref(ctypes.c_char.from_buffer(data)), len(data)
+
+
 class DeviceLibraryWrapper:
     def __init__(self, dll_path):
         if not os.path.exists(dll_path):
@@ -9,88 +74,222 @@ class DeviceLibraryWrapper:
 
         self.lib = ctypes.CDLL(dll_path)
         self._setup_prototypes()
+        self.emu = None     # Emulator context handle, one per wrapper
 
     def _setup_prototypes(self):
         """Define argument and return types for the DLL functions."""
 
         self.lib.init.argtypes = []
-        self.lib.init.restype = None
+        self.lib.init.restype = ctypes.c_void_p
+
+        self.lib.init_with_clock.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.lib.init_with_clock.restype = ctypes.c_void_p
+
+        self.lib.destroy.argtypes = [ctypes.c_void_p]
+        self.lib.destroy.restype = None
         
-        self.lib.run.argtypes = []
+        self.lib.run.argtypes = [ctypes.c_void_p]
         self.lib.run.restype = None
         
-        self.lib.stop.argtypes = []
+        self.lib.stop.argtypes = [ctypes.c_void_p]
         self.lib.stop.restype = None
         
-        self.lib.reset.argtypes = []
+        self.lib.reset.argtypes = [ctypes.c_void_p]
         self.lib.reset.restype = None
 
-        self.lib.save_state.argtypes = [ctypes.c_char_p]
+        self.lib.save_state.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
         self.lib.save_state.restype = None
         
-        self.lib.restore_state.argtypes = [ctypes.c_char_p]
+        self.lib.restore_state.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
         self.lib.restore_state.restype = None
 
-        self.lib.step.argtypes = [ctypes.c_uint32]
+        self.lib.step.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
         self.lib.step.restype = None
 
-        self.lib.mem_write.argtypes = [ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint8)]
+        self.lib.set_tick_limit.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
+        self.lib.set_tick_limit.restype = None
+
+        self.lib.set_deadline.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        self.lib.set_deadline.restype = None
+
+        self.lib.set_done_callback.argtypes = [ctypes.c_void_p, DONE_CALLBACK]
+        self.lib.set_done_callback.restype = None
+
+        self.lib.wait_done.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        self.lib.wait_done.restype = ctypes.c_uint32
+
+        self.lib.irq_sleep.argtypes = [ctypes.c_void_p]
+        self.lib.irq_sleep.restype = ctypes.c_uint64
+
+        # Buffers are passed as c_void_p, which takes bytes and ctypes arrays without conversion
+        self.lib.mem_write.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_void_p]
         self.lib.mem_write.restype = None
         
-        self.lib.mem_read.argtypes = [ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint8)]
+        self.lib.mem_read.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_void_p]
         self.lib.mem_read.restype = None
 
+        self.lib.mem_fill.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint8]
+        self.lib.mem_fill.restype = None
+
+        self.lib.mem_compare.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_void_p]
+        self.lib.mem_compare.restype = ctypes.c_int64
+
+        self.lib.mem_map.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.POINTER(ctypes.POINTER(ctypes.c_uint8)), ctypes.POINTER(ctypes.c_uint32)]
+        self.lib.mem_map.restype = ctypes.c_int
+
+        self.lib.bus_read.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint8)]
+        self.lib.bus_read.restype = ctypes.c_int
+
+        self.lib.bus_write.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint8]
+        self.lib.bus_write.restype = ctypes.c_int
+
+        self.lib.bus_map_device.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32]
+        self.lib.bus_map_device.restype = ctypes.c_int
+
+        self.lib.bus_map_direct.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32]
+        self.lib.bus_map_direct.restype = ctypes.c_int
+
         # Register Access
-        self.lib.set_register.argtypes = [ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32]
+        self.lib.set_register.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32]
         self.lib.set_register.restype = None
         
         # get_register uses a pointer for the return value
-        self.lib.get_register.argtypes = [ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint32)]
+        self.lib.get_register.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint32)]
         self.lib.get_register.restype = None
 
-    def init(self):
-        self.lib.init()
+        self.lib.set_log_level.argtypes = [ctypes.c_uint32]
+        self.lib.set_log_level.restype = None
+
+    def init(self, freq: int = None, real_time: bool = True):
+        """freq: clock ticks per second, None: the DLL default clock"""
+        if freq is None:
+            self.emu = self.lib.init()
+        else:
+            self.emu = self.lib.init_with_clock(freq, int(real_time))
+
+    def destroy(self):
+        """Stop the clock thread and free the emulator context"""
+        self.lib.destroy(self.emu)
+        self.emu = None
 
     def save_state(self, filename: str):
-        self.lib.save_state(filename.encode('utf-8'))
+        self.lib.save_state(self.emu, filename.encode('utf-8'))
 
     def restore_state(self, filename: str):
-        self.lib.restore_state(filename.encode('utf-8'))
+        self.lib.restore_state(self.emu, filename.encode('utf-8'))
 
     def run(self):
-        self.lib.run()
+        self.lib.run(self.emu)
 
     def stop(self):
-        self.lib.stop()
+        self.lib.stop(self.emu)
 
     def step(self, num_steps: int = 1):
-        self.lib.step(num_steps)
+        self.lib.step(self.emu, num_steps)
 
     def reset(self):
-        self.lib.reset()
+        self.lib.reset(self.emu)
+
+    def set_tick_limit(self, ticks: int):
+        """Pause after ticks more ticks, 0: no limit"""
+        self.lib.set_tick_limit(self.emu, ticks)
+
+    def set_deadline(self, seconds: float):
+        """Pause once the wall clock time has passed, 0: no deadline"""
+        self.lib.set_deadline(self.emu, int(seconds * 1000))
+
+    def set_done_callback(self, callback):
+        """callback(reason) is called from the clock thread when a limit pauses the clock, None: no callback"""
+        # Keep a reference, ctypes doesn't and the DLL would call freed memory
+        self._done_callback = DONE_CALLBACK(lambda emu, reason: callback(reason)) if callback else DONE_CALLBACK()
+        self.lib.set_done_callback(self.emu, self._done_callback)
+
+    def wait_done(self, timeout: float = 0) -> int:
+        """Wait until the clock is paused, returns STOP_* (STOP_NONE on timeout), timeout 0: forever"""
+        return self.lib.wait_done(self.emu, int(timeout * 1000))
+
+    def irq_sleep(self) -> int:
+        """SLEEP: skip the paused clock to the next scheduled interrupt, returns the skipped ticks or IRQ_NO_WAKEUP"""
+        return self.lib.irq_sleep(self.emu)
 
-    def mem_write(self, memspace: int, offset: int, data: bytes):
-        # Convert python bytes to a ctypes array
-        data_len = len(data)
-        c_data = (ctypes.c_uint8 * data_len)(*data)
-        print(f"mem_write: {memspace = }, {offset = }, {data_len = }, {c_data = }")
-        self.lib.mem_write(memspace, offset, data_len, c_data)
+    def mem_write(self, memspace: int, offset: int, data):
+        """data: any bytes-like object, passed to the DLL without a copy"""
+        c_buf, length = c_buffer(data)
+        self.lib.mem_write(self.emu, memspace, offset, length, c_buf)
 
     def mem_read(self, memspace: int, offset: int, length: int) -> bytes:
-        # Create a buffer to receive data
-        buffer = (ctypes.c_uint8 * length)()
-        print(f"mem_write: {memspace = }, {offset = }, {length = }, {buffer = }")
-        self.lib.mem_read(memspace, offset, length, buffer)
-        return bytes(buffer)
+        buffer = ctypes.create_string_buffer(length)
+        self.lib.mem_read(self.emu, memspace, offset, length, buffer)
+        return buffer.raw
+
+    def mem_read_into(self, memspace: int, offset: int, buffer):
+        """Fill a preallocated writable buffer (bytearray, memoryview...) from the emulator memory"""
+        c_buf, length = c_buffer(buffer)
+        if isinstance(c_buf, bytes):
+            raise TypeError("mem_read_into() needs a writable buffer")
+        self.lib.mem_read(self.emu, memspace, offset, length, c_buf)
+        return buffer
+
+    def mem_fill(self, memspace: int, offset: int, length: int, value: int = 0):
+        self.lib.mem_fill(self.emu, memspace, offset, length, value)
+
+    def mem_compare(self, memspace: int, offset: int, data: bytes) -> int:
+        """Index of the first byte differing from data, MEM_EQUAL or MEM_OUT_OF_BOUNDS"""
+        c_buf, length = c_buffer(data)
+        return self.lib.mem_compare(self.emu, memspace, offset, length, c_buf)
+
+    def mem_view(self, memspace: int) -> memoryview:
+        """Writable memoryview aliasing the emulator memory, valid until destroy().
+
+        np.frombuffer(view, dtype=np.uint8) turns it into a NumPy array without a copy.
+        """
+        ptr = ctypes.POINTER(ctypes.c_uint8)()
+        length = ctypes.c_uint32()
+        if self.lib.mem_map(self.emu, memspace, ctypes.byref(ptr), ctypes.byref(length)):
+            raise ValueError(f"Unknown memspace {memspace}")
+        buffer = (ctypes.c_uint8 * length.value).from_address(ctypes.addressof(ptr.contents))
+        return memoryview(buffer).cast('B')
+
+    def bus_read(self, address: int) -> int:
+        """CPU side read through the address decoder, raises BusError"""
+        value = ctypes.c_uint8()
+        error = self.lib.bus_read(self.emu, address, ctypes.byref(value))
+        if error:
+            raise BusError(error, f"Bus read at 0x{address:X} failed")
+        return value.value
+
+    def bus_write(self, address: int, value: int):
+        """CPU side write through the address decoder, raises BusError"""
+        error = self.lib.bus_write(self.emu, address, value)
+        if error:
+            raise BusError(error, f"Bus write at 0x{address:X} failed")
+
+    def bus_map_device(self, memspace: int, addr_start: int, addr_end: int) -> int:
+        """Map [addr_start, addr_end] to the memspace through its device callbacks, returns the map entry index"""
+        entry = self.lib.bus_map_device(self.emu, memspace, addr_start, addr_end)
+        if entry < 0:
+            raise BusError(entry, f"Couldn't map memspace {memspace} at [0x{addr_start:X}, 0x{addr_end:X}]")
+        return entry
+
+    def bus_map_direct(self, memspace: int, addr_start: int, addr_end: int, access: int) -> int:
+        """Map [addr_start, addr_end] to the memspace backing store with the MEM_ACCESS_* rights, returns the map entry index"""
+        entry = self.lib.bus_map_direct(self.emu, memspace, addr_start, addr_end, access)
+        if entry < 0:
+            raise BusError(entry, f"Couldn't map memspace {memspace} at [0x{addr_start:X}, 0x{addr_end:X}]")
+        return entry
 
     def set_register(self, dev_id: int, reg_id: int, value: int):
-        self.lib.set_register(dev_id, reg_id, value)
+        self.lib.set_register(self.emu, dev_id, reg_id, value)
 
     def get_register(self, dev_id: int, reg_id: int) -> int:
         value = ctypes.c_uint32()
-        self.lib.get_register(dev_id, reg_id, ctypes.byref(value))
+        self.lib.get_register(self.emu, dev_id, reg_id, ctypes.byref(value))
         return value.value
 
+    def set_log_level(self, level: int):
+        """level: LOG_LEVEL_* from lib/log.h, 0 (trace) ... 5 (none)"""
+        self.lib.set_log_level(level)
+
 
 if __name__ == "__main__":
     device = DeviceLibraryWrapper("bin/executables/libtest_clock_dll.dll")
@@ -113,3 +312,4 @@ if __name__ == "__main__":
     device.run()
     time.sleep(5)
     device.stop()
+    device.destroy()
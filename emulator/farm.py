@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Regression farm: runs ROM images against their expected output on a process pool.
+#
+# The manifest holds one JSON job per line:
+#   {"name": "uart_hello", "rom": "roms/hello.bin", "expected": "roms/hello.out"}
+# Optional job fields: "max_steps" (overrides --max-steps), and for the DLL backend:
+# "state" (a save_state() file restored after loading the ROM, it holds the
+# device registers but not the memory), "load_memspace" (where the ROM is
+# loaded, MEMSPACE_ROM by default, the rest of the memspace is cleared),
+# "result_memspace" and "result_offset" (where the output is read back from,
+# MEMSPACE_RAM at 0 by default).
+# Relative paths are resolved against the manifest directory.
+#
+# Each worker process builds its machine once (emul4b.CPU or the DLL through
+# DeviceLibraryWrapper) and resets it between jobs. Results are printed as JSON
+# lines in completion order.
+
+BACKEND_PY = "py"
+BACKEND_DLL = "dll"
+
+# Seconds a DLL job may run before it is stopped with the "deadline" reason (--timeout)
+DLL_TIMEOUT = 60
+
+# The DLL clock runs unthrottled in the farm, so a job takes as long as its ticks and
+# not max_steps seconds of the 1 Hz real time default clock
+DLL_FREQ = 1000000
+
+_machine = None     # Per worker process, built by init_worker()
+
+
+class PyMachine:
+    """emul4b.CPU backend, the output is the UART byte stream"""
+    def __init__(self):
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import emul4b
+        self.cpu = emul4b.CPU()
+
+    def run(self, job, max_steps):
+        with open(job["rom"], 'rb') as f:
+            self.cpu.reset(f.read())
+        reason = self.cpu.run(max_steps)
+        return reason, self.cpu.instret, bytes(self.cpu.uart)
+
+
+class DLLMachine:
+    """C core backend, the output is read back from the emulator memory"""
+    def __init__(self, dll_path, timeout=DLL_TIMEOUT):
+        from dll_wrapper import DeviceLibraryWrapper, STOP_TICK_LIMIT, STOP_DEADLINE, STOP_PAUSED, MEMSPACE_ROM, MEMSPACE_RAM
+        self.timeout = timeout
+        self.load_memspace = MEMSPACE_ROM
+        self.result_memspace = MEMSPACE_RAM
+        self.tick_limit_reason = STOP_TICK_LIMIT
+        self.reasons = {STOP_TICK_LIMIT: "tick_limit", STOP_DEADLINE: "deadline", STOP_PAUSED: "paused"}
+        self.device = DeviceLibraryWrapper(dll_path)
+        self.device.init(DLL_FREQ, real_time=False)
+
+    def run(self, job, max_steps, expected_len):
+        device = self.device
+        device.reset()
+        load_memspace = job.get("load_memspace", self.load_memspace)
+        with open(job["rom"], 'rb') as f:
+            rom = f.read()
+        # reset() keeps the ROM, clear what the previous job's image left after this one
+        device.mem_write(load_memspace, 0, rom)
+        device.mem_fill(load_memspace, len(rom), len(device.mem_view(load_memspace)) - len(rom))
+        if "state" in job:
+            device.restore_state(job["state"])
+        device.set_tick_limit(max_steps)
+        device.set_deadline(self.timeout)
+        device.run()
+        reason = device.wait_done()
+        device.set_tick_limit(0)
+        device.set_deadline(0)
+        output = device.mem_read(job.get("result_memspace", self.result_memspace), job.get("result_offset", 0), expected_len)
+        steps = max_steps if reason == self.tick_limit_reason else None
+        return self.reasons.get(reason, "timeout"), steps, output
+
+
+def init_worker(backend, dll_path, timeout):
+    global _machine
+    # Anything the workers (or the DLL) print goes to stderr, stdout only carries results
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    _machine = DLLMachine(dll_path, timeout) if backend == BACKEND_DLL else PyMachine()
+
+
+def run_job(job, max_steps):
+    """Run one job in a worker process and return its result record"""
+    start = time.perf_counter()
+    result = {"name": job["name"], "pid": os.getpid()}
+    try:
+        with open(job["expected"], 'rb') as f:
+            expected = f.read()
+        max_steps = job.get("max_steps", max_steps)
+        if isinstance(_machine, DLLMachine):
+            reason, steps, output = _machine.run(job, max_steps, len(expected))
+        else:
+            reason, steps, output = _machine.run(job, max_steps)
+        result.update(passed=output == expected, reason=reason, steps=steps, output=output.hex())
+    except Exception as e:
+        result.update(passed=False, error=f"{type(e).__name__}: {e}")
+    result["elapsed"] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def load_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            for key in ("rom", "expected", "state"):
+                if key in job:
+                    job[key] = os.path.join(base, job[key])
+            job.setdefault("name", f"{os.path.basename(path)}:{line_no}")
+            jobs.append(job)
+    return jobs
+
+
+def run_farm(jobs, backend=BACKEND_PY, dll_path=None, workers=None, max_steps=1000000, out=sys.stdout,
+             timeout=DLL_TIMEOUT):
+    """Run the jobs on a pool of workers, streaming results to out, returns the number of failures"""
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(backend, dll_path, timeout)) as pool:
+        futures = {pool.submit(run_job, job, max_steps): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:  # The worker died (BrokenProcessPool) or the result didn't pickle
+                result = {"name": futures[future]["name"], "passed": False, "error": f"{type(e).__name__}: {e}"}
+            failures += not result["passed"]
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ROM images against their expected output in parallel")
+    parser.add_argument("manifest", type=str, help="JSON lines file, one job per line")
+    parser.add_argument("--backend", choices=[BACKEND_PY, BACKEND_DLL], default=BACKEND_PY, help="Emulator used by the workers")
+    parser.add_argument("--dll", type=str, default="bin/executables/libtest_clock_dll.dll", help="Emulator library for the dll backend")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to the number of CPUs")
+    parser.add_argument("--max-steps", type=int, default=1000000, help="Instruction (or tick) budget per job")
+    parser.add_argument("--timeout", type=float, default=DLL_TIMEOUT, help="Seconds a dll backend job may run")
+    args = parser.parse_args()
+    if args.backend == BACKEND_DLL:
+        args.dll = os.path.abspath(args.dll)    # Workers may not share our working directory
+    failures = run_farm(load_manifest(args.manifest), args.backend, args.dll, args.workers, args.max_steps,
+                        timeout=args.timeout)
+    sys.exit(1 if failures else 0)
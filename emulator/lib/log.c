@@ -0,0 +1,20 @@
+#include <stdio.h>
+#include <stdarg.h>
+
+#include "log.h"
+
+uint32_t log_level = LOG_DEFAULT_LEVEL;
+
+void log_set_level(uint32_t level) {
+    log_level = level > LOG_LEVEL_NONE? LOG_LEVEL_NONE: level;
+}
+
+void log_print(uint32_t level, const char *fmt, ...) {
+    va_list args;
+    va_start(args, fmt);
+    vprintf(fmt, args);
+    va_end(args);
+    if (level >= LOG_LEVEL_ERROR) {
+        fflush(stdout);
+    }
+}
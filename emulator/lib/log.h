@@ -0,0 +1,37 @@
+#pragma once
+
+#include <stdint.h>
+
+/* Levels: a message is printed if its level is >= LOG_MIN_LEVEL (compile time) and
+   >= the runtime level set with log_set_level(). Calls below LOG_MIN_LEVEL are
+   removed by the compiler, calls below the runtime level cost one compare and don't
+   evaluate their arguments. */
+#define LOG_LEVEL_TRACE     0   // Per tick / per access messages
+#define LOG_LEVEL_DEBUG     1   // State transitions
+#define LOG_LEVEL_INFO      2
+#define LOG_LEVEL_WARNING   3
+#define LOG_LEVEL_ERROR     4
+#define LOG_LEVEL_NONE      5
+
+#ifndef LOG_MIN_LEVEL
+    #define LOG_MIN_LEVEL LOG_LEVEL_TRACE
+#endif
+
+#define LOG_DEFAULT_LEVEL LOG_LEVEL_WARNING
+
+extern uint32_t log_level;
+
+void log_set_level(uint32_t level);
+void log_print(uint32_t level, const char *fmt, ...) __attribute__((format(printf, 2, 3)));
+
+#define LOG(level, fmt, ...) do { \
+        if (((level) >= LOG_MIN_LEVEL) && __builtin_expect((level) >= log_level, 0)) { \
+            log_print(level, fmt, ##__VA_ARGS__); \
+        } \
+    } while (0)
+
+#define LOG_TRACE(fmt, ...)     LOG(LOG_LEVEL_TRACE, fmt, ##__VA_ARGS__)
+#define LOG_DEBUG(fmt, ...)     LOG(LOG_LEVEL_DEBUG, fmt, ##__VA_ARGS__)
+#define LOG_INFO(fmt, ...)      LOG(LOG_LEVEL_INFO, fmt, ##__VA_ARGS__)
+#define LOG_WARNING(fmt, ...)   LOG(LOG_LEVEL_WARNING, fmt, ##__VA_ARGS__)
+#define LOG_ERROR(fmt, ...)     LOG(LOG_LEVEL_ERROR, fmt, ##__VA_ARGS__)
@@ -4,55 +4,113 @@
 #include "clock/clock.h"
 #include "API/emulator_api.h"
 #include "API/device_api.h"
+#include "lib/log.h"
 
 // Devices:
 #include "clock/clock.h"
 #include "dummy/dummy.h"
+#include "memory/memory.h"
+#include "interrupt_controller/interrupt_controller.h"
+#include "address_decoder/address_decoder.h"
 
 #define MAX_DEV_NUM 128
 
-static device_iface_t *devices[MAX_DEV_NUM];
-static uint32_t num_devices;
+// Device ids of set_register() / get_register()
+#define DEV_DUMMY       0
+#define DEV_CLOCK       1
+#define DEV_IRQ         2
+
+// Memory spaces of mem_read() / mem_write()
+#define MEMSPACE_ROM    0
+#define MEMSPACE_RAM    1
+#define NUM_MEMSPACES   2
+#define ROM_SIZE        0x1000
+#define RAM_SIZE        0x1000
+
+// Bus addresses of the memspaces, see bus_read() / bus_write()
+#define BUS_ROM_BASE    0x0000
+#define BUS_RAM_BASE    0x1000
+
+struct emulator {
+    xtal_t *clock;
+    device_iface_t *devices[MAX_DEV_NUM];
+    uint32_t num_devices;
+    memory_t *memspaces[NUM_MEMSPACES];
+    address_decoder_t *bus;
+    void (*done_callback)(emulator_t*, uint32_t);
+};
 
 typedef struct {
     uint32_t size;
     uint8_t data[0];
 } device_state_t;
 
-uint8_t memory[128];
+emulator_t *init(void) {
+    return init_with_clock(1, 1);
+}
 
-void init(void) {
-    init_clock(1, 1);
-    devices[0] = calloc(1, sizeof(device_iface_t));
-    dummy_device_get_device_iface(devices[0]);
-    int device_id = clock_add_device(devices[0]->tick, 1);
-    printf("Dummy device id: %d\n", device_id);
-    num_devices++;
+emulator_t *init_with_clock(int freq, int real_time_mode) {
+    emulator_t *emu = calloc(1, sizeof(emulator_t));
+    emu->clock = init_clock(freq, real_time_mode);
+    emu->devices[DEV_DUMMY] = calloc(1, sizeof(device_iface_t));
+    dummy_device_get_device_iface(emu->devices[DEV_DUMMY]);
+    int device_id = clock_add_device(emu->clock, emu->devices[DEV_DUMMY]->tick, emu->devices[DEV_DUMMY]->ctx, 1);
+    LOG_INFO("Dummy device id: %d\n", device_id);
+    emu->num_devices++;
+    emu->devices[DEV_CLOCK] = calloc(1, sizeof(device_iface_t));   // Scheduler stats
+    clock_get_device_iface(emu->clock, emu->devices[DEV_CLOCK]);
+    emu->num_devices++;
+    emu->devices[DEV_IRQ] = calloc(1, sizeof(device_iface_t));
+    interrupt_controller_get_device_iface(emu->devices[DEV_IRQ]);
+    device_id = clock_add_device(emu->clock, emu->devices[DEV_IRQ]->tick, emu->devices[DEV_IRQ]->ctx, 1);
+    LOG_INFO("Interrupt controller device id: %d\n", device_id);
+    emu->num_devices++;
+    emu->memspaces[MEMSPACE_ROM] = memory_init(ROM_SIZE);
+    emu->memspaces[MEMSPACE_RAM] = memory_init(RAM_SIZE);
+    emu->bus = address_decoder_init();
+    bus_map_direct(emu, MEMSPACE_ROM, BUS_ROM_BASE, BUS_ROM_BASE + ROM_SIZE - 1, MEM_ACCESS_READ);
+    bus_map_direct(emu, MEMSPACE_RAM, BUS_RAM_BASE, BUS_RAM_BASE + RAM_SIZE - 1, MEM_ACCESS_READ | MEM_ACCESS_WRITE);
+    return emu;
+}
+
+void destroy(emulator_t *emu) {
+    free_clock(emu->clock);     // Stops the clock thread before the devices go away
+    for(int i=0; i<emu->num_devices; i++) {
+        emu->devices[i]->destroy(emu->devices[i]->ctx);
+        free(emu->devices[i]);
+    }
+    for(int i=0; i<NUM_MEMSPACES; i++) {
+        memory_free(emu->memspaces[i]);
+    }
+    address_decoder_free(emu->bus);
+    free(emu);
 }
 
-void save_state(char *filename) {
-    uint32_t buf_size = sizeof(num_devices);
+void save_state(emulator_t *emu, char *filename) {
+    uint32_t buf_size = sizeof(emu->num_devices);
     uint8_t *buf = malloc(buf_size);
-    memmove(buf, &num_devices, sizeof(num_devices));
-    for(int i=0; i<num_devices; i++) {
-        uint32_t buf_size_inc = sizeof(device_state_t) + devices[0]->get_buf_size();
+    memmove(buf, &emu->num_devices, sizeof(emu->num_devices));
+    for(int i=0; i<emu->num_devices; i++) {
+        uint32_t buf_size_inc = sizeof(device_state_t) + emu->devices[i]->get_buf_size(emu->devices[i]->ctx);
         buf = realloc(buf, buf_size+buf_size_inc);
-        device_state_t *dev_state = (device_state_t *)&buf[buf_size+1];
-        devices[i]->save_state(dev_state->data);
+        device_state_t *dev_state = (device_state_t *)&buf[buf_size];
+        dev_state->size = buf_size_inc;     // Whole record, restore_state() skips by it
+        emu->devices[i]->save_state(emu->devices[i]->ctx, dev_state->data);
         buf_size += buf_size_inc;
     }
 
     FILE *fptr;
     if ((fptr = fopen(filename, "wb")) == NULL) {
-        printf("Error! opening file");
-        exit(1);
+        LOG_ERROR("Couldn't open %s\n", filename);
+        free(buf);
+        return;
     }
     fwrite(buf, 1, buf_size, fptr);
     fclose(fptr);
     free(buf);
 }
 
-void restore_state(char *filename) {
+void restore_state(emulator_t *emu, char *filename) {
     FILE *file_ptr;
     unsigned char *buffer;
     long file_len;
@@ -82,61 +140,182 @@ void restore_state(char *filename) {
         return;
     }
 
-    printf("Read %ld bytes from file. Contents:\n", file_len);
+    LOG_DEBUG("Read %ld bytes from file. Contents:\n", file_len);
 
-    num_devices = ((uint32_t*)buffer)[0];
+    if ((file_len < sizeof(uint32_t)) || (((uint32_t*)buffer)[0] != emu->num_devices)) {
+        LOG_ERROR("%s doesn't hold the state of %d devices\n", filename, emu->num_devices);
+        free(buffer);
+        fclose(file_ptr);
+        return;
+    }
     uint32_t offset = sizeof(uint32_t);
-    for (int i = 0; i < num_devices; i++) {
+    for (int i = 0; i < emu->num_devices; i++) {
         device_state_t *buf = (device_state_t*)&buffer[offset];
-        offset += buf->size;
-        devices[i]->restore_state(buf->data);
+        uint32_t size = sizeof(device_state_t) + emu->devices[i]->get_buf_size(emu->devices[i]->ctx);
+        if ((offset + size > file_len) || (buf->size != size)) {
+            LOG_ERROR("%s: bad state record of device %d\n", filename, i);
+            break;
+        }
+        offset += size;
+        emu->devices[i]->restore_state(emu->devices[i]->ctx, buf->data);
     }
     free(buffer);
     fclose(file_ptr);
 }
 
-void run(void) {
-    xtal_run();
+void run(emulator_t *emu) {
+    xtal_run(emu->clock);
 }
 
-void stop(void) {
-    xtal_pause();
+void stop(emulator_t *emu) {
+    xtal_pause(emu->clock);
 }
 
-void step(uint32_t num_steps) {
-    xtal_step(num_steps);
+void step(emulator_t *emu, uint32_t num_steps) {
+    xtal_step(emu->clock, num_steps);
 }
 
-void reset(void) {
-    for(int i=0; i<num_devices; i++) {
-        devices[i]->reset();
+void set_tick_limit(emulator_t *emu, uint64_t ticks) {
+    xtal_set_tick_limit(emu->clock, ticks);
+}
+
+void set_deadline(emulator_t *emu, uint32_t ms) {
+    xtal_set_deadline(emu->clock, ms);
+}
+
+static void done_callback(void *arg, uint32_t reason) {
+    emulator_t *emu = arg;
+    emu->done_callback(emu, reason);
+}
+
+void set_done_callback(emulator_t *emu, void (*callback)(emulator_t *emu, uint32_t reason)) {
+    emu->done_callback = callback;
+    xtal_set_done_callback(emu->clock, callback? done_callback: NULL, emu);
+}
+
+uint32_t wait_done(emulator_t *emu, uint32_t timeout_ms) {
+    return xtal_wait(emu->clock, timeout_ms);
+}
+
+uint64_t irq_sleep(emulator_t *emu) {
+    uint64_t skipped = interrupt_controller_sleep(emu->devices[DEV_IRQ]->ctx);
+    if (skipped != IRQ_NO_WAKEUP) {
+        clock_skip_ticks(emu->clock, skipped);
+    }
+    return skipped;
+}
+
+void reset(emulator_t *emu) {
+    for(int i=0; i<emu->num_devices; i++) {
+        emu->devices[i]->reset(emu->devices[i]->ctx);
     }
+    memory_reset(emu->memspaces[MEMSPACE_RAM]);     // The ROM keeps its image
 }
 
-void mem_write(uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data) {
-    printf("Memspace %d: Writing %d bytes to offset 0x%X, addr: 0x%X\n", memspace, len, offset, data);
-    for(int i=0; i<len; i++) {
-        memory[offset+i] = data[i];
+static memory_t *get_memspace(emulator_t *emu, uint32_t memspace) {
+    if(memspace >= NUM_MEMSPACES) {
+        LOG_ERROR("Unknown memspace %d\n", memspace);
+        return NULL;
     }
+    return emu->memspaces[memspace];
 }
 
-void mem_read(uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data) {
-    printf("Memspace %d: Reading %d bytes from offset 0x%X, addr: 0x%X\n", memspace, len, offset, data);
-    for(int i=0; i<len; i++) {
-        data[i] = memory[offset+i];
+void mem_write(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data) {
+    LOG_TRACE("Memspace %d: Writing %d bytes to offset 0x%X, addr: %p\n", memspace, len, offset, data);
+    memory_t *mem = get_memspace(emu, memspace);
+    if(mem && memory_write_array(mem, offset, len, data)) {
+        LOG_ERROR("Memspace %d: Write of %d bytes at 0x%X is out of bounds\n", memspace, len, offset);
     }
 }
 
-void set_register(uint32_t dev_id, uint32_t reg_id, uint32_t value) {
-    printf("Device %d: Writing to register 0x%X: 0x%X\n", dev_id, reg_id, value);
-    if (devices[dev_id]) {
-        devices[dev_id]->set_register(reg_id, value);
+void mem_read(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data) {
+    LOG_TRACE("Memspace %d: Reading %d bytes from offset 0x%X, addr: %p\n", memspace, len, offset, data);
+    memory_t *mem = get_memspace(emu, memspace);
+    if(mem && memory_read_array(mem, offset, len, data)) {
+        LOG_ERROR("Memspace %d: Read of %d bytes at 0x%X is out of bounds\n", memspace, len, offset);
+    }
+}
+
+void mem_fill(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t value) {
+    memory_t *mem = get_memspace(emu, memspace);
+    if(mem && memory_fill(mem, offset, len, value)) {
+        LOG_ERROR("Memspace %d: Fill of %d bytes at 0x%X is out of bounds\n", memspace, len, offset);
+    }
+}
+
+int64_t mem_compare(emulator_t *emu, uint32_t memspace, uint32_t offset, uint32_t len, uint8_t *data) {
+    memory_t *mem = get_memspace(emu, memspace);
+    return mem? memory_compare(mem, offset, len, data): MEMORY_OUT_OF_BOUNDS;
+}
+
+int mem_map(emulator_t *emu, uint32_t memspace, uint8_t **ptr, uint32_t *len) {
+    memory_t *mem = get_memspace(emu, memspace);
+    *ptr = mem? memory_get_buffer(mem): NULL;
+    *len = mem? memory_get_size(mem): 0;
+    return mem? 0: -1;
+}
+
+// The memspace must cover the whole range, the memory device doesn't check the addresses it gets
+static int check_bus_range(memory_t *mem, uint32_t addr_start, uint32_t addr_end) {
+    if(!mem || addr_start > addr_end || addr_end - addr_start >= memory_get_size(mem)) {
+        return ADDRESS_DECODER_INVALID_RANGE;
+    }
+    return 0;
+}
+
+int bus_map_device(emulator_t *emu, uint32_t memspace, uint32_t addr_start, uint32_t addr_end) {
+    memory_t *mem = get_memspace(emu, memspace);
+    int ret = check_bus_range(mem, addr_start, addr_end);
+    if(ret == 0) {
+        ret = memory_map_device(emu->bus, addr_start, addr_end, memory_read, memory_write, mem);
+    }
+    if(ret < 0) {
+        LOG_ERROR("Memspace %d: Couldn't map it at [0x%X, 0x%X]: error %d\n", memspace, addr_start, addr_end, ret);
+    }
+    return ret;
+}
+
+int bus_map_direct(emulator_t *emu, uint32_t memspace, uint32_t addr_start, uint32_t addr_end, uint32_t access) {
+    memory_t *mem = get_memspace(emu, memspace);
+    int ret = check_bus_range(mem, addr_start, addr_end);
+    if(ret == 0) {
+        ret = memory_map_direct(emu->bus, addr_start, addr_end, memory_get_buffer(mem), access);
+    }
+    if(ret < 0) {
+        LOG_ERROR("Memspace %d: Couldn't map it at [0x%X, 0x%X]: error %d\n", memspace, addr_start, addr_end, ret);
+    }
+    return ret;
+}
+
+int bus_read(emulator_t *emu, uint32_t address, uint8_t *val) {
+    LOG_TRACE("Bus: Reading from 0x%X\n", address);
+    return address_decoder_read(emu->bus, address, val);
+}
+
+int bus_write(emulator_t *emu, uint32_t address, uint8_t val) {
+    LOG_TRACE("Bus: Writing to 0x%X: 0x%X\n", address, val);
+    return address_decoder_write(emu->bus, address, val);
+}
+
+void set_log_level(uint32_t level) {
+    log_set_level(level);
+}
+
+void set_register(emulator_t *emu, uint32_t dev_id, uint32_t reg_id, uint32_t value) {
+    LOG_TRACE("Device %d: Writing to register 0x%X: 0x%X\n", dev_id, reg_id, value);
+    if (dev_id >= emu->num_devices) {
+        LOG_ERROR("Unknown device %d\n", dev_id);
+    } else {
+        emu->devices[dev_id]->set_register(emu->devices[dev_id]->ctx, reg_id, value);
     }
 }
 
-void get_register(uint32_t dev_id, uint32_t reg_id, uint32_t *value) {
-    if (devices[dev_id]) {
-        devices[dev_id]->get_register(reg_id, value);
+void get_register(emulator_t *emu, uint32_t dev_id, uint32_t reg_id, uint32_t *value) {
+    if (dev_id >= emu->num_devices) {
+        LOG_ERROR("Unknown device %d\n", dev_id);
+        *value = 0;
+    } else {
+        emu->devices[dev_id]->get_register(emu->devices[dev_id]->ctx, reg_id, value);
     }
-    printf("Device %d: Reading from register 0x%X: 0x%X\n", dev_id, reg_id, *value);
+    LOG_TRACE("Device %d: Reading from register 0x%X: 0x%X\n", dev_id, reg_id, *value);
 }
@@ -0,0 +1,367 @@
+import argparse
+import heapq
+import sys
+import time
+
+# Reference interpreter for the 4-bit BrainFuck-style ISA described at the top of Readme.md.
+#
+# The program is 256 bytes: 0x00 holds the main function pointer, 0x01-0x0F the
+# interrupt handler pointers and code starts at 0x10. The data tape holds 4-bit cells.
+# Jump offsets are signed 6-bit values relative to the next instruction.
+#
+# Loops of the form "JZ end / body / JNZ start" whose body only uses INC/DEC/PINC/PDEC/ZERO
+# are recognised when the program is loaded and executed as single bulk operations:
+#   clear loops  [-]        the cell is zeroed
+#   move loops   [->+>++<<] the loop cell is added, multiplied, to the other cells
+#                           (cells cleared with ZERO in the body are just set)
+#   scan loops   [>]        the pointer jumps to the next zero cell
+# Bulk operations account for every instruction the loop would have executed, so
+# step counts and instret are identical with and without acceleration.
+#
+# Simulated time is counted in cycles, one per executed instruction. Interrupt lines
+# 1-15 are driven by an InterruptController: when SLEEP is executed with no interrupt
+# pending, the time is skipped straight to the next scheduled interrupt instead of
+# being spent on idle cycles.
+
+TAPE_SIZE = 0x100
+PROGRAM_SIZE = 0x100
+CELL_MASK = 0x0F
+UART_MSB_PORT = 0x00
+UART_LSB_PORT = 0x01
+
+K_SLEEP, K_ZERO, K_RET, K_IN, K_OUT, K_INC, K_DEC, K_PINC, K_PDEC, K_JZ, K_JNZ = range(11)
+K_NAMES = ["SLEEP", "ZERO", "RET", "IN", "OUT", "INC", "DEC", "PINC", "PDEC", "JZ", "JNZ"]
+
+LOOP_CLEAR, LOOP_MOVE, LOOP_SCAN = range(3)
+
+NUM_IRQS = 0x10        # Line 0 is the main function pointer and can't be raised
+
+# run() stop reasons
+STOP_HALT = "halt"      # RET without an interrupt to return from
+STOP_SLEEP = "sleep"    # SLEEP with nothing that could wake the CPU up
+STOP_BUDGET = "budget"
+
+
+def decode(byte, pc):
+    """Return (kind, argument, jump target) of one instruction"""
+    high = byte >> 4
+    if high == 0x0:
+        return (K_ZERO if byte & 1 else K_SLEEP, 0, 0)
+    if high == 0x1:
+        return (K_RET, 0, 0)
+    if high < 0x8:
+        return (K_IN + high - 0x2, byte & 0x0F, 0)
+    offset = byte & 0x3F
+    if offset & 0x20:
+        offset -= 0x40
+    return (K_JZ if high < 0xC else K_JNZ, 0, (pc + 1 + offset) & (PROGRAM_SIZE - 1))
+
+
+class InterruptController:
+    """Pending and mask state of the interrupt lines plus a scheduler of timed interrupts"""
+    def __init__(self):
+        self.pending = 0
+        self.mask = 0   # Bit n set: line n is masked
+        self.events = []    # Heap of (due cycle, sequence number, line, period)
+        self.sequence = 0
+
+    def raise_irq(self, line):
+        if not 0 < line < NUM_IRQS:
+            raise ValueError(f"Invalid interrupt line: {line}")
+        self.pending |= 1 << line
+
+    def schedule(self, line, due, period=0):
+        """Raise line at cycle due, and then every period cycles if period is set"""
+        if not 0 < line < NUM_IRQS:
+            raise ValueError(f"Invalid interrupt line: {line}")
+        heapq.heappush(self.events, (due, self.sequence, line, period))
+        self.sequence += 1
+
+    def cancel(self, line):
+        self.events = [event for event in self.events if event[2] != line]
+        heapq.heapify(self.events)
+
+    def next_due(self):
+        """Cycle of the next scheduled interrupt, None if nothing is scheduled"""
+        return self.events[0][0] if self.events else None
+
+    def update(self, cycle):
+        """Raise every interrupt due at or before cycle"""
+        events = self.events
+        while events and events[0][0] <= cycle:
+            due, _, line, period = heapq.heappop(events)
+            self.pending |= 1 << line
+            if period:
+                heapq.heappush(events, (due + period, self.sequence, line, period))
+                self.sequence += 1
+
+    def active(self):
+        """Lowest unmasked pending line, 0 if there is none"""
+        active = self.pending & ~self.mask
+        return (active & -active).bit_length() - 1 if active else 0
+
+    def can_wake(self):
+        """Whether an unmasked line is pending or may become pending"""
+        if self.pending & ~self.mask:
+            return True
+        return any(not self.mask & (1 << line) for _, _, line, _ in self.events)
+
+    def next_wakeup(self):
+        """Cycle of the next scheduled unmasked interrupt, None if there is none"""
+        events = [event for event in self.events if not self.mask & (1 << event[2])]
+        return min(events)[0] if events else None
+
+    def acknowledge(self, line):
+        self.pending &= ~(1 << line)
+
+
+class BFCPU:
+    def __init__(self, program=b"", tape_size=TAPE_SIZE, accelerate=True):
+        self.program = bytearray(PROGRAM_SIZE)
+        self.program[:len(program)] = program
+        self.tape = bytearray(tape_size)
+        self.tape_mask = tape_size - 1
+        self.accelerate = accelerate
+        self.ptr = 0
+        self.pc = self.program[0]
+        self.stack = []     # Return addresses of the interrupt handlers being executed
+        self.ports = [0 for _ in range(0x10)]
+        self.uart = bytearray()
+        self.instret = 0
+        self.cycle = 0      # Simulated time: instructions executed plus cycles skipped in SLEEP
+        self.idle_skipped = 0
+        self.irq = InterruptController()
+        self.analyse()
+
+    def analyse(self):
+        """Decode the program and find the loops that can be executed in bulk.
+
+        self.code[pc] is (kind, argument, jump target, loop) where loop is None or,
+        for the JZ of an accelerated loop, (idiom, body length, ...).
+        """
+        decoded = [decode(byte, pc) for pc, byte in enumerate(self.program)]
+        self.code = []
+        for pc, (kind, arg, target) in enumerate(decoded):
+            loop = None
+            if kind == K_JZ and self.accelerate:
+                loop = self.loop_idiom(decoded, pc, target)
+            self.code.append((kind, arg, target, loop))
+
+    def loop_idiom(self, decoded, start, end):
+        jnz = end - 1
+        if jnz <= start or decoded[jnz][0] != K_JNZ or decoded[jnz][2] != start + 1:
+            return None
+        body = decoded[start + 1:jnz]
+        if not body or any(kind not in (K_INC, K_DEC, K_PINC, K_PDEC, K_ZERO) for kind, _, _ in body):
+            return None
+        offset = 0
+        deltas = {}     # offset -> change per iteration
+        zeroed = set()  # Offsets set to a constant (ZERO + later change) by every iteration
+        for kind, arg, _ in body:
+            if kind == K_PINC:
+                offset += arg
+            elif kind == K_PDEC:
+                offset -= arg
+            elif kind == K_ZERO:
+                zeroed.add(offset)
+                deltas[offset] = 0
+            else:
+                deltas[offset] = deltas.get(offset, 0) + (arg if kind == K_INC else -arg)
+        if offset != 0:
+            if not any(d & CELL_MASK for d in deltas.values()) and not zeroed:
+                return (LOOP_SCAN, len(body), offset)
+            return None
+        if 0 in zeroed:
+            return None
+        step = deltas.pop(0, 0) & CELL_MASK
+        if not step & 1:    # Even steps may never reach zero
+            return None
+        updates = [(o, d & CELL_MASK, o in zeroed) for o, d in deltas.items() if d & CELL_MASK or o in zeroed]
+        if not updates:
+            return (LOOP_CLEAR, len(body), pow(step, -1, CELL_MASK + 1))
+        return (LOOP_MOVE, len(body), pow(step, -1, CELL_MASK + 1), updates)
+
+    def scan(self, ptr, stride):
+        """Number of strides to the next zero cell, None if there is none"""
+        tape = self.tape
+        size = len(tape)
+        if stride == 1:
+            found = tape.find(0, ptr + 1)
+            if found < 0:
+                found = tape.find(0, 0, ptr + 1)
+                return None if found < 0 else found + size - ptr
+            return found - ptr
+        if stride == -1:
+            found = tape.rfind(0, 0, ptr)
+            if found < 0:
+                found = tape.rfind(0, ptr)
+                return None if found < 0 else ptr + size - found
+            return ptr - found
+        mask = self.tape_mask
+        for n in range(1, size + 1):
+            if tape[(ptr + n * stride) & mask] == 0:
+                return n
+        return None
+
+    def in_port(self, port):
+        return self.ports[port]
+
+    def out_port(self, port, value):
+        self.ports[port] = value
+        if port == UART_LSB_PORT:
+            self.uart.append(((self.ports[UART_MSB_PORT] & 0x0F) << 4) | (value & 0x0F))
+
+    def interrupt(self, line):
+        """Enter the handler of line, the return address is the current pc"""
+        self.irq.acknowledge(line)
+        self.stack.append(self.pc)
+        self.pc = self.program[line]
+
+    def run(self, max_steps):
+        """Execute up to max_steps instructions and return the stop reason.
+
+        Interrupts are taken between instructions while no handler is running. SLEEP
+        with nothing pending skips the simulated time to the next scheduled interrupt,
+        skipped cycles don't count against max_steps.
+        """
+        irq = self.irq
+        steps = 0
+        while True:
+            irq.update(self.cycle)
+            if not self.stack:
+                line = irq.active()
+                if line:
+                    self.interrupt(line)
+            # Run until the next scheduled interrupt, so it is raised at its exact cycle
+            budget = max_steps - steps
+            due = irq.next_due()
+            if due is not None:
+                budget = min(budget, max(due - self.cycle, 1))
+            instret = self.instret
+            reason = self.execute(budget)
+            executed = self.instret - instret
+            steps += executed
+            self.cycle += executed
+            if reason == STOP_SLEEP:
+                irq.update(self.cycle)
+                if not irq.can_wake():
+                    return STOP_SLEEP
+                if not irq.pending & ~irq.mask:
+                    wakeup = irq.next_wakeup()
+                    self.idle_skipped += wakeup - self.cycle
+                    self.cycle = wakeup
+                    irq.update(self.cycle)
+                # The SLEEP instruction completes when the CPU wakes up
+                self.pc = (self.pc + 1) & (PROGRAM_SIZE - 1)
+                self.instret += 1
+                steps += 1
+                self.cycle += 1
+            elif reason == STOP_HALT:
+                return STOP_HALT
+            if steps >= max_steps:
+                return STOP_BUDGET
+
+    def execute(self, max_steps):
+        """Execute up to max_steps instructions without taking interrupts"""
+        code = self.code
+        tape = self.tape
+        mask = self.tape_mask
+        ptr = self.ptr
+        pc = self.pc
+        steps = 0
+        reason = STOP_BUDGET
+        while steps < max_steps:
+            kind, arg, target, loop = code[pc]
+            steps += 1
+            if kind == K_INC:
+                tape[ptr] = (tape[ptr] + arg) & CELL_MASK
+            elif kind == K_DEC:
+                tape[ptr] = (tape[ptr] - arg) & CELL_MASK
+            elif kind == K_PINC:
+                ptr = (ptr + arg) & mask
+            elif kind == K_PDEC:
+                ptr = (ptr - arg) & mask
+            elif kind == K_JZ:
+                value = tape[ptr]
+                if value == 0:
+                    pc = target
+                    continue
+                if loop is not None:
+                    idiom, body_len = loop[0], loop[1]
+                    if idiom == LOOP_SCAN:
+                        n = self.scan(ptr, loop[2])
+                    else:
+                        n = (-value * loop[2]) & CELL_MASK
+                    if n is not None and steps + n * (body_len + 1) <= max_steps:
+                        steps += n * (body_len + 1)
+                        if idiom == LOOP_SCAN:
+                            ptr = (ptr + n * loop[2]) & mask
+                        else:
+                            if idiom == LOOP_MOVE:
+                                for offset, delta, zeroed in loop[3]:
+                                    cell = (ptr + offset) & mask
+                                    if zeroed:
+                                        tape[cell] = delta
+                                    else:
+                                        tape[cell] = (tape[cell] + n * delta) & CELL_MASK
+                            tape[ptr] = 0
+                        pc = target
+                        continue
+            elif kind == K_JNZ:
+                if tape[ptr] != 0:
+                    pc = target
+                    continue
+            elif kind == K_ZERO:
+                tape[ptr] = 0
+            elif kind == K_OUT:
+                self.out_port(arg, tape[ptr])
+            elif kind == K_IN:
+                tape[ptr] = self.in_port(arg) & CELL_MASK
+            elif kind == K_RET:
+                if not self.stack:
+                    steps -= 1
+                    reason = STOP_HALT
+                    break
+                pc = self.stack.pop()
+                if not self.stack and self.irq.pending & ~self.irq.mask:
+                    break   # Let run() take the interrupt that was held off by the handler
+                continue
+            else:   # SLEEP, left to run() which knows when the next interrupt is due
+                steps -= 1
+                reason = STOP_SLEEP
+                break
+            pc = (pc + 1) & (PROGRAM_SIZE - 1)
+        self.ptr = ptr
+        self.pc = pc
+        self.instret += steps
+        return reason
+
+
+def load_program(path, optimize=False):
+    """Load a raw 256-byte image, or assemble a .s/.bf source for the bf ISA"""
+    if path.endswith((".s", ".bf")):
+        import compiler
+        return compiler.assemble(path, compiler.ISA_BF, optimizer=compiler.BFOptimizer() if optimize else None)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reference interpreter for the 4-bit BrainFuck-style ISA")
+    parser.add_argument("program", type=str, help="Program image, or a .s/.bf source")
+    parser.add_argument("--max-steps", type=int, default=10 ** 9, help="Instruction budget")
+    parser.add_argument("--optimize", action="store_true", help="Run the assembler's peephole optimizer")
+    parser.add_argument("--no-accel", action="store_true", help="Don't execute loop idioms in bulk")
+    parser.add_argument("--timer", type=str, action="append", default=[], metavar="LINE:PERIOD",
+                        help="Raise interrupt LINE every PERIOD cycles")
+    args = parser.parse_args()
+    cpu = BFCPU(load_program(args.program, args.optimize), accelerate=not args.no_accel)
+    for timer in args.timer:
+        line, period = (int(value, 0) for value in timer.split(":"))
+        cpu.irq.schedule(line, period, period)
+    start = time.perf_counter()
+    reason = cpu.run(args.max_steps)
+    elapsed = time.perf_counter() - start
+    sys.stdout.buffer.write(bytes(cpu.uart))
+    print(f"\nStopped: {reason} at PC 0x{cpu.pc:02X} after {cpu.instret} instructions, {cpu.cycle} cycles "
+          f"({cpu.idle_skipped} skipped in SLEEP, {elapsed:.3f} s)", file=sys.stderr)
@@ -0,0 +1,41 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+# The emulators and the assembler are top-level scripts, not an installed package,
+# same for the C emulator wrappers in emulator/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "emulator"))
+
+EMULATOR_DIR = os.path.join(ROOT, "emulator")
+
+
+def build_test_dll(out_dir):
+    """Compile the test DLL the way CMake links it: main.c with every library of emulator/"""
+    compiler = os.environ.get("CC") or shutil.which("cc") or shutil.which("gcc")
+    if compiler is None:
+        pytest.skip("No C compiler to build the test DLL, set EMULATOR_DLL")
+    sources = [os.path.join(EMULATOR_DIR, "tests", "test_clock", "main.c")]
+    sources += sorted(glob.glob(os.path.join(EMULATOR_DIR, "lib", "*.c")))
+    sources += sorted(glob.glob(os.path.join(EMULATOR_DIR, "devices", "*", "*.c")))
+    path = os.path.join(out_dir, "libtest_clock_dll.dll" if os.name == "nt" else "libtest_clock_dll.so")
+    subprocess.run([compiler, "-shared", "-fPIC", "-O1", "-I", EMULATOR_DIR, "-I", os.path.join(EMULATOR_DIR, "devices"),
+                    *sources, "-lpthread", "-o", path], check=True)
+    return path
+
+
+@pytest.fixture(scope="session")
+def emulator_dll(tmp_path_factory):
+    """Path of the test DLL: EMULATOR_DLL, the CMake build-all output, or built from the sources"""
+    if "EMULATOR_DLL" in os.environ:
+        return os.environ["EMULATOR_DLL"]
+    for name in ("libtest_clock_dll.dll", "libtest_clock_dll.so", "libtest_clock_dll.dylib"):
+        path = os.path.join(EMULATOR_DIR, "bin", "executables", name)
+        if os.path.exists(path):
+            return path
+    return build_test_dll(str(tmp_path_factory.mktemp("dll")))
@@ -0,0 +1,152 @@
+import time
+
+import pytest
+
+from dll_wrapper import DeviceLibraryWrapper, DEV_CLOCK, STOP_NONE, STOP_TICK_LIMIT, STOP_DEADLINE, STOP_PAUSED
+
+# CLOCK_REG_* in devices/clock/clock.h
+CLOCK_REG_TICKS_LO = 0x00
+CLOCK_REG_NUM_DEVICES = 0x02
+CLOCK_REG_FIRED_LO = 0x03
+CLOCK_REG_FIRED_PER_TICK = 0x05
+CLOCK_REG_MAX_FIRED = 0x07
+CLOCK_REG_RESET_STATS = 0x08
+CLOCK_REG_TIME_LO = 0x09
+CLOCK_REG_TARGET_FREQ = 0x0B
+CLOCK_REG_ACHIEVED_FREQ_LO = 0x0C
+CLOCK_REG_ACHIEVED_FREQ_HI = 0x0D
+CLOCK_REG_OVERRUNS = 0x0E
+
+TICK_BATCH = 4096   # Ticks the clock thread claims per lock acquisition, see clock.c
+
+
+@pytest.fixture
+def machine(emulator_dll):
+    """Factory of emulator contexts, by default with an unthrottled 1 MHz clock"""
+    devices = []
+
+    def make(freq=1000000, real_time=False):
+        device = DeviceLibraryWrapper(emulator_dll)
+        device.init(freq, real_time)
+        devices.append(device)
+        return device
+
+    yield make
+    for device in devices:
+        device.destroy()
+
+
+def clock_reg(device, reg_id):
+    return device.get_register(DEV_CLOCK, reg_id)
+
+
+@pytest.mark.parametrize("steps", [[1], [TICK_BATCH - 1, 1], [TICK_BATCH + 1], [3 * TICK_BATCH + 5, 2]])
+def test_step_runs_exact_ticks_across_batches(machine, steps):
+    device = machine()
+    for count in steps:
+        device.step(count)
+    assert clock_reg(device, CLOCK_REG_TICKS_LO) == sum(steps)
+    assert clock_reg(device, CLOCK_REG_TIME_LO) == sum(steps)
+
+
+def test_batched_ticks_fire_every_device(machine):
+    device = machine()
+    device.step(2 * TICK_BATCH + 7)
+    ticks = 2 * TICK_BATCH + 7
+    # The dummy device and the interrupt controller both tick on every clock tick
+    assert clock_reg(device, CLOCK_REG_NUM_DEVICES) == 2
+    assert clock_reg(device, CLOCK_REG_FIRED_LO) == 2 * ticks
+    assert clock_reg(device, CLOCK_REG_FIRED_PER_TICK) == 2000
+    assert clock_reg(device, CLOCK_REG_MAX_FIRED) == 2
+    device.set_register(DEV_CLOCK, CLOCK_REG_RESET_STATS, 1)
+    assert clock_reg(device, CLOCK_REG_TICKS_LO) == 0
+    assert clock_reg(device, CLOCK_REG_FIRED_LO) == 0
+    assert clock_reg(device, CLOCK_REG_TIME_LO) == ticks
+
+
+def test_real_time_batches_stay_exact(machine):
+    # At 1 kHz a batch is 10 ticks, so step() waits for several paced batches
+    device = machine(1000, True)
+    device.step(25)
+    assert clock_reg(device, CLOCK_REG_TICKS_LO) == 25
+
+
+def achieved_mhz(device):
+    return clock_reg(device, CLOCK_REG_ACHIEVED_FREQ_LO) | clock_reg(device, CLOCK_REG_ACHIEVED_FREQ_HI) << 32
+
+
+def test_real_time_pacing(machine):
+    device = machine(1000, True)
+    assert clock_reg(device, CLOCK_REG_TARGET_FREQ) == 1000
+    assert achieved_mhz(device) == 0
+    start = time.monotonic()
+    device.step(200)
+    elapsed = time.monotonic() - start
+    # Deadlines are absolute, so the run can't end before its last one
+    assert elapsed >= 0.199
+    assert 900000 <= achieved_mhz(device) <= 1010000
+
+
+def test_slow_clock_reports_its_frequency(machine):
+    # 1 tick per 500 ms, whole Hz would read 2 but a 1 Hz clock would read 0 or 1
+    device = machine(2, True)
+    device.step(1)
+    assert 1800 <= achieved_mhz(device) <= 2010
+    assert clock_reg(device, CLOCK_REG_OVERRUNS) == 0
+
+
+def test_unthrottled_clock_isnt_paced(machine):
+    device = machine(10, False)
+    start = time.monotonic()
+    device.step(100)
+    assert time.monotonic() - start < 5
+    assert achieved_mhz(device) == 0
+
+
+@pytest.mark.parametrize("limit", [1, TICK_BATCH, 3 * TICK_BATCH + 1])
+def test_tick_limit(machine, limit):
+    device = machine()
+    device.set_tick_limit(limit)
+    device.run()
+    assert device.wait_done(10) == STOP_TICK_LIMIT
+    assert clock_reg(device, CLOCK_REG_TICKS_LO) == limit
+
+
+def test_tick_limit_counts_steps(machine):
+    device = machine()
+    device.set_tick_limit(10)
+    device.step(4)
+    device.run()
+    assert device.wait_done(10) == STOP_TICK_LIMIT
+    assert clock_reg(device, CLOCK_REG_TICKS_LO) == 10
+
+
+def test_deadline(machine):
+    device = machine()
+    device.set_deadline(0.05)
+    start = time.monotonic()
+    device.run()
+    assert device.wait_done(10) == STOP_DEADLINE
+    assert time.monotonic() - start >= 0.045
+
+
+def test_pause_reason_and_callback(machine):
+    device = machine()
+    reasons = []
+    device.set_done_callback(reasons.append)
+    device.set_tick_limit(100)
+    device.run()
+    assert device.wait_done(10) == STOP_TICK_LIMIT
+    assert reasons == [STOP_TICK_LIMIT]
+    device.set_tick_limit(0)
+    device.run()
+    device.stop()
+    assert device.wait_done(10) == STOP_PAUSED
+    assert reasons == [STOP_TICK_LIMIT]     # Only the limits call it
+
+
+def test_wait_done_timeout(machine):
+    device = machine(1, True)
+    assert device.wait_done(0.05) == STOP_NONE
+    device.run()
+    assert device.wait_done(0.05) == STOP_NONE
@@ -0,0 +1,171 @@
+import pytest
+
+import compiler
+import emulbf
+
+BF_PROGRAMS = {
+    "clear": "+++++[-]>++<",
+    "move": "++++[->+>++<<]>>.",
+    "nested": "++[>+++[>++<-]<-]>>.",
+    "cancel": "+++--><><>>+<-<[-]>.",
+}
+
+ASM_PROGRAMS = {
+    # '$' jumps skip over code the optimizer would shrink
+    "relative": """
+main:
+    JZ $+4
+    INC 1
+    INC 1
+    INC 1
+    PINC 1
+    INC 7
+    SLEEP
+""",
+    "relative_loop": """
+main:
+    INC 3
+    PINC 1
+    INC 1
+    INC 1
+    PDEC 1
+    DEC 1
+    JNZ $-5
+    PINC 2
+    INC 7
+    SLEEP
+""",
+    "numeric": """
+main:
+    JZ 0x15
+    INC 1
+    INC 1
+    PINC 1
+    PDEC 1
+    INC 5
+    SLEEP
+""",
+}
+
+
+def run(path, optimize):
+    cpu = emulbf.BFCPU(emulbf.load_program(str(path), optimize))
+    reason = cpu.run(100000)
+    return reason, cpu.ptr, bytes(cpu.tape[:8]), bytes(cpu.uart)
+
+
+@pytest.mark.parametrize("name", sorted(BF_PROGRAMS))
+def test_optimized_bf_matches_plain(tmp_path, name):
+    path = tmp_path / f"{name}.bf"
+    path.write_text(BF_PROGRAMS[name])
+    assert run(path, True) == run(path, False)
+
+
+@pytest.mark.parametrize("name", sorted(ASM_PROGRAMS))
+def test_optimized_fixed_jumps_match_plain(tmp_path, name):
+    path = tmp_path / f"{name}.s"
+    path.write_text(ASM_PROGRAMS[name])
+    assert run(path, True) == run(path, False)
+
+
+def test_fixed_jumps_disable_optimization(tmp_path):
+    path = tmp_path / "relative.s"
+    path.write_text(ASM_PROGRAMS["relative"])
+    optimizer = compiler.BFOptimizer()
+    image = compiler.assemble(str(path), compiler.ISA_BF, optimizer=optimizer)
+    assert image == compiler.assemble(str(path), compiler.ISA_BF)
+    assert optimizer.bytes_before == optimizer.bytes_after
+
+
+def test_optimizer_shrinks_label_jumps(tmp_path):
+    path = tmp_path / "clear.bf"
+    path.write_text(BF_PROGRAMS["clear"])
+    optimizer = compiler.BFOptimizer()
+    compiler.assemble(str(path), compiler.ISA_BF, optimizer=optimizer)
+    assert optimizer.bytes_after < optimizer.bytes_before
+
+
+def assemble_text(tmp_path, source, isa):
+    path = tmp_path / "program.s"
+    path.write_text(source)
+    return compiler.assemble(str(path), isa)
+
+
+REG12_ENCODINGS = """
+main:
+    SETA 5
+    MOV B, A
+    ADD B, A
+    STOR B, 0x123
+    LD E0, 0x7FF
+    JZ A, main
+    OUT C, 0x1
+    IN A, 0xAB
+    RET
+    HALT
+    JMP end
+end:
+    .stack 0x800
+"""
+
+
+def test_reg12_encodings(tmp_path):
+    image = assemble_text(tmp_path, REG12_ENCODINGS, compiler.ISA_REG12)
+    assert len(image) == 0x1000
+    assert bytes(image[:38]) == bytes([
+        0xE, 0x5,
+        0x8, 0x1, 0x1, 0x0,
+        0xC, 0x4,
+        0x6, 0x9, 0x2, 0x3,
+        0x5, 0xF, 0xF, 0xF,
+        0x0, 0x7, 0xE, 0xC,     # -20 from the next instruction
+        0xF, 0xE, 0x0, 0x1,
+        0xF, 0x8, 0xA, 0xB,
+        0x8, 0x0,
+        0xF, 0x7, 0xF, 0xC,
+        0xF, 0x0, 0x0, 0x0,     # Forward reference, backpatched
+    ])
+    assert bytes(image[0xFF9:0xFFF]) == bytes([0x0, 0x0, 0x0, 0x8, 0x0, 0x0])
+
+
+def test_bf_encodings(tmp_path):
+    source = "main:\n    INC 3\n    PDEC 15\n    OUT 1\n    JZ main\n    JNZ $\n    SLEEP\n"
+    image = assemble_text(tmp_path, source, compiler.ISA_BF)
+    assert len(image) == 0x100
+    assert image[0] == 0x10
+    assert bytes(image[0x10:0x16]) == bytes([0x43, 0x7F, 0x31, 0xBC, 0xFF, 0x00])
+
+
+@pytest.mark.parametrize("isa, source", [
+    (compiler.ISA_REG12, "    JMP far\n    .org 0x404\nfar:\n    HALT\n"),
+    (compiler.ISA_REG12, "    .org 0x500\n    JNZ A, 0\n"),
+    (compiler.ISA_BF, "    JZ far\n    .org 0x31\nfar:\n    SLEEP\n"),
+    (compiler.ISA_BF, "    .org 0x40\n    JNZ 0x1F\n"),
+])
+def test_jump_out_of_range(tmp_path, isa, source):
+    with pytest.raises(compiler.AssemblerError, match="jump offset"):
+        assemble_text(tmp_path, source, isa)
+
+
+@pytest.mark.parametrize("isa, source", [
+    (compiler.ISA_REG12, "    JMP far\n    .org 0x403\nfar:\n    HALT\n"),
+    (compiler.ISA_REG12, "    .org 0x3FC\n    JNZ A, 0\n"),
+    (compiler.ISA_BF, "    JZ far\n    .org 0x30\nfar:\n    SLEEP\n"),
+    (compiler.ISA_BF, "    .org 0x3F\n    JNZ 0x20\n"),
+])
+def test_jump_range_limits(tmp_path, isa, source):
+    assemble_text(tmp_path, source, isa)
+
+
+def test_cache_hit_from_another_directory(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "main.s").write_text('main:\n    .include "inc.s"\n    HALT\n')
+    (src / "inc.s").write_text("    SETA 3\n")
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+    image = compiler.assemble("src/main.s", cache=compiler.ItemCache(cache_dir))
+    monkeypatch.chdir(src)
+    cache = compiler.ItemCache(cache_dir)
+    assert compiler.assemble("main.s", cache=cache) == image
+    assert cache.hits == 2
@@ -0,0 +1,193 @@
+import time
+
+import compiler
+import emul4b
+import trace4b
+
+ROM = bytes([0xE, 0x1, 0xE, 0x2, 0xF, 0x7, 0xF, 0xC])  # SETA 1; SETA 2; JMP $
+
+
+def test_trace_without_logger(tmp_path):
+    cpu = emul4b.CPU(ROM)
+    text_trace = tmp_path / "trace.txt"
+    cpu.start_trace(str(text_trace))
+    assert cpu.run(100) == emul4b.STOP_HALT
+    cpu.stop_trace()
+    assert text_trace.read_text().splitlines()[1].startswith("002: 00E2 SETA A=2")
+
+    cpu = emul4b.CPU(ROM)
+    binary_trace = tmp_path / "trace.bin"
+    cpu.start_trace(str(binary_trace), binary=True)
+    cpu.run(100)
+    cpu.stop_trace()
+    assert binary_trace.read_bytes().startswith(trace4b.trace_header())
+
+
+# Counts B down from 5, storing each value and copying E0 to E1, then prints C over the UART
+LOOP_SOURCE = """
+main:
+    SETA 5
+    MOV B, A
+    SETA 1
+loop:
+    SUB B, A
+    STOR B, 0x10
+    MOV E1, E0
+    STOR E0, 0x20
+    JNZ B, loop
+    LD C, 0x10
+    ADD C, A
+    OUT C, 1
+    HALT
+"""
+
+
+def assemble(tmp_path, source):
+    path = tmp_path / "program.s"
+    path.write_text(source)
+    return compiler.assemble(str(path))
+
+
+def arch_state(cpu):
+    regs = cpu.regs
+    return ((regs.A, regs.B, regs.C, regs.E1, regs.E2, regs.PC, regs.SP),
+            bytes(cpu.RAM.data), list(cpu.ports), bytes(cpu.uart))
+
+
+def run_ticks(cpu):
+    steps = 0
+    while cpu.tick():
+        steps += 1
+    return steps
+
+
+def run_blocks(cpu):
+    steps = 0
+    while True:
+        executed = cpu.step_block()
+        if not executed:
+            return steps
+        steps += executed
+
+
+def test_tick_redecodes_written_rom():
+    cpu = emul4b.CPU(ROM)
+    assert cpu.tick() == 1
+    assert cpu.regs.A == 1
+    # The instruction at 0 is cached now, overwrite it: SETA 1 -> SETA 9
+    cpu.rom_write(1, [9])
+    cpu.reset()
+    cpu.tick()
+    assert cpu.regs.A == 9
+    cpu.tick()
+    assert cpu.tick() == 0      # JMP $
+    assert cpu.regs.PC == 4
+
+
+def test_step_block_matches_tick(tmp_path):
+    rom = assemble(tmp_path, LOOP_SOURCE)
+    by_tick = emul4b.CPU(rom)
+    by_block = emul4b.CPU(rom)
+    assert run_blocks(by_block) == run_ticks(by_tick)
+    assert arch_state(by_block) == arch_state(by_tick)
+    assert by_block.uart == bytes([1])
+
+
+def test_rom_write_invalidates_compiled_blocks(tmp_path):
+    rom = assemble(tmp_path, LOOP_SOURCE)
+    cpu = emul4b.CPU(rom)
+    run_blocks(cpu)
+    # SETA 5 -> SETA 3, inside the block compiled at main
+    cpu.rom_write(1, [3])
+    cpu.reset()
+    run_blocks(cpu)
+    reference = emul4b.CPU(rom)
+    reference.rom_write(1, [3])
+    run_ticks(reference)
+    assert arch_state(cpu) == arch_state(reference)
+    # Through the 8-bit store path too: SETA 3 -> SETA 2
+    cpu.set_8b_value(cpu.ROM, 0, 0xE2)
+    cpu.reset()
+    assert cpu.step_block() == 8    # Up to the JNZ
+    assert (cpu.regs.B, cpu.RAM[0x10]) == (1, 1)
+
+
+def test_nibble_memory_masks_and_wraps():
+    mem = emul4b.NibbleMemory(bytes([0x1F, 0x02]), size=16)
+    assert len(mem) == 16
+    assert (mem[0], mem[1], mem[16]) == (0xF, 0x2, 0xF)
+    mem[17] = 0x3A
+    assert mem[1] == 0xA
+    mem.load(14, [1, 2, 3, 4])
+    assert bytes(mem.data[:2]) + bytes(mem.data[14:]) == bytes([3, 4, 1, 2])
+    mem.set_12b(15, 0xABC)
+    assert (mem[15], mem[0], mem[1]) == (0xA, 0xB, 0xC)
+    assert mem.get_12b(15) == 0xABC
+    mem.set_8b(15, 0x5D)
+    assert mem.get_8b(15) == 0x5D
+    view = mem.view()
+    view[3] = 7
+    assert mem[3] == 7
+
+
+def test_run_stops_at_breakpoint(tmp_path):
+    rom = assemble(tmp_path, LOOP_SOURCE)
+    cpu = emul4b.CPU(rom)
+    loop = 8    # SETA, MOV, SETA
+    assert cpu.run(1000, breakpoints={loop}) == emul4b.STOP_BREAKPOINT
+    assert (cpu.regs.PC, cpu.regs.B, cpu.instret) == (loop, 5, 3)
+    # Resuming from the breakpoint executes it
+    assert cpu.run(1000, breakpoints={loop}) == emul4b.STOP_BREAKPOINT
+    assert (cpu.regs.B, cpu.instret) == (4, 8)
+    # A breakpoint inside a compiled block splits it
+    cpu = emul4b.CPU(rom)
+    assert cpu.run(1000, breakpoints={18}) == emul4b.STOP_BREAKPOINT    # STOR E0
+    assert (cpu.regs.PC, cpu.instret) == (18, 6)
+
+
+def test_run_stops_after_watched_store(tmp_path):
+    rom = assemble(tmp_path, LOOP_SOURCE)
+    cpu = emul4b.CPU(rom)
+    assert cpu.run(1000, watch={0x22}) == emul4b.STOP_WATCHPOINT    # Low nibble of the E0 store
+    assert cpu.instret == 7
+    assert cpu.RAM.get_12b(0x20) == 0x140
+    assert cpu.run(1000, watch={0x30}) == emul4b.STOP_HALT
+
+
+def test_run_budget_matches_tick(tmp_path):
+    rom = assemble(tmp_path, LOOP_SOURCE)
+    cpu = emul4b.CPU(rom)
+    reference = emul4b.CPU(rom)
+    for budget in (1, 2, 5, 7):
+        assert cpu.run(budget) == emul4b.STOP_BUDGET
+        for _ in range(budget):
+            reference.tick()
+        assert arch_state(cpu) == arch_state(reference)
+    assert cpu.instret == 15
+
+
+class LineLogger:
+    def __init__(self):
+        self.lines = []
+
+    def print_line(self, line):
+        self.lines.append(line)
+
+
+def test_worker_reads_the_mode_once_per_chunk(tmp_path):
+    rom = assemble(tmp_path, "main:\n    SETA 1\n    JMP main\n")
+    modes = iter([emul4b.MODE_REALTIME, emul4b.MODE_UNTHROTTLED] * 5)
+
+    class SwitchingCPU(emul4b.CPU):
+        # Switches the mode while a chunk runs, as the REPL does between the worker's reads
+        def run(self, max_steps, breakpoints=set(), watch=set()):
+            worker.run_mode = next(modes, worker.run_mode)
+            return super().run(max_steps, breakpoints, watch)
+
+    logger = LineLogger()
+    worker = emul4b.CPUWorker(SwitchingCPU(rom), logger, emul4b.MODE_UNTHROTTLED)
+    worker.start()
+    time.sleep(0.2)
+    worker.stop()
+    worker.shutdown()
+    assert logger.lines[-1].startswith("CPU stopped: stopped by user")
@@ -0,0 +1,69 @@
+import pytest
+
+import compiler
+import emulbf
+
+IDIOMS = {
+    "clear": ("clear.bf", "+++++[-]>++<"),
+    "clear_odd_step": ("clear_odd_step.bf", "++++[---]+"),
+    "move": ("move.bf", "++++[->+>++<<]>>."),
+    "scan_right": ("scan_right.bf", ">+>+>+<<<+[>]+."),
+    "scan_left": ("scan_left.bf", ">>>>+<+<+<+[<]+"),
+    "scan_stride": ("scan_stride.bf", "+>>+>>+<<<<[>>]+"),
+    "move_zero": ("move_zero.s", """
+main:
+    INC 3
+    PINC 1
+    INC 5
+    PDEC 1
+    JZ end
+start:
+    DEC 1
+    PINC 1
+    ZERO
+    INC 2
+    PDEC 1
+    JNZ start
+end:
+    PINC 1
+    OUT 1
+    RET
+"""),
+}
+
+
+def state(cpu):
+    return cpu.pc, cpu.ptr, cpu.instret, bytes(cpu.tape), bytes(cpu.uart)
+
+
+@pytest.fixture(params=sorted(IDIOMS))
+def program(request, tmp_path):
+    name, source = IDIOMS[request.param]
+    path = tmp_path / name
+    path.write_text(source)
+    return compiler.assemble(str(path), compiler.ISA_BF)
+
+
+def test_idiom_is_accelerated(program):
+    cpu = emulbf.BFCPU(program)
+    assert any(loop is not None for _, _, _, loop in cpu.code)
+
+
+def test_idiom_matches_plain_interpreter(program):
+    accelerated = emulbf.BFCPU(program)
+    plain = emulbf.BFCPU(program, accelerate=False)
+    reason = plain.run(1000)
+    assert reason != emulbf.STOP_BUDGET
+    assert accelerated.run(1000) == reason
+    assert state(accelerated) == state(plain)
+
+
+def test_idiom_respects_step_budget(program):
+    plain = emulbf.BFCPU(program, accelerate=False)
+    plain.run(1000)
+    # Every budget up to the end of the program, including the ones ending inside a loop
+    for budget in range(1, plain.instret + 2):
+        accelerated = emulbf.BFCPU(program)
+        plain = emulbf.BFCPU(program, accelerate=False)
+        assert accelerated.run(budget) == plain.run(budget)
+        assert state(accelerated) == state(plain), f"budget {budget}"
@@ -0,0 +1,80 @@
+import io
+import json
+
+import farm
+
+
+def uart_rom(text):
+    """emul4b ROM image printing text on the UART and halting, the reset vector is 0"""
+    program = []
+    for byte in text.encode():
+        # SETA msb; OUT UART_MSB_PORT; SETA lsb; OUT UART_LSB_PORT
+        program += [0xE, byte >> 4, 0xF, 0xC, 0x0, 0x0, 0xE, byte & 0xF, 0xF, 0xC, 0x0, 0x1]
+    program += [0xF, 0x7, 0xF, 0xC]     # JMP $
+    return bytes(program)
+
+
+def write_job(tmp_path, name, text, expected):
+    (tmp_path / f"{name}.bin").write_bytes(uart_rom(text))
+    (tmp_path / f"{name}.out").write_bytes(expected)
+    return {"name": name, "rom": f"{name}.bin", "expected": f"{name}.out"}
+
+
+def test_farm_round_trip(tmp_path):
+    jobs = [
+        write_job(tmp_path, "hello", "hello", b"hello"),
+        write_job(tmp_path, "other", "hi", b"hi"),
+        write_job(tmp_path, "wrong", "abc", b"abd"),
+        {"name": "missing", "rom": "missing.bin", "expected": "missing.out"},
+    ]
+    manifest = tmp_path / "jobs.jsonl"
+    manifest.write_text("".join(json.dumps(job) + "\n" for job in jobs))
+
+    out = io.StringIO()
+    failures = farm.run_farm(farm.load_manifest(str(manifest)), farm.BACKEND_PY, workers=2, out=out)
+    results = {result["name"]: result for result in map(json.loads, out.getvalue().splitlines())}
+
+    assert failures == 2
+    assert set(results) == {"hello", "other", "wrong", "missing"}
+    assert results["hello"]["passed"]
+    assert results["hello"]["reason"] == "halt"
+    assert bytes.fromhex(results["hello"]["output"]) == b"hello"
+    assert results["other"]["passed"]
+    assert not results["wrong"]["passed"]
+    assert bytes.fromhex(results["wrong"]["output"]) == b"abc"
+    assert not results["missing"]["passed"]
+    assert results["missing"]["error"].startswith("FileNotFoundError")
+
+
+def write_image_job(tmp_path, name, image, expected, **fields):
+    """DLL backend job, the test DLL has no CPU so its output is the memory the image was loaded into"""
+    (tmp_path / f"{name}.bin").write_bytes(image)
+    (tmp_path / f"{name}.out").write_bytes(expected)
+    return {"name": name, "rom": f"{name}.bin", "expected": f"{name}.out", **fields}
+
+
+def test_farm_dll_backend(tmp_path, emulator_dll):
+    from dll_wrapper import DeviceLibraryWrapper, MEMSPACE_ROM, MEMSPACE_RAM
+
+    device = DeviceLibraryWrapper(emulator_dll)
+    device.init()
+    device.save_state(str(tmp_path / "state.bin"))
+    device.destroy()
+    jobs = [
+        write_image_job(tmp_path, "ram", b"hello", b"hello", load_memspace=MEMSPACE_RAM),
+        write_image_job(tmp_path, "state", b"world", b"world", load_memspace=MEMSPACE_RAM, state="state.bin"),
+        write_image_job(tmp_path, "long", b"abcdef", b"abcdef", result_memspace=MEMSPACE_ROM),
+        write_image_job(tmp_path, "short", b"xy", b"xy\0\0", result_memspace=MEMSPACE_ROM),
+    ]
+    manifest = tmp_path / "jobs.jsonl"
+    manifest.write_text("".join(json.dumps(job) + "\n" for job in jobs))
+
+    out = io.StringIO()
+    # One worker runs the jobs in order, so "short" is loaded over the image of "long"
+    failures = farm.run_farm(farm.load_manifest(str(manifest)), farm.BACKEND_DLL, emulator_dll, workers=1,
+                             max_steps=1000, out=out)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert failures == 0, results
+    assert [result["name"] for result in results] == ["ram", "state", "long", "short"]
+    assert all(result["reason"] == "tick_limit" and result["steps"] == 1000 for result in results)
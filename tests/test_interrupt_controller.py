@@ -0,0 +1,91 @@
+import pytest
+
+from dll_wrapper import DeviceLibraryWrapper, DEV_CLOCK, DEV_IRQ, IRQ_NO_WAKEUP
+
+# IRQ_REG_* in devices/interrupt_controller/interrupt_controller.h
+IRQ_REG_PENDING = 0x00
+IRQ_REG_MASK = 0x01
+IRQ_REG_RAISE = 0x02
+IRQ_REG_ACTIVE = 0x04
+IRQ_REG_SCHED_LINE = 0x05
+IRQ_REG_SCHED_DELAY = 0x07
+IRQ_REG_NEXT_WAKEUP = 0x09
+IRQ_REG_TIME_LO = 0x0A
+IRQ_REG_SKIPPED_LO = 0x0C
+CLOCK_REG_TIME_LO = 0x09
+
+
+@pytest.fixture
+def device(emulator_dll):
+    device = DeviceLibraryWrapper(emulator_dll)
+    device.init()
+    yield device
+    device.destroy()
+
+
+def schedule(device, line, delay):
+    device.set_register(DEV_IRQ, IRQ_REG_SCHED_LINE, line)
+    device.set_register(DEV_IRQ, IRQ_REG_SCHED_DELAY, delay)
+
+
+def test_sleep_skips_to_scheduled_irq(device):
+    schedule(device, 3, 1000)
+    assert device.get_register(DEV_IRQ, IRQ_REG_NEXT_WAKEUP) == 1000
+    assert device.irq_sleep() == 1000
+    assert device.get_register(DEV_IRQ, IRQ_REG_ACTIVE) == 3
+    assert device.get_register(DEV_IRQ, IRQ_REG_SKIPPED_LO) == 1000
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 1000
+    # The clock and the controller carry on from the same time base
+    device.step()
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 1001
+    assert device.get_register(DEV_IRQ, IRQ_REG_TIME_LO) == 1001
+
+
+def test_sleep_returns_at_once_on_pending_irq(device):
+    schedule(device, 3, 1000)
+    device.set_register(DEV_IRQ, IRQ_REG_RAISE, 5)
+    assert device.irq_sleep() == 0
+    assert device.get_register(DEV_IRQ, IRQ_REG_ACTIVE) == 5
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 0
+
+
+def test_sleep_without_wakeup(device):
+    assert device.irq_sleep() == IRQ_NO_WAKEUP
+    schedule(device, 3, 10)
+    device.set_register(DEV_IRQ, IRQ_REG_MASK, 1 << 3)
+    assert device.irq_sleep() == IRQ_NO_WAKEUP
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 0
+
+
+def test_invalid_line_is_ignored(device):
+    device.set_register(DEV_IRQ, IRQ_REG_RAISE, 0)
+    device.set_register(DEV_IRQ, IRQ_REG_RAISE, 16)
+    schedule(device, 16, 10)
+    assert device.get_register(DEV_IRQ, IRQ_REG_PENDING) == 0
+    assert device.get_register(DEV_IRQ, IRQ_REG_NEXT_WAKEUP) == 0xFFFFFFFF
+    assert device.get_register(DEV_IRQ, 0x7F) == 0
+
+
+def test_state_round_trip(device, tmp_path):
+    schedule(device, 4, 500)
+    device.irq_sleep()
+    state = str(tmp_path / "state.bin")
+    device.save_state(state)
+    device.reset()
+    assert device.get_register(DEV_IRQ, IRQ_REG_PENDING) == 0
+    device.restore_state(state)
+    assert device.get_register(DEV_IRQ, IRQ_REG_ACTIVE) == 4
+    assert device.get_register(DEV_IRQ, IRQ_REG_TIME_LO) == 500
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 500
+
+
+def test_reset_restarts_both_time_bases(device):
+    schedule(device, 3, 1000)
+    device.irq_sleep()
+    device.step()
+    device.reset()
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 0
+    assert device.get_register(DEV_IRQ, IRQ_REG_TIME_LO) == 0
+    device.step()
+    assert device.get_register(DEV_CLOCK, CLOCK_REG_TIME_LO) == 1
+    assert device.get_register(DEV_IRQ, IRQ_REG_TIME_LO) == 1
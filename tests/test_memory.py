@@ -0,0 +1,174 @@
+import pytest
+
+from dll_wrapper import (DeviceLibraryWrapper, BusError, MEMSPACE_ROM, MEMSPACE_RAM, BUS_ROM_BASE, BUS_RAM_BASE,
+                         BUS_INVALID_RANGE, BUS_TABLE_FULL, BUS_OVERLAP, BUS_UNMAPPED, BUS_ACCESS_DENIED,
+                         MEM_ACCESS_READ, MEM_ACCESS_WRITE, MEM_EQUAL, MEM_OUT_OF_BOUNDS)
+
+MEM_SIZE = 0x1000   # ROM_SIZE and RAM_SIZE of the test DLL
+DEVICE_MAP_SIZE = 128
+
+
+@pytest.fixture
+def device(emulator_dll):
+    device = DeviceLibraryWrapper(emulator_dll)
+    device.init()
+    yield device
+    device.destroy()
+
+
+def bus_error(call, *args):
+    with pytest.raises(BusError) as error:
+        call(*args)
+    return error.value.code
+
+
+def test_memspaces_are_on_the_bus(device):
+    device.mem_write(MEMSPACE_ROM, 0, b"\x12\x34")
+    device.mem_write(MEMSPACE_RAM, MEM_SIZE - 1, b"\x56")
+    assert device.bus_read(BUS_ROM_BASE) == 0x12
+    assert device.bus_read(BUS_ROM_BASE + 1) == 0x34
+    assert device.bus_read(BUS_RAM_BASE + MEM_SIZE - 1) == 0x56
+    device.bus_write(BUS_RAM_BASE + 2, 0x9A)
+    assert device.mem_read(MEMSPACE_RAM, 2, 1) == b"\x9A"
+
+
+def test_unmapped_addresses(device):
+    for address in (BUS_RAM_BASE + MEM_SIZE, 0xFFFF, 0x10000):
+        assert bus_error(device.bus_read, address) == BUS_UNMAPPED
+        assert bus_error(device.bus_write, address, 0) == BUS_UNMAPPED
+
+
+@pytest.mark.parametrize("memspace, start, end, code", [
+    (MEMSPACE_RAM, BUS_RAM_BASE + MEM_SIZE - 1, BUS_RAM_BASE + MEM_SIZE, BUS_OVERLAP),
+    (MEMSPACE_RAM, 0x4000, 0x4000 + MEM_SIZE, BUS_INVALID_RANGE),     # Bigger than the memspace
+    (MEMSPACE_RAM, 0x4010, 0x400F, BUS_INVALID_RANGE),
+    (MEMSPACE_RAM, 0xFFFF, 0x10000, BUS_INVALID_RANGE),
+    (2, 0x4000, 0x40FF, BUS_INVALID_RANGE),     # Unknown memspace
+])
+def test_bad_mappings_are_rejected(device, memspace, start, end, code):
+    assert bus_error(device.bus_map_device, memspace, start, end) == code
+    # The existing mappings are untouched
+    device.bus_write(BUS_RAM_BASE + MEM_SIZE - 1, 0x42)
+    assert device.bus_read(BUS_RAM_BASE + MEM_SIZE - 1) == 0x42
+    assert bus_error(device.bus_read, BUS_RAM_BASE + MEM_SIZE) == BUS_UNMAPPED
+
+
+def test_map_table_full(device):
+    for i in range(DEVICE_MAP_SIZE - 2):    # The ROM and the RAM take two entries
+        assert device.bus_map_device(MEMSPACE_RAM, 0x4000 + i, 0x4000 + i) == i + 2
+    assert bus_error(device.bus_map_device, MEMSPACE_RAM, 0x5000, 0x5000) == BUS_TABLE_FULL
+
+
+def test_shared_page(device):
+    # Both halves of the 0x4000 page, each address resolves to its own device
+    device.bus_map_device(MEMSPACE_ROM, 0x4000, 0x407F)
+    device.bus_map_device(MEMSPACE_RAM, 0x4080, 0x40FF)
+    device.bus_write(0x407F, 0x11)
+    device.bus_write(0x4080, 0x22)
+    assert device.mem_read(MEMSPACE_ROM, 0x7F, 1) == b"\x11"
+    assert device.mem_read(MEMSPACE_RAM, 0, 1) == b"\x22"
+    assert device.bus_read(0x407F) == 0x11
+    assert device.bus_read(0x4080) == 0x22
+    assert device.bus_read(BUS_RAM_BASE) == 0x22     # Same memory as the default mapping
+
+
+def test_partially_mapped_page(device):
+    device.bus_map_device(MEMSPACE_RAM, 0x5010, 0x501F)
+    device.mem_write(MEMSPACE_RAM, 0, bytes(range(1, 17)))
+    assert device.bus_read(0x5010) == 1
+    assert device.bus_read(0x501F) == 16
+    for address in (0x5000, 0x500F, 0x5020, 0x50FF):
+        assert bus_error(device.bus_read, address) == BUS_UNMAPPED
+
+
+def test_range_across_pages(device):
+    # Partial first and last pages around whole ones
+    device.bus_map_device(MEMSPACE_RAM, 0x60F0, 0x6E0F)
+    device.bus_write(0x60F0, 1)
+    device.bus_write(0x6100, 2)
+    device.bus_write(0x6E0F, 3)
+    assert device.mem_read(MEMSPACE_RAM, 0, 1) == b"\x01"
+    assert device.mem_read(MEMSPACE_RAM, 0x10, 1) == b"\x02"
+    assert device.mem_read(MEMSPACE_RAM, 0xD1F, 1) == b"\x03"
+    assert bus_error(device.bus_read, 0x60EF) == BUS_UNMAPPED
+    assert bus_error(device.bus_read, 0x6E10) == BUS_UNMAPPED
+
+
+def test_rom_is_read_only_on_the_bus(device):
+    device.mem_write(MEMSPACE_ROM, 0x10, b"\x77")   # Loading the image bypasses the bus
+    assert device.bus_read(BUS_ROM_BASE + 0x10) == 0x77
+    assert bus_error(device.bus_write, BUS_ROM_BASE + 0x10, 0x55) == BUS_ACCESS_DENIED
+    assert device.mem_read(MEMSPACE_ROM, 0x10, 1) == b"\x77"
+
+
+@pytest.mark.parametrize("start, end", [(0x8000, 0x80FF), (0x8010, 0x801F)])
+def test_direct_access_rights(device, start, end):
+    # A whole page goes through the page pointers, a partial one through the map entry
+    device.bus_map_direct(MEMSPACE_RAM, start, end, MEM_ACCESS_WRITE)
+    device.bus_map_direct(MEMSPACE_RAM, start + 0x1000, end + 0x1000, MEM_ACCESS_READ)
+    device.bus_write(start + 3, 0x33)
+    assert device.mem_read(MEMSPACE_RAM, 3, 1) == b"\x33"
+    assert bus_error(device.bus_read, start + 3) == BUS_ACCESS_DENIED
+    assert device.bus_read(start + 0x1003) == 0x33
+    assert bus_error(device.bus_write, start + 0x1003, 0) == BUS_ACCESS_DENIED
+    assert bus_error(device.bus_map_direct, MEMSPACE_RAM, 0xA000, 0xA000 + MEM_SIZE, MEM_ACCESS_READ) == BUS_INVALID_RANGE
+
+
+def test_bulk_transfers(device):
+    data = bytes(range(256)) * 4
+    device.mem_write(MEMSPACE_RAM, 0x100, data)
+    assert device.mem_read(MEMSPACE_RAM, 0x100, len(data)) == data
+    buffer = bytearray(16)
+    assert device.mem_read_into(MEMSPACE_RAM, 0x110, buffer) is buffer
+    assert buffer == data[0x10:0x20]
+    device.mem_fill(MEMSPACE_RAM, 0x104, 4, 0xEE)
+    assert device.mem_compare(MEMSPACE_RAM, 0x100, data) == 4
+    assert device.mem_compare(MEMSPACE_RAM, 0x108, data[8:]) == MEM_EQUAL
+    with pytest.raises(TypeError):
+        device.mem_read_into(MEMSPACE_RAM, 0, b"read-only")
+
+
+@pytest.mark.parametrize("offset, length", [(MEM_SIZE - 3, 4), (MEM_SIZE, 1), (0xFFFFFFFF, 2)])
+def test_bulk_transfers_out_of_bounds(device, offset, length):
+    device.mem_fill(MEMSPACE_RAM, 0, MEM_SIZE, 0xAA)
+    # Out of bounds transfers are refused as a whole, nothing is written and nothing read
+    device.mem_write(MEMSPACE_RAM, offset, b"\x01" * length)
+    device.mem_fill(MEMSPACE_RAM, offset, length, 0x02)
+    assert device.mem_compare(MEMSPACE_RAM, 0, b"\xAA" * MEM_SIZE) == MEM_EQUAL
+    assert device.mem_read(MEMSPACE_RAM, offset, length) == bytes(length)
+    assert device.mem_compare(MEMSPACE_RAM, offset, b"\xAA" * length) == MEM_OUT_OF_BOUNDS
+
+
+def test_unknown_memspace(device):
+    assert device.mem_read(2, 0, 4) == bytes(4)
+    assert device.mem_compare(2, 0, b"\x00") == MEM_OUT_OF_BOUNDS
+
+
+def test_mem_view_aliases_the_memory(device):
+    view = device.mem_view(MEMSPACE_RAM)
+    assert len(view) == MEM_SIZE and not view.readonly
+    view[5] = 0x5A
+    assert device.mem_read(MEMSPACE_RAM, 5, 1) == b"\x5A"
+    assert device.bus_read(BUS_RAM_BASE + 5) == 0x5A
+    device.bus_write(BUS_RAM_BASE + 6, 0x6B)
+    device.mem_write(MEMSPACE_RAM, 7, b"\x7C")
+    assert bytes(view[5:8]) == b"\x5A\x6B\x7C"
+    # The views of one memspace share the memory, reset() clears it in place
+    assert device.mem_view(MEMSPACE_RAM)[5] == 0x5A
+    device.reset()
+    assert bytes(view[5:8]) == bytes(3)
+
+
+def test_mem_view_zero_copy_writes(device):
+    view = device.mem_view(MEMSPACE_ROM)
+    image = bytearray(b"\x01\x02\x03")
+    device.mem_write(MEMSPACE_ROM, 0, memoryview(image))
+    image[0] = 0xFF     # The DLL copied it, the caller's buffer is free again
+    assert bytes(view[:3]) == b"\x01\x02\x03"
+    device.mem_read_into(MEMSPACE_ROM, 0, view[0x10:0x13])
+    assert bytes(view[0x10:0x13]) == b"\x01\x02\x03"
+
+
+def test_mem_view_unknown_memspace(device):
+    with pytest.raises(ValueError):
+        device.mem_view(2)
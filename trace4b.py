@@ -0,0 +1,153 @@
+import argparse
+import struct
+import sys
+from collections import namedtuple
+
+# Binary execution trace of the 4-bit CPU.
+#
+# The file starts with HEADER (magic, format version, record size) followed by one
+# fixed-size RECORD per executed instruction:
+#   pc, opcode      address and raw nibbles of the instruction
+#   changed         CHANGED_* bits of the registers modified by the instruction
+#   mem_len         number of nibbles written to RAM (0 if none)
+#   abc             A << 8 | B << 4 | C
+#   e1, e2, sp      register values
+#   mem_addr        first written RAM address
+#   mem_value       written value (4 or 12 bits, depending on mem_len)
+# Register fields only hold the new values of changed registers and are 0 otherwise.
+# The same layout is described for C emitters in emulator/API/trace_format.h.
+
+MAGIC = b"T4BT"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+RECORD = struct.Struct("<HHBBHHHHHH")
+
+CHANGED_A = 0x01
+CHANGED_B = 0x02
+CHANGED_C = 0x04
+CHANGED_E1 = 0x08
+CHANGED_E2 = 0x10
+CHANGED_SP = 0x20
+CHANGED_NAMES = ["A", "B", "C", "E1", "E2", "SP"]
+
+READ_CHUNK = 4096   # Records read per file access
+
+TraceRecord = namedtuple("TraceRecord", "pc opcode changed mem_len abc e1 e2 sp mem_addr mem_value")
+
+
+def trace_header():
+    return HEADER.pack(MAGIC, VERSION, RECORD.size)
+
+
+def pack_record(pc, opcode, prev_regs, regs, mem_len=0, mem_addr=0, mem_value=0):
+    """Pack one record, prev_regs and regs are (A, B, C, E1, E2, SP) tuples"""
+    changed = 0
+    values = [0, 0, 0, 0, 0, 0]
+    for i in range(6):
+        if regs[i] != prev_regs[i]:
+            changed |= 1 << i
+            values[i] = regs[i]
+    abc = (values[0] << 8) | (values[1] << 4) | values[2]
+    return RECORD.pack(pc, opcode, changed, mem_len, abc, values[3], values[4], values[5], mem_addr, mem_value)
+
+
+def read_header(f, path):
+    header = f.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise ValueError(f"{path}: truncated trace header")
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path}: not a version {VERSION} trace file")
+
+
+def read_chunks(path):
+    """Yield the raw records of a trace in chunks of up to READ_CHUNK records"""
+    with open(path, 'rb') as f:
+        read_header(f, path)
+        while True:
+            chunk = f.read(RECORD.size * READ_CHUNK)
+            if len(chunk) % RECORD.size:
+                raise ValueError(f"{path}: truncated trace record")
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_trace(path):
+    """Stream the records of a trace file as TraceRecord tuples"""
+    for chunk in read_chunks(path):
+        for fields in RECORD.iter_unpack(chunk):
+            yield TraceRecord(*fields)
+
+
+def format_record(record):
+    regs = {
+        "A": record.abc >> 8, "B": (record.abc >> 4) & 0x0F, "C": record.abc & 0x0F,
+        "E1": record.e1, "E2": record.e2, "SP": record.sp,
+    }
+    changes = " ".join(f"{name}={regs[name]:X}" for i, name in enumerate(CHANGED_NAMES) if record.changed & (1 << i))
+    line = f"PC 0x{record.pc:03X} opcode 0x{record.opcode:04X}"
+    if changes:
+        line += f" {changes}"
+    if record.mem_len:
+        line += f" RAM[0x{record.mem_addr:03X}:{record.mem_len}]=0x{record.mem_value:X}"
+    return line
+
+
+def first_divergence(path_a, path_b):
+    """Return (index, record_a, record_b, previous_record) of the first differing record.
+
+    Returns None if both traces are identical. A record is None when its trace ended.
+    Chunks are compared as raw bytes, only the differing chunk is unpacked.
+    """
+    chunks_a = read_chunks(path_a)
+    chunks_b = read_chunks(path_b)
+    index = 0
+    previous = None
+    while True:
+        chunk_a = next(chunks_a, b"")
+        chunk_b = next(chunks_b, b"")
+        if chunk_a == chunk_b:
+            if not chunk_a:
+                return None
+            index += len(chunk_a) // RECORD.size
+            previous = TraceRecord(*RECORD.unpack_from(chunk_a, len(chunk_a) - RECORD.size))
+            continue
+        for offset in range(0, max(len(chunk_a), len(chunk_b)), RECORD.size):
+            raw_a = chunk_a[offset:offset + RECORD.size]
+            raw_b = chunk_b[offset:offset + RECORD.size]
+            if raw_a != raw_b:
+                record_a = TraceRecord(*RECORD.unpack(raw_a)) if raw_a else None
+                record_b = TraceRecord(*RECORD.unpack(raw_b)) if raw_b else None
+                return index, record_a, record_b, previous
+            previous = TraceRecord(*RECORD.unpack(raw_a))
+            index += 1
+
+
+def trace_diff(path_a, path_b):
+    divergence = first_divergence(path_a, path_b)
+    if divergence is None:
+        print("Traces are identical")
+        return 0
+    index, record_a, record_b, previous = divergence
+    print(f"Traces diverge at instruction {index}")
+    if previous is not None:
+        print(f"  previous: {format_record(previous)}")
+    print(f"  {path_a}: {format_record(record_a) if record_a else 'end of trace'}")
+    print(f"  {path_b}: {format_record(record_b) if record_b else 'end of trace'}")
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="4-bit CPU binary trace tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    diff_parser = subparsers.add_parser("trace-diff", help="Report the first divergence between two traces")
+    diff_parser.add_argument("trace_a", type=str)
+    diff_parser.add_argument("trace_b", type=str)
+    dump_parser = subparsers.add_parser("dump", help="Print the records of a trace")
+    dump_parser.add_argument("trace", type=str)
+    args = parser.parse_args()
+    if args.command == "trace-diff":
+        sys.exit(trace_diff(args.trace_a, args.trace_b))
+    for i, record in enumerate(read_trace(args.trace)):
+        print(f"{i}: {format_record(record)}")